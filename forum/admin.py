@@ -1,6 +1,7 @@
 from django.contrib import admin
 from mptt.admin import MPTTModelAdmin
 from .models import Category, Topic, Post, Attachment
+from kehubu.admin import IndexedSearchAdmin
 
 
 @admin.register(Category)
@@ -11,14 +12,14 @@ class CategoryAdmin(MPTTModelAdmin):
 
 
 @admin.register(Topic)
-class TopicAdmin(admin.ModelAdmin):
+class TopicAdmin(IndexedSearchAdmin):
     list_display = ('creator', 'category', 'title', 'created', 'modified')
     list_filter = ('created', 'modified')
     search_fields = ('title', )
 
 
 @admin.register(Post)
-class PostAdmin(admin.ModelAdmin):
+class PostAdmin(IndexedSearchAdmin):
     list_display = ('creator', 'topic', 'summary', 'created', 'modified')
     list_filter = ('created', 'modified')
     search_fields = ('content', )
@@ -0,0 +1,19 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from forum.models import AttachmentUpload
+
+
+class Command(BaseCommand):
+    help = "Delete chunked attachment uploads that have not been touched for a while"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        count = 0
+        for upload in AttachmentUpload.objects.filter(modified__lt=cutoff).iterator():
+            upload.delete()
+            count += 1
+        self.stdout.write("{} stale uploads deleted".format(count))
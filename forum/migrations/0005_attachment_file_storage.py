@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:51
+
+from django.db import migrations, models
+import kehubu.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0004_auto_20190417_0920'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attachment',
+            name='file',
+            field=models.FileField(storage=kehubu.storage.ContentAddressedStorage(), upload_to='uploads/forum.Attachment.file/%Y/%m/%d/'),
+        ),
+    ]
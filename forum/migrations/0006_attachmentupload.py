@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('kehubu', '0020_blob'),
+        ('forum', '0005_attachment_file_storage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attachment',
+            name='mimetype',
+            field=models.CharField(editable=False, max_length=128),
+        ),
+        migrations.CreateModel(
+            name='AttachmentUpload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0, editable=False)),
+                ('mimetype', models.CharField(editable=False, max_length=128)),
+                ('creator', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='forum_attachmentupload_set', to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='kehubu.Group')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0006_attachmentupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='icon_renditions_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,11 +1,19 @@
-from django.db import models
+import os
+import tempfile
+import magic
+from django.db import models, transaction
 from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
 from mptt.models import MPTTModel, TreeForeignKey
 from model_utils.models import TimeStampedModel
+from model_utils import FieldTracker
 from imagekit.models import ProcessedImageField
 from imagekit.processors import ResizeToFill
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
+from kehubu.counters import AtomicSaveMixin, increment
+from kehubu.storage import blob_storage
 
 
 class Category(MPTTModel, TimeStampedModel):
@@ -21,10 +29,13 @@ class Category(MPTTModel, TimeStampedModel):
                                format='PNG',
                                options={'quality': 80},
                                blank=True)
+    icon_renditions_ready = models.BooleanField(default=False, editable=False)
 
     topic_count = models.PositiveIntegerField(default=0)
     post_count = models.PositiveIntegerField(default=0)
 
+    tracker = FieldTracker(fields=['icon', 'group'])
+
     class Meta:
         unique_together = ('group', 'parent', 'name')
 
@@ -36,17 +47,16 @@ class Category(MPTTModel, TimeStampedModel):
             if self.group != self.parent.group:
                 raise ValidationError(_("Parent category must be in same group"))
 
-    def update_topic_count(self):
-        self.topic_count = self.topic_set.count()
-        self.save()
+    @classmethod
+    def update_topic_count(cls, pk, delta):
+        increment(cls.objects.filter(pk=pk), 'topic_count', delta)
 
-    def update_post_count(self):
-        topic_set = self.topic_set.all()
-        self.post_count = Post.objects.filter(topic__in=topic_set).count()
-        self.save()
+    @classmethod
+    def update_post_count(cls, pk, delta):
+        increment(cls.objects.filter(pk=pk), 'post_count', delta)
 
 
-class Topic(TimeStampedModel):
+class Topic(AtomicSaveMixin, TimeStampedModel):
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
                                 related_name='forum_topic_set')
@@ -55,6 +65,10 @@ class Topic(TimeStampedModel):
     is_published = models.BooleanField(default=True)
     post_count = models.PositiveIntegerField(default=0)
 
+    tracker = FieldTracker(fields=['category'])
+
+    search_kind = 'topic'
+
     def __str__(self):
         return self.title
 
@@ -62,21 +76,26 @@ class Topic(TimeStampedModel):
     def summary(self):
         return self.content[:200]
 
+    def get_search_document(self):
+        return self.category.group_id, self.created, [(self.title, 3), (self.content, 1)]
+
     def clean(self):
         if not self.category.group.has_member(self.creator):
             raise ValidationError(_("Only group member can create topic"))
 
-    def update_post_count(self):
-        self.post_count = self.post_set.count()
-        self.save()
+    @classmethod
+    def update_post_count(cls, pk, delta):
+        increment(cls.objects.filter(pk=pk), 'post_count', delta)
 
 
-class Post(TimeStampedModel):
+class Post(AtomicSaveMixin, TimeStampedModel):
     topic = models.ForeignKey(Topic, on_delete=models.CASCADE)
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
                                 related_name='forum_post_set')
     content = models.TextField()
 
+    search_kind = 'post'
+
     def __str__(self):
         return self.content[:50]
 
@@ -84,6 +103,9 @@ class Post(TimeStampedModel):
     def summary(self):
         return self.content[:200]
 
+    def get_search_document(self):
+        return self.topic.category.group_id, self.created, [(self.content, 1)]
+
     def clean(self):
         if not self.topic.category.group.has_member(self.creator):
             raise ValidationError(_("Only group member can create post"))
@@ -92,8 +114,10 @@ class Attachment(TimeStampedModel):
     group = models.ForeignKey('kehubu.Group', on_delete=models.CASCADE)
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
                                 related_name='forum_attachment_set')
-    file = models.FileField(upload_to="uploads/forum.Attachment.file/%Y/%m/%d/")
-    mimetype = models.CharField(max_length=24, editable=False)
+    file = models.FileField(upload_to="uploads/forum.Attachment.file/%Y/%m/%d/", storage=blob_storage)
+    mimetype = models.CharField(max_length=128, editable=False)
+
+    tracker = FieldTracker(fields=['file'])
 
     def __str__(self):
         return self.file.name
@@ -101,3 +125,68 @@ class Attachment(TimeStampedModel):
     def clean(self):
         if not self.group.has_member(self.creator):
             raise ValidationError(_("Only group member can create attachment"))
+
+
+class AttachmentUpload(TimeStampedModel):
+    """
+    A resumable, chunked Attachment upload. Chunks are appended in order to a
+    staging file outside MEDIA_ROOT; ``complete`` turns it into an Attachment.
+    """
+    group = models.ForeignKey('kehubu.Group', on_delete=models.CASCADE)
+    creator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                                related_name='forum_attachmentupload_set')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0, editable=False)
+    mimetype = models.CharField(max_length=128, editable=False)
+
+    def __str__(self):
+        return self.filename
+
+    @property
+    def path(self):
+        upload_dir = getattr(settings, 'FORUM_UPLOAD_DIR', None) or tempfile.gettempdir()
+        return os.path.join(upload_dir, 'forum-attachment-upload-{}'.format(self.pk))
+
+    @property
+    def is_complete(self):
+        return self.offset >= self.size
+
+    def write_chunk(self, offset, chunk):
+        """
+        Append ``chunk`` at ``offset`` and return the new offset, or None when
+        ``offset`` is not where the upload currently ends. The mimetype is
+        sniffed from the start of the first chunk.
+        """
+        with transaction.atomic():
+            upload = AttachmentUpload.objects.select_for_update().get(pk=self.pk)
+            if offset != upload.offset:
+                self.offset = upload.offset
+                return None
+            with open(self.path, 'r+b' if offset else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                for data in chunk.chunks():
+                    if f.tell() == 0:
+                        self.mimetype = magic.from_buffer(data[:1024], mime=True)
+                    f.write(data)
+                self.offset = f.tell()
+            AttachmentUpload.objects.filter(pk=self.pk).update(
+                offset=self.offset, mimetype=self.mimetype, modified=timezone.now())
+        return self.offset
+
+    def complete(self):
+        """Store the staged file as an Attachment and discard this upload."""
+        attachment = Attachment(group_id=self.group_id, creator_id=self.creator_id,
+                                mimetype=self.mimetype)
+        with open(self.path, 'rb') as f:
+            attachment.file.save(self.filename, File(f), save=False)
+        attachment.save()
+        self.delete()
+        return attachment
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -1,4 +1,5 @@
 from rest_framework import permissions
+from kehubu.permissions import get_roles
 
 class CategoryPermission(permissions.BasePermission):
     def has_permission(self, request, view):
@@ -9,14 +10,11 @@ class CategoryPermission(permissions.BasePermission):
             return False
 
         if request.method == 'POST':
-            group = request.data.get('group')
-            if not request.user.creator_kehubu_group_set.filter(pk=group).exists():
-                return False
-            return True
+            return get_roles(request).is_creator(request.data.get('group'))
         return True
 
     def has_object_permission(self, request, view, obj):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        return request.user == obj.group.creator
+        return get_roles(request).is_creator(obj.group_id)
@@ -1,10 +1,11 @@
 from .models import (
-    Category, Topic, Post, Attachment,
+    Category, Topic, Post, Attachment, AttachmentUpload,
 )
 from rest_framework import serializers
 from django.utils.translation import gettext_lazy as _
 from drf_extra_fields.fields import Base64FileField
-from kehubu.serializers import UserSerializer
+from kehubu.serializers import UserCardField, UserCardListSerializer, GroupPKField
+from kehubu.renditions import RenditionsField
 
 
 
@@ -16,6 +17,7 @@ class CategoryPKField(serializers.PrimaryKeyRelatedField):
 
 class CategorySerializer(serializers.ModelSerializer):
     parent  = CategoryPKField(allow_null=True, required=False)
+    icon_renditions = RenditionsField(source='icon')
 
     class Meta:
         model = Category
@@ -24,10 +26,11 @@ class CategorySerializer(serializers.ModelSerializer):
 
 
 class TopicSerializer(serializers.ModelSerializer):
-    creator = UserSerializer(read_only=True)
+    creator = UserCardField()
     class Meta:
         model = Topic
         fields = "__all__"
+        list_serializer_class = UserCardListSerializer
 
     def validate(self, attrs):
         attrs['creator'] = self.context['request'].user
@@ -35,10 +38,11 @@ class TopicSerializer(serializers.ModelSerializer):
 
 
 class PostSerializer(serializers.ModelSerializer):
-    creator = UserSerializer(read_only=True)
+    creator = UserCardField()
     class Meta:
         model = Post
         fields = "__all__"
+        list_serializer_class = UserCardListSerializer
 
     def validate(self, attrs):
         attrs['creator'] = self.context['request'].user
@@ -49,3 +53,32 @@ class AttachmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Attachment
         fields = "__all__"
+
+
+class AttachmentUploadSerializer(serializers.ModelSerializer):
+    group = GroupPKField()
+    creator = UserCardField()
+
+    class Meta:
+        model = AttachmentUpload
+        fields = "__all__"
+
+    def validate_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError(_("Size must be positive"))
+        return value
+
+    def validate(self, attrs):
+        attrs['creator'] = self.context['request'].user
+        return attrs
+
+
+class AttachmentChunkSerializer(serializers.Serializer):
+    offset = serializers.IntegerField(min_value=0)
+    chunk = serializers.FileField()
+
+    def validate(self, attrs):
+        upload = self.context['upload']
+        if attrs['offset'] + attrs['chunk'].size > upload.size:
+            raise serializers.ValidationError(_("Chunk exceeds the upload size"))
+        return attrs
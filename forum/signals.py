@@ -1,34 +1,79 @@
 import magic
 from django.db.models import signals
 from django.dispatch import receiver
-from .models import Attachment, Post, Category, Topic
+from .models import Attachment, AttachmentUpload, Post, Category, Topic
+from kehubu.renditions import reset_renditions, schedule_renditions
+from kehubu.storage import blob_storage
+from kehubu.search import get_search_backend, index_queryset
 
 
 @receiver(signals.pre_save, sender=Attachment)
 def attachment_pre_save(sender, instance, **kwargs):
-    if instance.file:
-        instance.mimetype = magic.from_buffer(instance.file.read(1024), mime=True)
+    # sniff new uploads only; committed files were sniffed when they arrived
+    if instance.file and not instance.file._committed:
+        file = instance.file.file
+        file.seek(0)
+        instance.mimetype = magic.from_buffer(file.read(1024), mime=True)
+        file.seek(0)
+
+
+@receiver(signals.post_save, sender=Attachment)
+def attachment_post_save(sender, instance, created, **kwargs):
+    if not created and instance.tracker.has_changed('file'):
+        blob_storage.release(instance.tracker.previous('file'))
+
+
+@receiver(signals.post_delete, sender=Attachment)
+def attachment_post_delete(sender, instance, **kwargs):
+    blob_storage.release(instance.file.name)
+
+
+@receiver(signals.post_delete, sender=AttachmentUpload)
+def attachment_upload_post_delete(sender, instance, **kwargs):
+    instance.discard()
+
+
+@receiver(signals.pre_save, sender=Category)
+def category_pre_save(sender, instance, **kwargs):
+    reset_renditions(instance, 'icon')
+
+
+@receiver(signals.post_save, sender=Category)
+def category_post_save(sender, instance, created, **kwargs):
+    schedule_renditions(instance, 'icon')
+    if not created and instance.tracker.has_changed('group'):
+        # topics and posts are indexed under their category's group
+        index_queryset(Topic.objects.filter(category=instance).select_related('category'))
+        index_queryset(Post.objects.filter(topic__category=instance).select_related('topic__category'))
 
 
 @receiver(signals.post_save, sender=Topic)
 def topic_post_save(sender, instance, created, **kwargs):
     if created:
-        instance.category.update_topic_count()
+        Category.update_topic_count(instance.category_id, 1)
+    get_search_backend().index([instance])
+    if not created and instance.tracker.has_changed('category'):
+        index_queryset(Post.objects.filter(topic=instance).select_related('topic__category'))
 
 
 @receiver(signals.post_delete, sender=Topic)
 def topic_post_delete(sender, instance, **kwargs):
-    instance.category.update_topic_count()
+    Category.update_topic_count(instance.category_id, -1)
+    get_search_backend().remove(instance.search_kind, instance.pk)
 
 
 @receiver(signals.post_save, sender=Post)
 def post_post_save(sender, instance, created, **kwargs):
     if created:
-        instance.topic.category.update_post_count()
-        instance.topic.update_post_count()
+        category_id = Topic.objects.filter(pk=instance.topic_id).values('category')[:1]
+        Category.update_post_count(category_id, 1)
+        Topic.update_post_count(instance.topic_id, 1)
+    get_search_backend().index([instance])
 
 
 @receiver(signals.post_delete, sender=Post)
 def post_post_delete(sender, instance, **kwargs):
-    instance.topic.category.update_topic_count()
-    instance.topic.update_post_count()
\ No newline at end of file
+    category_id = Topic.objects.filter(pk=instance.topic_id).values('category')[:1]
+    Category.update_post_count(category_id, -1)
+    Topic.update_post_count(instance.topic_id, -1)
+    get_search_backend().remove(instance.search_kind, instance.pk)
@@ -1,3 +1,296 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db.models import signals
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from kehubu.models import Group, GroupAlbum, GroupChat
+from kehubu.search import get_search_backend
+from kehubu.tests import KehubuTestCase, QueryBudgetTestCase, make_image
+from .models import Category, Topic, Post, Attachment, AttachmentUpload
 
-# Create your tests here.
+
+class ForumQueryBudgetTest(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.category = Category.objects.create(group=self.group, name='c')
+        self.topic = Topic.objects.create(category=self.category, creator=self.user, title='t', content='c')
+
+    def create_member(self):
+        user = self.create_user()
+        self.group.add_member(user)
+        return user
+
+    def test_category_list(self):
+        def populate(size):
+            while Category.objects.filter(group=self.group).count() < size:
+                Category.objects.create(group=self.group, name='c{}'.format(self.user_count),
+                                        parent=self.category)
+                self.user_count += 1
+        self.assertFlatQueryCount('/api/forum/category/', populate)
+
+    def test_topic_list(self):
+        def populate(size):
+            while Topic.objects.count() < size:
+                Topic.objects.create(category=self.category, creator=self.create_member(),
+                                     title='t', content='c')
+        self.assertFlatQueryCount('/api/forum/topic/', populate)
+
+    def test_post_list(self):
+        def populate(size):
+            while Post.objects.count() < size:
+                Post.objects.create(topic=self.topic, creator=self.create_member(), content='c')
+        self.assertFlatQueryCount('/api/forum/post/', populate)
+
+
+class ForumCounterTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.category = Category.objects.create(group=self.group, name='c')
+
+    def get_counts(self):
+        category = Category.objects.get(pk=self.category.pk)
+        return category.topic_count, category.post_count
+
+    def test_topic_and_post_counts(self):
+        topic = Topic.objects.create(category=self.category, creator=self.user, title='t', content='c')
+        post = Post.objects.create(topic=topic, creator=self.user, content='c')
+        Post.objects.create(topic=topic, creator=self.user, content='c')
+        self.assertEqual(self.get_counts(), (1, 2))
+        self.assertEqual(Topic.objects.get(pk=topic.pk).post_count, 2)
+
+        post.delete()
+        self.assertEqual(self.get_counts(), (1, 1))
+        self.assertEqual(Topic.objects.get(pk=topic.pk).post_count, 1)
+
+        topic.delete()
+        self.assertEqual(self.get_counts(), (0, 0))
+
+    def test_failed_save_rolls_back_the_counter(self):
+        def fail(sender, instance, created, **kwargs):
+            raise RuntimeError
+        signals.post_save.connect(fail, sender=Topic)
+        try:
+            with self.assertRaises(RuntimeError):
+                Topic.objects.create(category=self.category, creator=self.user, title='t', content='c')
+        finally:
+            signals.post_save.disconnect(fail, sender=Topic)
+        self.assertEqual(self.get_counts(), (0, 0))
+        self.assertFalse(Topic.objects.exists())
+
+
+class AttachmentUploadTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.upload_dir, ignore_errors=True)
+        settings_override = override_settings(FORUM_UPLOAD_DIR=self.upload_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.data = make_image().read()
+
+    def create_upload(self, size=None, group=None):
+        response = self.client.post('/api/forum/attachmentupload/', {
+            'group': (group or self.group).pk,
+            'filename': 'image.png',
+            'size': len(self.data) if size is None else size,
+        })
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data['id']
+
+    def send_chunk(self, upload_id, offset, data):
+        return self.client.post('/api/forum/attachmentupload/{}/chunk/'.format(upload_id), {
+            'offset': offset,
+            'chunk': ContentFile(data, name='chunk'),
+        }, format='multipart')
+
+    def complete(self, upload_id):
+        return self.client.post('/api/forum/attachmentupload/{}/complete/'.format(upload_id))
+
+    def test_chunked_upload(self):
+        upload_id = self.create_upload()
+        half = len(self.data) // 2
+        response = self.send_chunk(upload_id, 0, self.data[:half])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['offset'], half)
+        self.assertEqual(response.data['mimetype'], 'image/png')
+        self.assertEqual(self.send_chunk(upload_id, half, self.data[half:]).status_code, 200)
+
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 201)
+        attachment = Attachment.objects.get(pk=response.data['id'])
+        self.assertEqual(attachment.mimetype, 'image/png')
+        self.assertEqual(attachment.creator, self.user)
+        self.assertEqual(attachment.file.read(), self.data)
+        self.assertFalse(AttachmentUpload.objects.exists())
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_out_of_order_chunk(self):
+        upload_id = self.create_upload()
+        response = self.send_chunk(upload_id, 10, self.data[10:20])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], 0)
+
+        self.send_chunk(upload_id, 0, self.data[:10])
+        response = self.send_chunk(upload_id, 0, self.data[:10])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], 10)
+
+    def test_oversized_chunk(self):
+        upload_id = self.create_upload(size=10)
+        self.assertEqual(self.send_chunk(upload_id, 0, self.data[:11]).status_code, 400)
+        self.assertEqual(self.send_chunk(upload_id, 0, self.data[:10]).status_code, 200)
+        self.assertEqual(self.send_chunk(upload_id, 10, self.data[10:11]).status_code, 400)
+
+    def test_complete_with_missing_chunks(self):
+        upload_id = self.create_upload()
+        self.send_chunk(upload_id, 0, self.data[:10])
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], 10)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_invalid_size_and_group(self):
+        response = self.client.post('/api/forum/attachmentupload/', {
+            'group': self.group.pk, 'filename': 'a.png', 'size': 0})
+        self.assertEqual(response.status_code, 400)
+
+        other = Group.objects.create(creator=User.objects.create(username='other'), name='o')
+        response = self.client.post('/api/forum/attachmentupload/', {
+            'group': other.pk, 'filename': 'a.png', 'size': 10})
+        self.assertEqual(response.status_code, 400)
+
+    def test_uploads_are_private(self):
+        upload_id = self.create_upload()
+        member = User.objects.create(username='member')
+        self.group.add_member(member)
+        self.client.force_authenticate(member)
+        self.assertEqual(self.send_chunk(upload_id, 0, self.data[:10]).status_code, 404)
+
+    def test_clear_stale_uploads(self):
+        upload_id = self.create_upload()
+        self.send_chunk(upload_id, 0, self.data[:10])
+        fresh_id = self.create_upload()
+        AttachmentUpload.objects.filter(pk=upload_id).update(modified=timezone.now() - timedelta(days=2))
+
+        out = StringIO()
+        call_command('clear_attachment_uploads', stdout=out)
+        self.assertIn('1 stale uploads deleted', out.getvalue())
+        self.assertEqual(list(AttachmentUpload.objects.values_list('pk', flat=True)), [fresh_id])
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+
+class ForumSearchTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.category = Category.objects.create(group=self.group, name='c')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_topic(self, title, category=None):
+        return Topic.objects.create(category=category or self.category, creator=self.user,
+                                    title=title, content='content')
+
+    def search(self, url, query, **params):
+        return self.client.get(url, dict(params, search=query))
+
+    def test_results_are_not_capped(self):
+        topics = [self.create_topic('needle {}'.format(i)) for i in range(205)]
+        response = self.search('/api/forum/topic/', 'needle', limit=10, offset=200)
+        self.assertEqual(response.data['count'], 205)
+        self.assertEqual(len(response.data['results']), 5)
+        # equal scores fall back to the newest first
+        self.assertEqual([topic['id'] for topic in response.data['results']],
+                         [topic.pk for topic in reversed(topics[:5])])
+
+    def test_best_match_first_unless_ordered(self):
+        content_match = Topic.objects.create(category=self.category, creator=self.user,
+                                             title='t', content='needle')
+        title_match = self.create_topic('needle')
+        self.create_topic('hay')
+        response = self.search('/api/forum/topic/', 'needle')
+        self.assertEqual([topic['id'] for topic in response.data['results']],
+                         [title_match.pk, content_match.pk])
+        response = self.search('/api/forum/topic/', 'needle', ordering='id')
+        self.assertEqual([topic['id'] for topic in response.data['results']],
+                         [content_match.pk, title_match.pk])
+
+    def test_group_chat_best_match_first(self):
+        strong = GroupChat.objects.create(group=self.group, user=self.user, message='needle needle')
+        weak = GroupChat.objects.create(group=self.group, user=self.user, message='needle hay')
+        GroupChat.objects.create(group=self.group, user=self.user, message='hay')
+        response = self.search('/api/kehubu/groupchat/', 'needle', limit=1)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([chat['id'] for chat in response.data['results']], [strong.pk])
+        response = self.client.get('/api/kehubu/groupchat/', response.data['next_query'])
+        self.assertEqual([chat['id'] for chat in response.data['results']], [weak.pk])
+
+        # without a search the keyset pages stay newest first
+        response = self.client.get('/api/kehubu/groupchat/')
+        self.assertNotIn('count', response.data)
+        self.assertEqual(response.data['results'][-1]['id'], strong.pk)
+
+    def test_other_groups_are_not_searched(self):
+        other = Group.objects.create(creator=User.objects.create(username='other'), name='o')
+        self.create_topic('needle', category=Category.objects.create(group=other, name='c'))
+        self.assertEqual(self.search('/api/forum/topic/', 'needle').data['count'], 0)
+
+    def test_moved_topic_reindexes_posts(self):
+        other = Group.objects.create(creator=self.user, name='o')
+        topic = self.create_topic('t')
+        post = Post.objects.create(topic=topic, creator=self.user, content='needle')
+        backend = get_search_backend()
+
+        topic.category = Category.objects.create(group=other, name='c')
+        topic.save()
+        self.assertEqual(backend.search('post', 'needle', group_ids=[self.group.pk]), [])
+        self.assertEqual(backend.search('post', 'needle', group_ids=[other.pk]), [post.pk])
+
+    def test_moved_category_reindexes_topics_and_posts(self):
+        other = Group.objects.create(creator=self.user, name='o')
+        topic = self.create_topic('needle')
+        post = Post.objects.create(topic=topic, creator=self.user, content='needle')
+        backend = get_search_backend()
+
+        self.category.group = other
+        self.category.save()
+        for kind, obj in (('topic', topic), ('post', post)):
+            self.assertEqual(backend.search(kind, 'needle', group_ids=[self.group.pk]), [])
+            self.assertEqual(backend.search(kind, 'needle', group_ids=[other.pk]), [obj.pk])
+
+
+class GroupStatsTest(KehubuTestCase):
+    def test_annotated_stats_match_aggregates(self):
+        user = User.objects.create(username='me')
+        group = Group.objects.create(creator=user, name='g')
+        empty = Group.objects.create(creator=user, name='e')
+        GroupAlbum.objects.create(group=group, title='a')
+        category = Category.objects.create(group=group, name='c')
+        for i in range(2):
+            topic = Topic.objects.create(category=category, creator=user, title='t', content='c')
+            for j in range(i + 1):
+                Post.objects.create(topic=topic, creator=user, content='c')
+
+        for pk, albums, topics, posts in ((group.pk, 1, 2, 3), (empty.pk, 0, 0, 0)):
+            annotated = Group.objects.with_stats().get(pk=pk)
+            plain = Group.objects.get(pk=pk)
+            self.assertEqual(annotated.album_count, albums)
+            self.assertEqual(plain.album_count, albums)
+            self.assertEqual(annotated.forum_stats, dict(topic_count=topics, post_count=posts))
+            self.assertEqual(plain.forum_stats, dict(topic_count=topics, post_count=posts))
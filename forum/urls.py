@@ -7,4 +7,5 @@ router.register(r'category', views.CategoryViewSet, basename='category')
 router.register(r'topic', views.TopicViewSet, basename='topic')
 router.register(r'post', views.PostViewSet, basename='post')
 router.register(r'attachment', views.AttachmentViewSet, basename='attachment')
+router.register(r'attachmentupload', views.AttachmentUploadViewSet, basename='attachmentupload')
 urlpatterns = router.urls
\ No newline at end of file
@@ -1,12 +1,17 @@
 from rest_framework import (
-        viewsets, generics, permissions, filters, exceptions, status,
+        viewsets, generics, permissions, filters, exceptions, status, mixins,
 )
-from .models import Category, Topic, Post, Attachment
+from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.response import Response
+from .models import Category, Topic, Post, Attachment, AttachmentUpload
 from .serializers import (
     CategorySerializer, TopicSerializer, PostSerializer, AttachmentSerializer,
+    AttachmentUploadSerializer, AttachmentChunkSerializer,
 )
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import OrderingFilter, SearchFilter
+from kehubu.filters import IndexedSearchFilter
 from kehubu.permissions import (IsGroupCreatorOrReadOnly, IsOwnerOrReadOnly)
 from .permissions import CategoryPermission
 
@@ -31,9 +36,9 @@ class TopicViewSet(viewsets.ModelViewSet):
     permission_classes = [IsOwnerOrReadOnly, permissions.IsAuthenticated]
     owner_field = "creator"
     filterset_fields = ('category', 'creator', 'category__group')
-    filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
+    filter_backends = (DjangoFilterBackend, OrderingFilter, IndexedSearchFilter)
     ordering_fields = ('id', 'category', 'creator', 'created', 'modified')
-    search_fields = ('title', )
+    search_kind = 'topic'
 
     def get_queryset(self):
         group_ids = self.request.user.kehubu_profile.group_ids
@@ -46,9 +51,9 @@ class PostViewSet(viewsets.ModelViewSet):
     permission_classes = [IsOwnerOrReadOnly, permissions.IsAuthenticated]
     owner_field = "creator"
     filterset_fields = ('topic', 'creator', 'topic__category', 'topic__category__group')
-    filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
+    filter_backends = (DjangoFilterBackend, OrderingFilter, IndexedSearchFilter)
     ordering_fields = ('id', 'topic', 'creator', 'created', 'modified')
-    search_fields = ('content', )
+    search_kind = 'post'
 
     def get_queryset(self):
         group_ids = self.request.user.kehubu_profile.group_ids
@@ -67,3 +72,41 @@ class AttachmentViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         group_ids = self.request.user.kehubu_profile.group_ids
         return self.queryset.filter(group__in=group_ids)
+
+
+class AttachmentUploadViewSet(mixins.CreateModelMixin,
+                              mixins.RetrieveModelMixin,
+                              mixins.DestroyModelMixin,
+                              viewsets.GenericViewSet):
+    """
+    Resumable attachment upload: create the upload, POST its chunks in order
+    to ``chunk`` and finish with ``complete``. A client that lost its place
+    reads ``offset`` back from the upload and resumes from there.
+    """
+    serializer_class = AttachmentUploadSerializer
+    queryset = AttachmentUpload.objects.all()
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return self.queryset.filter(creator=self.request.user)
+
+    @action(detail=True, methods=['post'], parser_classes=[MultiPartParser, FormParser])
+    def chunk(self, request, pk=None):
+        upload = self.get_object()
+        serializer = AttachmentChunkSerializer(data=request.data, context=dict(upload=upload))
+        serializer.is_valid(raise_exception=True)
+        offset = upload.write_chunk(**serializer.validated_data)
+        if offset is None:
+            return Response({'detail': 'Offset mismatch', 'offset': upload.offset},
+                            status=status.HTTP_409_CONFLICT)
+        return Response(self.get_serializer(upload).data)
+
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        upload = self.get_object()
+        if not upload.is_complete:
+            return Response({'detail': 'Upload is incomplete', 'offset': upload.offset},
+                            status=status.HTTP_409_CONFLICT)
+        attachment = upload.complete()
+        serializer = AttachmentSerializer(attachment, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -0,0 +1,100 @@
+from collections import defaultdict
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from actstream.models import Action
+from .models import Group, FeedItem, get_group_user_ids
+
+GENERIC_FIELDS = ('actor', 'target', 'action_object')
+
+
+def prefetch_action_objects(actions):
+    """
+    Resolve the actor, target and action object of ``actions`` with one
+    ``in_bulk`` per content type and attach them (and their content types)
+    to the generic foreign key caches, so serializing the page never falls
+    back to a query per row.
+    """
+    object_ids = defaultdict(set)
+    for action in actions:
+        for name in GENERIC_FIELDS:
+            ct_id = getattr(action, name + '_content_type_id')
+            if ct_id is not None:
+                object_ids[ct_id].add(getattr(action, name + '_object_id'))
+
+    objects = dict()
+    for ct_id, ids in object_ids.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        if model is None:
+            continue
+        pk_field = model._meta.pk
+        for pk, obj in model._base_manager.in_bulk([pk_field.to_python(pk) for pk in ids]).items():
+            objects[(ct_id, pk)] = obj
+
+    for action in actions:
+        for name in GENERIC_FIELDS:
+            ct_id = getattr(action, name + '_content_type_id')
+            if ct_id is None:
+                continue
+            ct = ContentType.objects.get_for_id(ct_id)
+            action._meta.get_field(name + '_content_type').set_cached_value(action, ct)
+            model = ct.model_class()
+            if model is None:
+                continue
+            pk = model._meta.pk.to_python(getattr(action, name + '_object_id'))
+            obj = objects.get((ct_id, pk))
+            if obj is not None:
+                action._meta.get_field(name).set_cached_value(action, obj)
+    return actions
+
+
+def get_action_group_ids(action):
+    """Ids of the groups ``action`` refers to as actor, target or action object."""
+    group_ct = ContentType.objects.get_for_model(Group)
+    group_ids = set()
+    for name in GENERIC_FIELDS:
+        if getattr(action, name + '_content_type_id') == group_ct.pk:
+            group_ids.add(int(getattr(action, name + '_object_id')))
+    return group_ids
+
+
+def fan_out(actions):
+    """Write a FeedItem for every member of the groups each action refers to."""
+    feed_items = []
+    for action in actions:
+        group_ids = get_action_group_ids(action)
+        if not group_ids:
+            continue
+        for user_id in get_group_user_ids(group_ids):
+            feed_items.append(FeedItem(user_id=user_id, action=action, timestamp=action.timestamp))
+    FeedItem.objects.bulk_create(feed_items, batch_size=500, ignore_conflicts=True)
+    return len(feed_items)
+
+
+def group_action_q(group_id, prefix=''):
+    """Q for the actions that refer to ``group_id`` as actor, target or action object."""
+    group_ct = ContentType.objects.get_for_model(Group)
+    object_id = str(group_id)
+    return (
+        Q(**{prefix + 'actor_content_type': group_ct, prefix + 'actor_object_id': object_id}) |
+        Q(**{prefix + 'target_content_type': group_ct, prefix + 'target_object_id': object_id}) |
+        Q(**{prefix + 'action_object_content_type': group_ct, prefix + 'action_object_object_id': object_id})
+    )
+
+
+def backfill_group_feed(user_id, group_id):
+    """
+    Give a new member of ``group_id`` the group's latest actions, which were
+    fanned out before they joined. ``KEHUBU_FEED_BACKFILL_SIZE`` caps how many.
+    """
+    size = getattr(settings, 'KEHUBU_FEED_BACKFILL_SIZE', 100)
+    action_set = Action.objects.filter(group_action_q(group_id)).order_by('-timestamp', '-id')
+    feed_items = [FeedItem(user_id=user_id, action_id=pk, timestamp=timestamp)
+                  for pk, timestamp in action_set.values_list('pk', 'timestamp')[:size]]
+    FeedItem.objects.bulk_create(feed_items, batch_size=500, ignore_conflicts=True)
+    return len(feed_items)
+
+
+def remove_group_feed(user_id, group_id):
+    """Drop the feed items ``user_id`` received through ``group_id``."""
+    FeedItem.objects.filter(user=user_id).filter(group_action_q(group_id, 'action__')).delete()
@@ -1,9 +1,19 @@
 from django.contrib import admin
 from . import models
+from .search import get_search_backend
 
 admin.site.site_header = 'kehubu administration'
 admin.site.site_title = 'kehubu site admin'
 
+
+class IndexedSearchAdmin(admin.ModelAdmin):
+    """ModelAdmin whose search box queries the search index of ``model.search_kind``."""
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return get_search_backend().rank(queryset, self.model.search_kind, search_term), False
+
+
 @admin.register(models.Profile)
 class ProfileAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'nickname', 'id_type', 'id_number', 'gender', 'birthdate', 'country', 'province', 'city')
@@ -67,7 +77,7 @@ class GroupAlbumImageAdmin(admin.ModelAdmin):
 
 
 @admin.register(models.GroupChat)
-class GroupChatAdmin(admin.ModelAdmin):
+class GroupChatAdmin(IndexedSearchAdmin):
     list_display = ('group', 'user', 'message_summary', 'created', 'modified')
     list_filter = ('created', 'modified')
     search_fields = ('message', )
@@ -78,3 +88,18 @@ class UserChatAdmin(admin.ModelAdmin):
     list_display = ('sender', 'receiver', 'message_summary', 'created', 'modified')
     list_filter = ('created', 'modified')
     search_fields = ('message', )
+
+
+
+@admin.register(models.Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('owner', 'peer', 'last_message_summary', 'last_activity', 'unread_count')
+    list_filter = ('last_activity', )
+    search_fields = ('owner__username', 'peer__username')
+
+
+@admin.register(models.OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('channel', 'attempts', 'next_attempt', 'created')
+    list_filter = ('created', )
+    search_fields = ('channel', )
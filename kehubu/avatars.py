@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from imagekit import ImageSpec
+from imagekit.processors import ResizeToFill
+
+logger = logging.getLogger(__name__)
+
+HEAD_IMAGE_TIMEOUT = (3, 10)
+
+
+class HeadImage(ImageSpec):
+    processors = [ResizeToFill(256, 256)]
+    format = 'JPEG'
+    options = {'quality': 85}
+
+
+_session = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """Process-wide requests session so avatar fetches reuse CDN connections."""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=1)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                workers = getattr(settings, 'KEHUBU_AVATAR_WORKERS', 4)
+                _executor = ThreadPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def sync_head_image(profile_id, url):
+    """
+    Fetch ``url`` into the profile's head image unless it is the stored source
+    and the CDN answers 304 to its stored ETag. Returns True when it saved.
+    """
+    from .models import Profile
+    close_old_connections()
+    try:
+        profile = Profile.objects.get(pk=profile_id)
+        headers = dict()
+        if url == profile.head_image_source and profile.head_image:
+            if not profile.head_image_etag:
+                return False
+            headers['If-None-Match'] = profile.head_image_etag
+        response = get_session().get(url, headers=headers, timeout=HEAD_IMAGE_TIMEOUT)
+        if response.status_code != 200:
+            return False
+        etag = response.headers.get('ETag', '')[:128]
+        if etag and etag == profile.head_image_etag and profile.head_image:
+            if url != profile.head_image_source:
+                Profile.objects.filter(pk=profile_id).update(head_image_source=url)
+            return False
+
+        content = HeadImage(source=ContentFile(response.content)).generate()
+        name = '{}.jpg'.format(hashlib.md5(url.encode()).hexdigest())
+        profile.head_image.save(name, ContentFile(content.read()), save=False)
+        profile.head_image_source = url
+        profile.head_image_etag = etag
+        profile.save(update_fields=['head_image', 'head_image_renditions_ready',
+                                    'head_image_source', 'head_image_etag'])
+        return True
+    finally:
+        close_old_connections()
+
+
+def submit_head_image(profile_id, url):
+    def done(future):
+        try:
+            future.result()
+        except Exception:
+            logger.exception("head image sync failed for profile %s", profile_id)
+
+    get_executor().submit(sync_head_image, profile_id, url).add_done_callback(done)
+
+
+def schedule_head_image(profile, url):
+    """Sync ``profile``'s head image from ``url`` in the background after commit."""
+    profile_id = profile.pk
+    transaction.on_commit(lambda: submit_head_image(profile_id, url))
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from django.db import connection, transaction
+from .models import GroupChat, UserChat
+from .signals import broadcast_group_chat, broadcast_user_chat
+from .search import get_search_backend
+
+logger = logging.getLogger(__name__)
+
+BROADCASTS = {
+    GroupChat: broadcast_group_chat,
+    UserChat: broadcast_user_chat,
+}
+
+
+def persist(objs):
+    """
+    Insert a batch of unsaved chat rows in one transaction and broadcast them
+    the way their post_save signals would.
+    """
+    with transaction.atomic():
+        by_model = dict()
+        for obj in objs:
+            by_model.setdefault(obj.__class__, []).append(obj)
+        for model, model_objs in by_model.items():
+            if connection.features.can_return_ids_from_bulk_insert:
+                model.objects.bulk_create(model_objs)
+                for obj in model_objs:
+                    BROADCASTS[model](obj, True)
+                if hasattr(model, 'search_kind'):
+                    get_search_backend().index(model_objs)
+            else:
+                # without returned ids each row is saved and broadcast by post_save
+                for obj in model_objs:
+                    obj.save()
+
+
+class ChatWriteBuffer(object):
+    """
+    Collects chat rows from websocket consumers and writes them with one
+    transaction per ``window`` seconds (or per ``max_size`` rows).
+    """
+    window = 0.05
+    max_size = 100
+
+    def __init__(self):
+        self.pending = []
+        self.flush_handle = None
+
+    async def add(self, obj):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((obj, future))
+        if len(self.pending) >= self.max_size:
+            self.schedule_flush(loop)
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self.schedule_flush, loop)
+        return await future
+
+    def schedule_flush(self, loop):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            loop.create_task(self.flush(batch))
+
+    async def flush(self, batch):
+        try:
+            await database_sync_to_async(persist)([obj for obj, future in batch])
+        except Exception:
+            logger.exception("failed to persist %s chat messages, retrying them one by one", len(batch))
+            for obj, future in batch:
+                await self.retry(obj, future)
+        else:
+            for obj, future in batch:
+                if not future.done():
+                    future.set_result(obj)
+
+    async def retry(self, obj, future):
+        """Persist ``obj`` on its own, so one bad row cannot sink the rest of its batch."""
+        # the rolled back bulk insert may have assigned a primary key
+        obj.pk = None
+        obj._state.adding = True
+        try:
+            await database_sync_to_async(persist)([obj])
+        except Exception as exc:
+            logger.exception("failed to persist a %s", obj.__class__.__name__)
+            if not future.done():
+                future.set_exception(exc)
+        else:
+            if not future.done():
+                future.set_result(obj)
+
+
+chat_write_buffer = ChatWriteBuffer()
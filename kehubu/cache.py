@@ -0,0 +1,80 @@
+import time
+from django.core.cache import cache
+from django.db import transaction
+
+
+class VersionedCache(object):
+    """
+    Cache entries keyed by a primary key plus a per-key version counter.
+
+    Invalidation bumps the version instead of deleting the value, so readers
+    racing with a writer can never resurrect data cached under the old version.
+    A missing version counter restarts from the current time rather than 1 so
+    values left behind by an evicted counter are never read again.
+    """
+    timeout = 60 * 60
+
+    def __init__(self, prefix, timeout=None):
+        self.prefix = prefix
+        if timeout is not None:
+            self.timeout = timeout
+
+    def version_key(self, pk):
+        return "{}.version.{}".format(self.prefix, pk)
+
+    def value_key(self, pk, version):
+        return "{}.{}.v{}".format(self.prefix, pk, version)
+
+    def initial_version(self):
+        return int(time.time() * 1000)
+
+    def get_versions(self, pks):
+        version_keys = {self.version_key(pk): pk for pk in pks}
+        found = cache.get_many(version_keys.keys())
+        versions = dict()
+        for key, pk in version_keys.items():
+            version = found.get(key)
+            if version is None:
+                cache.add(key, self.initial_version(), None)
+                version = cache.get(key) or self.initial_version()
+            versions[pk] = version
+        return versions
+
+    def get_or_fill(self, pks, fill):
+        """
+        Return a dict of pk -> value, calling ``fill(missing_pks)`` once for
+        the misses. Filled values are stored under the versions read before
+        ``fill`` ran, so a concurrent invalidation always wins.
+        """
+        pks = list(pks)
+        if not pks:
+            return dict()
+        versions = self.get_versions(pks)
+        value_keys = {self.value_key(pk, version): pk for pk, version in versions.items()}
+        found = cache.get_many(value_keys.keys())
+        values = {value_keys[key]: value for key, value in found.items()}
+        missing = [pk for pk in pks if pk not in values]
+        if missing:
+            filled = fill(missing)
+            cache.set_many({
+                self.value_key(pk, versions[pk]): filled[pk] for pk in missing if pk in filled
+            }, self.timeout)
+            values.update(filled)
+        return values
+
+    def bump(self, pk):
+        key = self.version_key(pk)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, self.initial_version(), None)
+
+    def invalidate(self, pk):
+        self.bump(pk)
+        transaction.on_commit(lambda: self.bump(pk))
+
+
+user_group_ids_cache = VersionedCache("kehubu.membership.user")
+group_user_ids_cache = VersionedCache("kehubu.membership.group")
+user_card_cache = VersionedCache("kehubu.usercard")
+weixin_app_cache = VersionedCache("kehubu.wechat.app")
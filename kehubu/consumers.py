@@ -1,43 +1,126 @@
-import json
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+import asyncio
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from .models import Group, GroupChat, UserChat, share_group
+from .batching import chat_write_buffer
 
 
-class KehubuConsumer(JsonWebsocketConsumer):
-    def connect(self):
-        self.accept()
+class KehubuConsumer(AsyncJsonWebsocketConsumer):
+    async def connect(self):
         user = self.scope.get('user')
-        async_to_sync(self.channel_layer.group_add)(user.kehubu_profile.channel_name, self.channel_name)
-        member_set = user.user_kehubu_member_set.all()
-        for member in member_set:
-            group_channel_name = member.group.channel_name
-            async_to_sync(self.channel_layer.group_add)(group_channel_name, self.channel_name)
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+        self.subscriptions = await database_sync_to_async(self.get_subscriptions)(user)
+        await asyncio.gather(*[
+            self.channel_layer.group_add(name, self.channel_name) for name in self.subscriptions
+        ])
+        await self.accept()
 
-    def disconnect(self, close_code):
-        user = self.scope.get('user')
-        async_to_sync(self.channel_layer.group_discard)(user.kehubu_profile.channel_name, self.channel_name)
-        member_set = user.user_kehubu_member_set.all()
-        for member in member_set:
-            group_channel_name = member.group.channel_name
-            async_to_sync(self.channel_layer.group_discard)(group_channel_name, self.channel_name)
+    async def disconnect(self, close_code):
+        subscriptions = getattr(self, 'subscriptions', set())
+        await asyncio.gather(*[
+            self.channel_layer.group_discard(name, self.channel_name) for name in subscriptions
+        ])
+
+    def get_subscriptions(self, user):
+        profile = user.kehubu_profile
+        self.group_ids = set(profile.group_ids)
+        subscriptions = {Group.get_channel_name(pk) for pk in self.group_ids}
+        subscriptions.add(profile.channel_name)
+        return subscriptions
+
+    async def receive_json(self, content):
+        receivers = {
+            'groupchat.add': self.receive_groupchat_add,
+            'userchat.add': self.receive_userchat_add,
+        }
+        receiver = receivers.get(content.get('type'))
+        if receiver is None:
+            await self.send_error(content, "Unknown message type.")
+            return
+        await receiver(content)
+
+    async def reply(self, content, **kwargs):
+        """Answer the client message ``content``, echoing its type and optional ``nonce``."""
+        await self.send_json(dict(kwargs, request=content.get('type'), nonce=content.get('nonce')))
+
+    async def send_error(self, content, detail):
+        await self.reply(content, type='error', detail=detail)
+
+    def clean_message(self, content):
+        message = content.get('message')
+        if isinstance(message, str) and message.strip():
+            return message
+
+    async def receive_groupchat_add(self, content):
+        message = self.clean_message(content)
+        if message is None:
+            await self.send_error(content, "This field may not be blank: message.")
+            return
+        group = content.get('group')
+        if group not in self.group_ids:
+            await self.send_error(content, "You are not a member of this group.")
+            return
+        chat = GroupChat(group_id=group, user_id=self.scope['user'].pk, message=message)
+        asyncio.ensure_future(self.write_chat(content, chat))
+
+    async def receive_userchat_add(self, content):
+        message = self.clean_message(content)
+        if message is None:
+            await self.send_error(content, "This field may not be blank: message.")
+            return
+        receiver = content.get('receiver')
+        if not isinstance(receiver, int) or not await database_sync_to_async(share_group)(
+                self.scope['user'].pk, receiver):
+            await self.send_error(content, "You can only chat with users in your groups.")
+            return
+        chat = UserChat(sender_id=self.scope['user'].pk, receiver_id=receiver, message=message)
+        asyncio.ensure_future(self.write_chat(content, chat))
+
+    async def write_chat(self, content, chat):
+        """Queue ``chat`` for the next batched insert and ack it with its id once saved."""
+        try:
+            await chat_write_buffer.add(chat)
+        except Exception:
+            await self.send_error(content, "Failed to save the message.")
+        else:
+            await self.reply(content, type='ack', id=chat.pk)
+
+    async def kehubu_subscription_add(self, content):
+        self.group_ids.add(content['group'])
+        channel = content['channel']
+        if channel not in self.subscriptions:
+            self.subscriptions.add(channel)
+            await self.channel_layer.group_add(channel, self.channel_name)
+
+    async def kehubu_subscription_discard(self, content):
+        self.group_ids.discard(content['group'])
+        channel = content['channel']
+        if channel in self.subscriptions:
+            self.subscriptions.discard(channel)
+            await self.channel_layer.group_discard(channel, self.channel_name)
 
-    def receive_json(self, content):
-        print("receive_json", content)
+    async def forward(self, content):
+        if 'text' in content:
+            await self.send(text_data=content['text'])
+        else:
+            await self.send_json(content)
 
-    def kehubu_member_add(self, content):
-        self.send_json(content)
+    async def kehubu_member_add(self, content):
+        await self.forward(content)
 
-    def kehubu_member_delete(self, content):
-        self.send_json(content)
+    async def kehubu_member_delete(self, content):
+        await self.forward(content)
 
-    def kehubu_groupchat_add(self, content):
-        self.send_json(content)
+    async def kehubu_groupchat_add(self, content):
+        await self.forward(content)
 
-    def kehubu_groupchat_update(self, content):
-        self.send_json(content)
+    async def kehubu_groupchat_update(self, content):
+        await self.forward(content)
 
-    def kehubu_userchat_add(self, content):
-        self.send_json(content)
+    async def kehubu_userchat_add(self, content):
+        await self.forward(content)
 
-    def kehubu_userchat_update(self, content):
-        self.send_json(content)
+    async def kehubu_userchat_update(self, content):
+        await self.forward(content)
@@ -0,0 +1,49 @@
+from django.db import transaction
+from django.db.models import F, Value, Count, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce, Greatest
+
+
+class AtomicSaveMixin(object):
+    """
+    Saves the row and runs its post_save receivers in one transaction, so the
+    counter deltas and outbox messages they write commit or roll back with
+    the row. Deletes need
+    no help: the deletion collector already sends post_delete inside its own.
+    """
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+
+
+def increment(queryset, field, delta=1):
+    """Atomically add ``delta`` to ``field`` on every row of ``queryset``, never below zero."""
+    return queryset.update(**{field: Greatest(F(field) + delta, Value(0))})
+
+
+def count_subquery(queryset, group_field, aggregate=None, outer_field='pk'):
+    """Correlated subquery aggregating ``queryset`` rows whose ``group_field`` is the outer ``outer_field``."""
+    if aggregate is None:
+        aggregate = Count('pk')
+    queryset = queryset.filter(**{group_field: OuterRef(outer_field)}).order_by()
+    queryset = queryset.values(group_field).annotate(value=aggregate).values('value')
+    return Coalesce(Subquery(queryset, output_field=IntegerField()), Value(0))
+
+
+def reconcile(model, field, queryset, group_field, chunk_size=500):
+    """
+    Recount ``model.field`` from ``queryset`` in pk-ordered chunks and fix
+    only the rows that drifted. Returns the number of rows fixed.
+    """
+    actual = count_subquery(queryset, group_field)
+    fixed = 0
+    last_pk = 0
+    while True:
+        chunk = list(model.objects.filter(pk__gt=last_pk).order_by('pk')
+                     .values_list('pk', flat=True)[:chunk_size])
+        if not chunk:
+            return fixed
+        last_pk = chunk[-1]
+        drifted = model.objects.filter(pk__in=chunk).annotate(actual_count=actual)
+        drifted = list(drifted.exclude(**{field: F('actual_count')}).values_list('pk', flat=True))
+        if drifted:
+            fixed += model.objects.filter(pk__in=drifted).update(**{field: actual})
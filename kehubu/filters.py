@@ -0,0 +1,56 @@
+import django_filters
+from rest_framework.filters import OrderingFilter, SearchFilter
+from .models import FeedItem
+from .search import get_search_backend
+
+
+class FeedItemFilter(django_filters.FilterSet):
+    actor_object_id = django_filters.CharFilter(field_name='action__actor_object_id')
+    actor_content_type = django_filters.NumberFilter(field_name='action__actor_content_type')
+    action_object_object_id = django_filters.CharFilter(field_name='action__action_object_object_id')
+    action_object_content_type = django_filters.NumberFilter(field_name='action__action_object_content_type')
+    target_object_id = django_filters.CharFilter(field_name='action__target_object_id')
+    target_content_type = django_filters.NumberFilter(field_name='action__target_content_type')
+
+    class Meta:
+        model = FeedItem
+        fields = []
+
+
+class FeedItemOrderingFilter(OrderingFilter):
+    """
+    OrderingFilter for FeedItem rows that takes the field names of their
+    actions, so ``ordering`` keeps the meaning it had when the activity list
+    was a list of actions.
+    """
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if not ordering:
+            return ordering
+        return [self.get_feed_item_field(term) for term in ordering]
+
+    def get_feed_item_field(self, term):
+        prefix, name = ('-', term[1:]) if term.startswith('-') else ('', term)
+        if name == 'timestamp':
+            return term
+        if name == 'id':
+            return prefix + 'action_id'
+        return prefix + 'action__' + name
+
+
+class IndexedSearchFilter(SearchFilter):
+    """
+    SearchFilter answered from the search index for views that set
+    ``search_kind``. Results come best match first unless the request
+    asks for an explicit ``ordering``.
+    """
+    def filter_queryset(self, request, queryset, view):
+        kind = getattr(view, 'search_kind', None)
+        query = request.query_params.get(self.search_param, '').strip()
+        if kind is None or not query:
+            return super().filter_queryset(request, queryset, view)
+        group_ids = request.user.kehubu_profile.group_ids
+        queryset = get_search_backend().rank(queryset, kind, query, group_ids)
+        if 'ordering' in request.query_params:
+            return queryset
+        return queryset.order_by('-search_score', '-pk')
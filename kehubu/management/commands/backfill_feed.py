@@ -0,0 +1,30 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from actstream.models import Action
+from kehubu.models import Group
+from kehubu.activity import fan_out
+
+
+class Command(BaseCommand):
+    help = "Fan existing group actions out to the FeedItem table of current members"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        group_ct = ContentType.objects.get_for_model(Group)
+        action_set = Action.objects.filter(
+            Q(actor_content_type=group_ct) |
+            Q(target_content_type=group_ct) |
+            Q(action_object_content_type=group_ct)
+        ).order_by('pk')
+        last_pk = 0
+        total = 0
+        while True:
+            chunk = list(action_set.filter(pk__gt=last_pk)[:options['chunk_size']])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            total += fan_out(chunk)
+        self.stdout.write("{} feed items written".format(total))
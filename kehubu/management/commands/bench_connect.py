@@ -0,0 +1,50 @@
+import time
+import statistics
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from kehubu.consumers import KehubuConsumer
+
+
+class Command(BaseCommand):
+    help = "Measure KehubuConsumer connect/disconnect latency against membership size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10,
+                            help="number of users to sample, largest membership first")
+        parser.add_argument('--rounds', type=int, default=5)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        user_set = User.objects.annotate(
+            membership_count=Count('user_kehubu_member_set')
+        ).order_by('-membership_count')[:options['users']]
+
+        self.stdout.write("{:>10} {:>12} {:>12} {:>12}".format(
+            'user', 'memberships', 'connect ms', 'disconnect ms'))
+        for user in user_set:
+            connect, disconnect = [], []
+            for _ in range(options['rounds']):
+                connect_ms, disconnect_ms = async_to_sync(self.measure)(user)
+                connect.append(connect_ms)
+                disconnect.append(disconnect_ms)
+            self.stdout.write("{:>10} {:>12} {:>12.2f} {:>12.2f}".format(
+                user.pk, user.membership_count,
+                statistics.median(connect), statistics.median(disconnect)))
+
+    async def measure(self, user):
+        def application(scope):
+            return KehubuConsumer(dict(scope, user=user))
+
+        communicator = WebsocketCommunicator(application, "/ws/kehubu/")
+        start = time.perf_counter()
+        connected, _ = await communicator.connect()
+        connect_ms = (time.perf_counter() - start) * 1000
+        if not connected:
+            raise RuntimeError("user {} could not connect".format(user.pk))
+        start = time.perf_counter()
+        await communicator.disconnect()
+        disconnect_ms = (time.perf_counter() - start) * 1000
+        return connect_ms, disconnect_ms
@@ -0,0 +1,32 @@
+import time
+import logging
+from django.core.management.base import BaseCommand
+from kehubu import outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Deliver committed OutboxMessage rows to the channel layer. "
+            "Run a single dispatcher so per-channel ordering holds.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=float, default=0.2,
+                            help="seconds to sleep when the outbox is empty")
+        parser.add_argument('--once', action='store_true', help="drain the outbox and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            result = outbox.dispatch(options['batch_size'])
+            if result.sent or result.failed or result.dropped:
+                logger.info("outbox sent=%s failed=%s dropped=%s lag=%.3fs",
+                            result.sent, result.failed, result.dropped,
+                            result.lag.total_seconds())
+            if result.sent < options['batch_size']:
+                if options['once']:
+                    stats = outbox.get_stats()
+                    self.stdout.write("pending={} lag={:.3f}s".format(
+                        stats['pending'], stats['lag'].total_seconds()))
+                    return
+                time.sleep(options['interval'])
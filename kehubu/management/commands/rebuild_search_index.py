@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from forum.models import Topic, Post
+from kehubu.models import GroupChat
+from kehubu.search import get_search_backend, index_queryset
+
+
+class Command(BaseCommand):
+    help = "Rebuild the search index of topics, posts and group chats"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        querysets = [
+            Topic.objects.select_related('category'),
+            Post.objects.select_related('topic__category'),
+            GroupChat.objects.all(),
+        ]
+        for queryset in querysets:
+            model = queryset.model
+            backend.clear(model.search_kind)
+            count = index_queryset(queryset, options['chunk_size'])
+            self.stdout.write("{} {} objects indexed".format(count, model.search_kind))
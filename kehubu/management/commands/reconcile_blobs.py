@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from kehubu.models import GroupAlbumImage
+from kehubu.storage import blob_storage
+from forum.models import Attachment
+
+
+class Command(BaseCommand):
+    help = "Recount blob references, add missing Blob rows and collect unreferenced blobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        references = [
+            (GroupAlbumImage.objects.all(), 'image'),
+            (Attachment.objects.all(), 'file'),
+        ]
+        created, fixed, collected = blob_storage.reconcile(references, options['chunk_size'])
+        self.stdout.write("Blob.refcount: {} created, {} fixed, {} collected".format(created, fixed, collected))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from kehubu.models import Group, Member
+from kehubu.counters import reconcile
+from forum.models import Category, Topic, Post
+
+
+class Command(BaseCommand):
+    help = "Recount denormalized counters and fix the rows that drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        counters = [
+            (Group, 'member_count', Member.objects.all(), 'group'),
+            (Category, 'topic_count', Topic.objects.all(), 'category'),
+            (Category, 'post_count', Post.objects.all(), 'topic__category'),
+            (Topic, 'post_count', Post.objects.all(), 'topic'),
+        ]
+        for model, field, queryset, group_field in counters:
+            fixed = reconcile(model, field, queryset, group_field, options['chunk_size'])
+            self.stdout.write("{}.{}: {} fixed".format(model.__name__, field, fixed))
@@ -0,0 +1,44 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from kehubu.renditions import RENDITIONS, generate_renditions, get_ready_field, mark_renditions_ready
+
+
+class Command(BaseCommand):
+    help = "Generate the image renditions that are not ready yet in parallel worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--field', action='append', dest='fields', choices=sorted(RENDITIONS),
+                            help="only warm this image field, e.g. kehubu.Group.logo (repeatable)")
+        parser.add_argument('--chunk-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        warmed = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            for key in options['fields'] or sorted(RENDITIONS):
+                model_label, field_name = key.rsplit('.', 1)
+                model = apps.get_model(model_label)
+                ready_field = get_ready_field(field_name)
+                row_set = model.objects.filter(**{ready_field: False}).exclude(**{field_name: ''}).order_by('pk')
+                last_pk = 0
+                while True:
+                    chunk = list(row_set.filter(pk__gt=last_pk)
+                                 .values_list('pk', field_name)[:options['chunk_size']])
+                    if not chunk:
+                        break
+                    last_pk = chunk[-1][0]
+                    futures = {executor.submit(generate_renditions, model_label, field_name, name): (pk, name)
+                               for pk, name in chunk}
+                    for future in as_completed(futures):
+                        pk, name = futures[future]
+                        try:
+                            future.result()
+                        except Exception as exc:
+                            failed += 1
+                            self.stderr.write("{} {}: {}".format(model_label, pk, exc))
+                        else:
+                            # per row, so post_save refreshes what it caches
+                            mark_renditions_ready(model_label, pk, field_name, name)
+                            warmed += 1
+        self.stdout.write("{} images warmed, {} failed".format(warmed, failed))
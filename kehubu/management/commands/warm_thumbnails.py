@@ -0,0 +1,42 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management.base import BaseCommand
+from kehubu.models import GroupAlbumImage
+from kehubu.thumbnails import generate_thumbnail
+
+
+class Command(BaseCommand):
+    help = "Generate missing GroupAlbumImage thumbnails in parallel worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--album', type=int, action='append', dest='albums',
+                            help="only warm this album (repeatable)")
+        parser.add_argument('--chunk-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        image_set = GroupAlbumImage.objects.filter(thumb_ready=False).order_by('pk')
+        if options['albums']:
+            image_set = image_set.filter(album__in=options['albums'])
+
+        warmed = failed = 0
+        last_pk = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                chunk = list(image_set.filter(pk__gt=last_pk)
+                             .values_list('pk', 'image')[:options['chunk_size']])
+                if not chunk:
+                    break
+                last_pk = chunk[-1][0]
+                futures = {executor.submit(generate_thumbnail, name): pk for pk, name in chunk}
+                ready = []
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as exc:
+                        failed += 1
+                        self.stderr.write("image {}: {}".format(futures[future], exc))
+                    else:
+                        ready.append(futures[future])
+                GroupAlbumImage.objects.filter(pk__in=ready).update(thumb_ready=True)
+                warmed += len(ready)
+        self.stdout.write("{} thumbnails warmed, {} failed".format(warmed, failed))
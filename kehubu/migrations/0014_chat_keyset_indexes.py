@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0013_userchat'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupchat',
+            index=models.Index(fields=['group', 'created', 'id'], name='kehubu_grou_group_i_447a39_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userchat',
+            index=models.Index(fields=['sender', 'receiver', 'created'], name='kehubu_user_sender__c86f96_idx'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+def backfill_conversations(apps, schema_editor):
+    UserChat = apps.get_model('kehubu', 'UserChat')
+    Conversation = apps.get_model('kehubu', 'Conversation')
+    latest = dict()
+    for chat in UserChat.objects.order_by('created', 'id').iterator():
+        latest[(chat.sender_id, chat.receiver_id)] = chat
+        latest[(chat.receiver_id, chat.sender_id)] = chat
+    Conversation.objects.bulk_create([
+        Conversation(
+            owner_id=owner_id,
+            peer_id=peer_id,
+            last_message=chat,
+            last_message_summary=chat.message[:100],
+            last_activity=chat.created,
+        ) for (owner_id, peer_id), chat in latest.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('kehubu', '0014_chat_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('last_message_summary', models.CharField(blank=True, max_length=100, verbose_name='last message summary')),
+                ('last_activity', models.DateTimeField(verbose_name='last activity')),
+                ('unread_count', models.PositiveIntegerField(default=0, verbose_name='unread count')),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='kehubu.UserChat')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='owner_kehubu_conversation_set', to=settings.AUTH_USER_MODEL)),
+                ('peer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='peer_kehubu_conversation_set', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['owner', '-last_activity'], name='kehubu_conv_owner_i_1083ee_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='conversation',
+            unique_together={('owner', 'peer')},
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:40
+
+from django.db import migrations, models
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0015_conversation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('channel', models.CharField(max_length=100, verbose_name='channel')),
+                ('payload', models.TextField(verbose_name='payload')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='attempts')),
+                ('next_attempt', models.DateTimeField(blank=True, null=True, verbose_name='next attempt')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
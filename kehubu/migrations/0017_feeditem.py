@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:45
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actstream', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('kehubu', '0016_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(verbose_name='timestamp')),
+                ('action', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='actstream.Action')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='kehubu_feeditem_set', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='feeditem',
+            index=models.Index(fields=['user', 'timestamp', 'id'], name='kehubu_feed_user_id_a0dd2c_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='feeditem',
+            unique_together={('user', 'action')},
+        ),
+    ]
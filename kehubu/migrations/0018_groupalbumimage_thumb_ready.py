@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0017_feeditem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupalbumimage',
+            name='thumb_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0018_groupalbumimage_thumb_ready'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='head_image_etag',
+            field=models.CharField(blank=True, editable=False, max_length=128),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='head_image_source',
+            field=models.URLField(blank=True, editable=False, max_length=512),
+        ),
+    ]
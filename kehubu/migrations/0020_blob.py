@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:51
+
+from django.db import migrations, models
+import kehubu.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0019_profile_head_image_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='groupalbumimage',
+            name='image',
+            field=models.ImageField(storage=kehubu.storage.ContentAddressedStorage(), upload_to='uploads/kehubu.GroupAlbumImage.image/%Y/%m/%d/'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0020_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchPosting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('object_id', models.PositiveIntegerField()),
+                ('timestamp', models.DateTimeField()),
+                ('term', models.CharField(max_length=32)),
+                ('weight', models.PositiveIntegerField(default=1)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='kehubu.Group')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchposting',
+            index=models.Index(fields=['kind', 'term', 'group'], name='kehubu_sear_kind_18b3a6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchposting',
+            index=models.Index(fields=['kind', 'object_id'], name='kehubu_sear_kind_9b8f7f_idx'),
+        ),
+    ]
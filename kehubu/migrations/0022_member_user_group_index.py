@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0021_searchposting'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='member',
+            index=models.Index(fields=['user', 'group'], name='kehubu_memb_user_id_9fd450_idx'),
+        ),
+    ]
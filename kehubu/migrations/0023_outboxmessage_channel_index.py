@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0022_member_user_group_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(fields=['channel', 'id'], name='kehubu_outb_channel_d34999_idx'),
+        ),
+    ]
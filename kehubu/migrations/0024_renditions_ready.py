@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0023_outboxmessage_channel_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='cover_renditions_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='logo_renditions_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='head_image_renditions_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kehubu', '0024_renditions_ready'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='blob',
+            name='size',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -1,6 +1,7 @@
 # coding: utf-8
+import json
 from django.db import models
-from django.db.models import Sum, Count, Value
+from django.db.models import Sum, Count, Value, F
 from django.db.models.functions import Coalesce
 from django.urls import reverse
 from django.utils import timezone
@@ -13,20 +14,58 @@ from model_utils.models import TimeStampedModel, TimeFramedModel
 from model_utils import Choices
 from taggit.managers import TaggableManager
 from django.utils import timezone
-from django.core.files.base import ContentFile
-from urllib.parse import urlparse
-import requests
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from django.core.serializers.json import DjangoJSONEncoder
 from imagekit.models import ProcessedImageField
 from imagekit.processors import ResizeToFill
 from model_utils import FieldTracker
 from imagekit.models import ImageSpecField
+from django.utils.functional import cached_property
+from django.db import IntegrityError, transaction, connection
+from .cache import user_group_ids_cache, group_user_ids_cache
+from .counters import AtomicSaveMixin, increment, count_subquery
+from .avatars import schedule_head_image
+from .storage import blob_storage
 
 
-channel_layer = get_channel_layer()
 User = get_user_model()
 
+
+def get_user_group_ids(user_id):
+    """Ids of the groups ``user_id`` is a member of, from the membership cache."""
+    def fill(user_ids):
+        ret = {pk: [] for pk in user_ids}
+        member_set = Member.objects.filter(user__in=user_ids)
+        for member_user_id, group_id in member_set.values_list("user", "group"):
+            ret[member_user_id].append(group_id)
+        return ret
+    return user_group_ids_cache.get_or_fill([user_id], fill)[user_id]
+
+
+def get_group_user_ids(group_ids):
+    """Distinct ids of the users in any of ``group_ids``, from the membership cache."""
+    def fill(missing_group_ids):
+        ret = {pk: [] for pk in missing_group_ids}
+        member_set = Member.objects.filter(group__in=missing_group_ids)
+        for group_id, user_id in member_set.values_list("group", "user"):
+            ret[group_id].append(user_id)
+        return ret
+    user_ids = set()
+    for group_user_ids in group_user_ids_cache.get_or_fill(group_ids, fill).values():
+        user_ids.update(group_user_ids)
+    return list(user_ids)
+
+
+def co_member_user_ids(user_id):
+    """Subquery of the ids of users who share a group with ``user_id``."""
+    user_group_ids = Member.objects.filter(user=user_id).values('group')
+    return Member.objects.filter(group__in=user_group_ids).values('user')
+
+
+def share_group(user_id, other_user_id):
+    """Whether two users are members of a common group, as one EXISTS query."""
+    return co_member_user_ids(user_id).filter(user=other_user_id).exists()
+
+
 class Profile(models.Model):
     GENDER = Choices(('m', 'male', _('male')), ('f', 'female', _('female')), ('u', 'unknown', _('unknown')))
     ID_TYPE = Choices(('IdentityCard', _('Identity Card')), ('Passport', _('Passport')))
@@ -45,6 +84,11 @@ class Profile(models.Model):
     province = models.CharField(_('province'), max_length=32, blank=True)
     city = models.CharField(_('city'), max_length=32, blank=True)
     head_image = models.ImageField(_('head image'), upload_to='uploads/kehubu.Profile.head_image/%Y/%m/%d/', blank=True)
+    head_image_renditions_ready = models.BooleanField(default=False, editable=False)
+    head_image_source = models.URLField(max_length=512, blank=True, editable=False)
+    head_image_etag = models.CharField(max_length=128, blank=True, editable=False)
+
+    tracker = FieldTracker(fields=['head_image'])
 
     def __str__(self):
         return str(self.user)
@@ -68,45 +112,33 @@ class Profile(models.Model):
         self.country = data.get('country', '')
         self.province = data.get('province', '')
         self.city = data.get('city', '')
+        self.save()
         headimgurl = data.get('headimgurl', '')
         if headimgurl:
-            try:
-                response = requests.get(headimgurl, timeout=3)
-            except requests.exceptions.ConnectTimeout:
-                pass
-            else:
-                name = urlparse(headimgurl).path.split('/')[-1]
-                if response.status_code == 200:
-                    self.head_image.save(name, ContentFile(response.content), save=True)
-        self.save()
+            schedule_head_image(self, headimgurl)
 
-    @property
+    @cached_property
     def group_ids(self):
-        user_member_set = self.user.user_kehubu_member_set.all()
-        return list(user_member_set.values_list("group", flat=True))
+        return get_user_group_ids(self.user_id)
 
     @property
     def group_set(self):
         return Group.objects.filter(pk__in=self.group_ids)
 
-    @property
-    def group_user_ids(self):
-        member_set = Member.objects.filter(group__in=self.group_ids)
-        return list(member_set.values_list("user", flat=True))
-
     @property
     def group_users(self):
-        return User.objects.filter(pk__in=self.group_user_ids)
+        return User.objects.filter(pk__in=co_member_user_ids(self.user_id))
+
+    @staticmethod
+    def get_channel_name(pk):
+        return "kehubu.profile.{}".format(pk)
 
     @property
     def channel_name(self):
-        return "kehubu.profile.{}".format(self.pk)
+        return self.get_channel_name(self.pk)
 
     def message_channel(self, message):
-        try:
-            async_to_sync(channel_layer.group_send)(self.channel_name, message)
-        except Exception as exc:
-            print(exc)
+        OutboxMessage.enqueue(self.channel_name, message)
 
 
 class GroupQuerySet(models.QuerySet):
@@ -118,6 +150,14 @@ class GroupQuerySet(models.QuerySet):
         inviter_group_ids = inviter.inviter_kehubu_member_set.values_list("group", flat=True)
         return self.filter(pk__in=inviter_group_ids)
 
+    def with_stats(self):
+        from forum.models import Topic
+        return self.annotate(
+            stats_album_count=count_subquery(GroupAlbum.objects.all(), 'group'),
+            stats_topic_count=count_subquery(Topic.objects.all(), 'category__group'),
+            stats_post_count=count_subquery(Topic.objects.all(), 'category__group', Sum('post_count')),
+        )
+
 
 class Group(TimeStampedModel):
     VISIBLE = Choices(
@@ -144,6 +184,8 @@ class Group(TimeStampedModel):
                                format='PNG',
                                options={'quality': 80},
                                blank=True)
+    logo_renditions_ready = models.BooleanField(default=False, editable=False)
+    cover_renditions_ready = models.BooleanField(default=False, editable=False)
     weighting = models.PositiveSmallIntegerField(_('weighting'), default=0)
     visible = models.PositiveSmallIntegerField(_('visible'), choices=VISIBLE, default=VISIBLE.PUBLIC)
 
@@ -160,13 +202,17 @@ class Group(TimeStampedModel):
     def __str__(self):
         return self.name
 
+    @staticmethod
+    def get_channel_name(pk):
+        return "kehubu.group.{}".format(pk)
+
     @property
     def channel_name(self):
-        return "kehubu.group.{}".format(self.pk)
+        return self.get_channel_name(self.pk)
 
-    def update_member_count(self):
-        self.member_count = self.group_kehubu_member_set.count()
-        self.save(update_fields=['member_count'])
+    def update_member_count(self, delta):
+        increment(Group.objects.filter(pk=self.pk), 'member_count', delta)
+        self.member_count = max(self.member_count + delta, 0)
 
     def add_member(self, user, inviter=None):
         return Member.objects.get_or_create(group=self, user=user, defaults=dict(inviter=inviter))
@@ -175,10 +221,7 @@ class Group(TimeStampedModel):
         return self.add_member(self.creator)
 
     def message_channel(self, message):
-        try:
-            async_to_sync(channel_layer.group_send)(self.channel_name, message)
-        except Exception as exc:
-            print(exc)
+        OutboxMessage.enqueue(self.channel_name, message)
 
     def has_member(self, user):
         return self.group_kehubu_member_set.filter(user=user).exists()
@@ -188,11 +231,15 @@ class Group(TimeStampedModel):
 
     @property
     def album_count(self):
+        if hasattr(self, 'stats_album_count'):
+            return self.stats_album_count
         return self.groupalbum_set.count()
 
     @property
     def forum_stats(self):
         from forum.models import Topic
+        if hasattr(self, 'stats_topic_count'):
+            return dict(post_count=self.stats_post_count, topic_count=self.stats_topic_count)
         category_set = self.forum_category_set.all()
         topic_set = Topic.objects.filter(category__in=category_set)
         ret = topic_set.aggregate(
@@ -247,7 +294,7 @@ class GroupMemberRank(TimeStampedModel):
         return self.name
 
 
-class Member(TimeStampedModel):
+class Member(AtomicSaveMixin, TimeStampedModel):
     group = models.ForeignKey(
         'Group',
         on_delete=models.CASCADE,
@@ -280,6 +327,9 @@ class Member(TimeStampedModel):
 
     class Meta:
         unique_together = ('group', 'user')
+        indexes = [
+            models.Index(fields=['user', 'group']),
+        ]
 
     def __str__(self):
         return '{}:{}'.format(self.group, self.user)
@@ -325,25 +375,65 @@ class GroupAlbum(TimeStampedModel):
     def __str__(self):
         return self.title
 
+    def add_images(self, files):
+        """
+        Store ``files`` one at a time and insert their GroupAlbumImage rows
+        with a single bulk insert, all in one transaction. If anything fails,
+        the rollback drops the blob references taken so far and blobs left
+        without any are deleted.
+        """
+        from .thumbnails import schedule_thumbnail
+        images = []
+        try:
+            with transaction.atomic():
+                for file in files:
+                    image = GroupAlbumImage(album=self)
+                    image.image.save(file.name, file, save=False)
+                    images.append(image)
+                if connection.features.can_return_ids_from_bulk_insert:
+                    GroupAlbumImage.objects.bulk_create(images)
+                    for image in images:
+                        schedule_thumbnail(image)
+                else:
+                    # without returned ids each row is saved and scheduled by post_save
+                    for image in images:
+                        image.save()
+        except Exception:
+            for image in images:
+                blob_storage.discard(image.image.name)
+            raise
+        return images
+
 
 class GroupAlbumImage(TimeStampedModel):
     album = models.ForeignKey(GroupAlbum, on_delete=models.CASCADE)
-    image = models.ImageField(upload_to="uploads/kehubu.GroupAlbumImage.image/%Y/%m/%d/")
+    image = models.ImageField(upload_to="uploads/kehubu.GroupAlbumImage.image/%Y/%m/%d/", storage=blob_storage)
     thumb = ImageSpecField(source='image',
                            processors=[ResizeToFill(300, 300)],
                            format='JPEG',
                            options={'quality': 70},
+                           cachefile_strategy='kehubu.thumbnails.Deferred',
                            )
+    thumb_ready = models.BooleanField(default=False, editable=False)
+
+    tracker = FieldTracker(fields=['image'])
 
     def __str__(self):
         return self.image.name
 
 
-class GroupChat(TimeStampedModel):
+class GroupChat(AtomicSaveMixin, TimeStampedModel):
     group = models.ForeignKey(Group, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     message = models.TextField()
 
+    search_kind = 'groupchat'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'created', 'id']),
+        ]
+
     def __str__(self):
         return self.message_summary
 
@@ -351,17 +441,155 @@ class GroupChat(TimeStampedModel):
     def message_summary(self):
         return self.message[:100]
 
+    def get_search_document(self):
+        return self.group_id, self.created, [(self.message, 1)]
 
-class UserChat(TimeStampedModel):
+
+class UserChat(AtomicSaveMixin, TimeStampedModel):
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
                                related_name='sender_kehubu_userchat_set')
     receiver = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
                                  related_name='receiver_kehubu_userchat_set')
     message = models.TextField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', 'receiver', 'created']),
+        ]
+
     def __str__(self):
         return self.message_summary
 
     @property
     def message_summary(self):
         return self.message[:100]
+
+
+class Conversation(TimeStampedModel):
+    """
+    One row per participant of a user chat, so a user's conversation list is
+    a single index range scan on (owner, last_activity).
+    """
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                              related_name='owner_kehubu_conversation_set')
+    peer = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                             related_name='peer_kehubu_conversation_set')
+    last_message = models.ForeignKey(UserChat, on_delete=models.SET_NULL, null=True, blank=True,
+                                     related_name='+')
+    last_message_summary = models.CharField(_('last message summary'), max_length=100, blank=True)
+    last_activity = models.DateTimeField(_('last activity'))
+    unread_count = models.PositiveIntegerField(_('unread count'), default=0)
+
+    class Meta:
+        unique_together = ('owner', 'peer')
+        indexes = [
+            models.Index(fields=['owner', '-last_activity']),
+        ]
+
+    def __str__(self):
+        return '{}:{}'.format(self.owner, self.peer)
+
+    @classmethod
+    def record_message(cls, userchat):
+        sides = [(userchat.sender_id, userchat.receiver_id, 0)]
+        if userchat.sender_id != userchat.receiver_id:
+            sides.append((userchat.receiver_id, userchat.sender_id, 1))
+        for owner_id, peer_id, unread in sides:
+            values = dict(
+                last_message=userchat,
+                last_message_summary=userchat.message_summary,
+                last_activity=userchat.created,
+            )
+            updated = cls.objects.filter(owner=owner_id, peer=peer_id).update(
+                unread_count=F('unread_count') + unread, **values)
+            if updated:
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(owner_id=owner_id, peer_id=peer_id, unread_count=unread, **values)
+            except IntegrityError:
+                cls.objects.filter(owner=owner_id, peer=peer_id).update(
+                    unread_count=F('unread_count') + unread, **values)
+
+    def mark_read(self):
+        self.unread_count = 0
+        Conversation.objects.filter(pk=self.pk).update(unread_count=0)
+
+
+class OutboxMessage(TimeStampedModel):
+    """
+    Channel-layer message written in the sender's transaction and delivered
+    by the dispatch_outbox command once committed, in pk order per channel.
+    """
+    channel = models.CharField(_('channel'), max_length=100)
+    payload = models.TextField(_('payload'))
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    next_attempt = models.DateTimeField(_('next attempt'), null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['channel', 'id']),
+        ]
+
+    def __str__(self):
+        return self.channel
+
+    @classmethod
+    def enqueue(cls, channel, message):
+        return cls.objects.create(channel=channel, payload=json.dumps(message, cls=DjangoJSONEncoder))
+
+    @classmethod
+    def enqueue_text(cls, channels, message_type, text):
+        """Enqueue a client event already encoded as JSON text, sharing one payload across channels."""
+        payload = json.dumps(dict(type=message_type, text=text))
+        return cls.objects.bulk_create([cls(channel=channel, payload=payload) for channel in channels])
+
+    @property
+    def message(self):
+        return json.loads(self.payload)
+
+
+class FeedItem(models.Model):
+    """An action fanned out to one user's activity feed when it was sent."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                             related_name='kehubu_feeditem_set')
+    action = models.ForeignKey('actstream.Action', on_delete=models.CASCADE, related_name='+')
+    timestamp = models.DateTimeField(_('timestamp'))
+
+    class Meta:
+        unique_together = ('user', 'action')
+        indexes = [
+            models.Index(fields=['user', 'timestamp', 'id']),
+        ]
+
+    def __str__(self):
+        return '{}:{}'.format(self.user_id, self.action_id)
+
+
+class Blob(models.Model):
+    """A content-addressed file in ``blob_storage`` and the number of rows referring to it."""
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    refcount = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+
+class SearchPosting(models.Model):
+    """One term of one indexed object, denormalized so lookups never join."""
+    kind = models.CharField(max_length=16)
+    object_id = models.PositiveIntegerField()
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='+')
+    timestamp = models.DateTimeField()
+    term = models.CharField(max_length=32)
+    weight = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'term', 'group']),
+            models.Index(fields=['kind', 'object_id']),
+        ]
+
+    def __str__(self):
+        return '{}:{}:{}'.format(self.kind, self.object_id, self.term)
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db.models import F, Q, Min, Exists, OuterRef
+from django.utils import timezone
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 10
+MAX_BACKOFF = 60
+
+DispatchResult = namedtuple('DispatchResult', ['sent', 'failed', 'dropped', 'lag'])
+
+
+def get_backoff(attempts):
+    return timedelta(seconds=min(2 ** attempts, MAX_BACKOFF))
+
+
+def get_batch(batch_size, now):
+    """
+    The oldest ``batch_size`` messages that are due. A channel whose oldest
+    message is backing off is skipped entirely, so its later messages never
+    overtake it and its failures never crowd other channels out of the batch.
+    """
+    backing_off = OutboxMessage.objects.filter(
+        channel=OuterRef('channel'), pk__lt=OuterRef('pk'), next_attempt__gt=now)
+    message_set = (OutboxMessage.objects
+                   .filter(Q(next_attempt__isnull=True) | Q(next_attempt__lte=now))
+                   .annotate(blocked=Exists(backing_off))
+                   .filter(blocked=False))
+    return list(message_set.order_by('pk')[:batch_size])
+
+
+async def send_channel(channel_layer, messages):
+    """
+    Send one channel's messages in pk order, stopping at the first failure
+    so later messages never overtake it.
+    """
+    sent = []
+    for message in messages:
+        try:
+            await channel_layer.group_send(message.channel, message.message)
+        except Exception:
+            logger.exception("outbox message %s to %s failed", message.pk, message.channel)
+            return sent, message
+        sent.append(message)
+    return sent, None
+
+
+async def send_batch(channel_layer, by_channel):
+    return await asyncio.gather(*[
+        send_channel(channel_layer, messages) for messages in by_channel.values()
+    ])
+
+
+def dispatch(batch_size=100, channel_layer=None):
+    """Deliver one batch of committed outbox messages and return a DispatchResult."""
+    if channel_layer is None:
+        channel_layer = get_channel_layer()
+    now = timezone.now()
+    by_channel = OrderedDict()
+    for message in get_batch(batch_size, now):
+        by_channel.setdefault(message.channel, []).append(message)
+
+    sent, failed, dropped = [], [], []
+    for channel_sent, channel_failed in async_to_sync(send_batch)(channel_layer, by_channel):
+        sent.extend(channel_sent)
+        if channel_failed is None:
+            continue
+        if channel_failed.attempts + 1 >= MAX_ATTEMPTS:
+            logger.error("dropping outbox message %s to %s after %s attempts",
+                         channel_failed.pk, channel_failed.channel, MAX_ATTEMPTS)
+            dropped.append(channel_failed)
+        else:
+            failed.append(channel_failed)
+
+    OutboxMessage.objects.filter(pk__in=[m.pk for m in sent + dropped]).delete()
+    for message in failed:
+        OutboxMessage.objects.filter(pk=message.pk).update(
+            attempts=F('attempts') + 1,
+            next_attempt=now + get_backoff(message.attempts + 1),
+        )
+
+    lag = max([now - m.created for m in sent], default=timedelta(0))
+    return DispatchResult(len(sent), len(failed), len(dropped), lag)
+
+
+def get_stats():
+    """Pending message count and age of the oldest pending message."""
+    stats = OutboxMessage.objects.aggregate(oldest=Min('created'))
+    oldest = stats['oldest']
+    return dict(
+        pending=OutboxMessage.objects.count(),
+        lag=timezone.now() - oldest if oldest else timedelta(0),
+    )
@@ -1,28 +1,125 @@
 from rest_framework import pagination
 from rest_framework.response import Response
+from rest_framework.exceptions import ParseError
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy as _
 from collections import OrderedDict
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import binascii
+import hashlib
 import urllib.parse as urlparse
+from .activity import prefetch_action_objects
+from .models import FeedItem
 
 
 class LimitOffsetPagination(pagination.LimitOffsetPagination):
-    def get_query(self, link):
-        tokens = urlparse.urlparse(link)
-        query_params = urlparse.parse_qs(tokens.query)
-        if not query_params:
+    """
+    LimitOffsetPagination whose ``count`` query param chooses how the total is
+    found: ``exact`` (the default) runs COUNT(*), ``estimate`` returns a
+    briefly cached count (the planner's estimate for large PostgreSQL
+    results) and ``none`` skips it. Both of the latter detect the next page
+    by fetching one extra row.
+    """
+    count_query_param = 'count'
+    count_modes = ('exact', 'estimate', 'none')
+    estimate_cache_timeout = 60
+    estimate_threshold = 10000
+
+    def get_count_mode(self, request):
+        mode = request.query_params.get(self.count_query_param)
+        return mode if mode in self.count_modes else 'exact'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_mode = self.get_count_mode(request)
+        if self.count_mode == 'exact':
+            return super().paginate_queryset(queryset, request, view)
+
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+        self.request = request
+        rows = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        self.count = self.get_estimated_count(queryset) if self.count_mode == 'estimate' else None
+        return rows[:self.limit]
+
+    def get_estimated_count(self, queryset):
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        key = 'kehubu.pagination.count.{}'.format(
+            hashlib.md5(repr((queryset.db, sql, params)).encode()).hexdigest())
+        count = cache.get(key)
+        if count is None:
+            connection = connections[queryset.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                    estimate = cursor.fetchone()[0][0]['Plan']['Plan Rows']
+                if estimate >= self.estimate_threshold:
+                    count = int(estimate)
+            if count is None:
+                count = queryset.count()
+            cache.set(key, count, self.estimate_cache_timeout)
+        return count
+
+    def get_next_offset(self):
+        if self.count_mode == 'exact':
+            if self.offset + self.limit >= self.count:
+                return None
+        elif not self.has_next:
             return None
+        return self.offset + self.limit
 
+    def get_previous_offset(self):
+        if self.offset <= 0:
+            return None
+        return max(self.offset - self.limit, 0)
+
+    def get_link(self, offset):
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        if offset <= 0:
+            return remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.offset_query_param, offset)
+
+    def get_query(self, offset):
+        """The query params of ``get_link(offset)`` as a dict, first value per key."""
         params = dict()
-        for k, v in query_params.items():
-            params[k] = v[0]
+        for key, values in self.request.query_params.lists():
+            values = [v for v in values if v]
+            if values:
+                params[key] = values[0]
+        params[self.limit_query_param] = str(self.limit)
+        if offset <= 0:
+            params.pop(self.offset_query_param, None)
+        else:
+            params[self.offset_query_param] = str(offset)
         return params
 
+    def get_next_link(self):
+        offset = self.get_next_offset()
+        return None if offset is None else self.get_link(offset)
+
+    def get_previous_link(self):
+        offset = self.get_previous_offset()
+        return None if offset is None else self.get_link(offset)
+
     def get_next_query(self):
-        next_link = self.get_next_link()
-        return self.get_query(next_link)
+        offset = self.get_next_offset()
+        return None if offset is None else self.get_query(offset)
 
     def get_previous_query(self):
-        link = self.get_previous_link()
-        return self.get_query(link)
+        offset = self.get_previous_offset()
+        return None if offset is None else self.get_query(offset)
 
     def get_paginated_response(self, data):
         return Response(OrderedDict([
@@ -33,3 +130,147 @@ class LimitOffsetPagination(pagination.LimitOffsetPagination):
             ('previous_query', self.get_previous_query()),
             ('results', data)
         ]))
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    Newest-first pagination keyed on (``timestamp_field``, id).
+
+    ``before=<token>`` pages back into older rows and ``after=<token>`` pages
+    forward into newer ones, so every page is a bounded index range scan
+    with no OFFSET and no COUNT(*).
+    """
+    default_limit = api_settings.PAGE_SIZE
+    max_limit = 100
+    timestamp_field = 'created'
+    limit_query_param = 'limit'
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_token_message = _('Invalid cursor')
+
+    def encode_token(self, obj):
+        value = "{}|{}".format(getattr(obj, self.timestamp_field).isoformat(), obj.pk)
+        return urlsafe_b64encode(value.encode('ascii')).decode('ascii')
+
+    def decode_token(self, token):
+        try:
+            timestamp, pk = urlsafe_b64decode(token.encode('ascii')).decode('ascii').split('|')
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise ParseError(self.invalid_token_message)
+        if timestamp is None:
+            raise ParseError(self.invalid_token_message)
+        return timestamp, pk
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.default_limit
+        if limit <= 0:
+            return self.default_limit
+        return min(limit, self.max_limit)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+        field = self.timestamp_field
+
+        if after:
+            timestamp, pk = self.decode_token(after)
+            queryset = queryset.filter(
+                Q(**{field + '__gt': timestamp}) | Q(**{field: timestamp, 'pk__gt': pk}))
+            rows = list(queryset.order_by(field, 'pk')[:self.limit + 1])
+            self.has_newer = len(rows) > self.limit
+            self.has_older = True
+            rows = rows[:self.limit][::-1]
+        else:
+            if before:
+                timestamp, pk = self.decode_token(before)
+                queryset = queryset.filter(
+                    Q(**{field + '__lt': timestamp}) | Q(**{field: timestamp, 'pk__lt': pk}))
+            rows = list(queryset.order_by('-' + field, '-pk')[:self.limit + 1])
+            self.has_older = len(rows) > self.limit
+            self.has_newer = bool(before)
+            rows = rows[:self.limit]
+
+        self.page = rows
+        return rows
+
+    def get_query(self, param, obj):
+        params = {k: v for k, v in self.request.query_params.items()
+                  if k not in (self.before_query_param, self.after_query_param)}
+        params[param] = self.encode_token(obj)
+        return params
+
+    def get_link(self, query):
+        if query is None:
+            return None
+        url = self.request.build_absolute_uri(self.request.path)
+        return "{}?{}".format(url, urlparse.urlencode(query))
+
+    def get_next_query(self):
+        if not self.has_older or not self.page:
+            return None
+        return self.get_query(self.before_query_param, self.page[-1])
+
+    def get_previous_query(self):
+        if not self.has_newer or not self.page:
+            return None
+        return self.get_query(self.after_query_param, self.page[0])
+
+    def get_paginated_response(self, data):
+        next_query = self.get_next_query()
+        previous_query = self.get_previous_query()
+        return Response(OrderedDict([
+            ('next', self.get_link(next_query)),
+            ('next_query', next_query),
+            ('previous', self.get_link(previous_query)),
+            ('previous_query', previous_query),
+            ('results', data)
+        ]))
+
+
+class FeedKeysetPagination(KeysetPagination):
+    timestamp_field = 'timestamp'
+
+
+class ActionPagination(LimitOffsetPagination):
+    """
+    Resolves the generic objects of each page of actions in bulk. A page of
+    FeedItem rows is returned as their actions.
+
+    Feeds page by limit/offset unless ``before`` or ``after`` is given
+    (empty for the newest page): those page by keyset on the feed's
+    (timestamp, id) index, newest first whatever the ``ordering``.
+    """
+    keyset_class = FeedKeysetPagination
+
+    def use_keyset(self, request):
+        params = request.query_params
+        return (self.keyset_class.before_query_param in params
+                or self.keyset_class.after_query_param in params)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        is_feed = queryset.model is FeedItem
+        if is_feed:
+            queryset = queryset.select_related('action')
+        self.keyset = None
+        if is_feed and self.use_keyset(request):
+            self.keyset = self.keyset_class()
+            page = self.keyset.paginate_queryset(queryset, request, view)
+        else:
+            page = super().paginate_queryset(queryset, request, view)
+        if page is None:
+            return None
+        if is_feed:
+            page = [item.action for item in page]
+        return prefetch_action_objects(page)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
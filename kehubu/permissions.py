@@ -1,4 +1,52 @@
+from django.utils.functional import cached_property
 from rest_framework import permissions
+from .models import get_user_group_ids
+
+
+class RoleResolver(object):
+    """
+    The caller's group roles, loaded at most once per request. Object checks
+    compare ``*_id`` columns so related rows are never fetched.
+    """
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def created_group_ids(self):
+        if not self.user.is_authenticated:
+            return frozenset()
+        return frozenset(self.user.creator_kehubu_group_set.values_list('pk', flat=True))
+
+    @cached_property
+    def member_group_ids(self):
+        if not self.user.is_authenticated:
+            return frozenset()
+        return frozenset(get_user_group_ids(self.user.pk))
+
+    def _contains(self, group_ids, group_id):
+        try:
+            return int(group_id) in group_ids
+        except (TypeError, ValueError):
+            return False
+
+    def is_creator(self, group_id):
+        return self._contains(self.created_group_ids, group_id)
+
+    def is_member(self, group_id):
+        return self._contains(self.member_group_ids, group_id)
+
+    def is_owner(self, obj, field_name):
+        if not self.user.is_authenticated:
+            return False
+        return getattr(obj, obj._meta.get_field(field_name).attname) == self.user.pk
+
+
+def get_roles(request):
+    """The RoleResolver of ``request``'s user, shared by every check of the request."""
+    roles = getattr(request, '_kehubu_roles', None)
+    if roles is None or roles.user is not request.user:
+        roles = request._kehubu_roles = RoleResolver(request.user)
+    return roles
 
 
 class ReadOnly(permissions.BasePermission):
@@ -13,18 +61,15 @@ class IsOwner(permissions.BasePermission):
         return bool(request.user and request.user.is_authenticated)
 
     def has_object_permission(self, request, view, obj):
-        if hasattr(view, "owner_field"):
-            owner = getattr(obj, view.owner_field)
-        else:
-            owner = getattr(obj, self.owner_field)
-        return owner == request.user
+        owner_field = getattr(view, "owner_field", self.owner_field)
+        return get_roles(request).is_owner(obj, owner_field)
 
 class IsGroupCreator(permissions.BasePermission):
     def has_permission(self, request, view):
         return bool(request.user and request.user.is_authenticated)
 
     def has_object_permission(self, request, view, obj):
-        return request.user == obj.group.creator
+        return get_roles(request).is_creator(obj.group_id)
 
 
 class IsOwnerOrReadOnly(permissions.BasePermission):
@@ -40,11 +85,8 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        if hasattr(view, "owner_field"):
-            owner = getattr(obj, view.owner_field)
-        else:
-            owner = getattr(obj, self.owner_field)
-        return owner == request.user
+        owner_field = getattr(view, "owner_field", self.owner_field)
+        return get_roles(request).is_owner(obj, owner_field)
 
 
 class IsGroupCreatorOrReadOnly(permissions.BasePermission):
@@ -56,17 +98,14 @@ class IsGroupCreatorOrReadOnly(permissions.BasePermission):
             return False
 
         if request.method == 'POST':
-            group = request.data.get('group')
-            if not request.user.creator_kehubu_group_set.filter(pk=group).exists():
-                return False
-            return True
+            return get_roles(request).is_creator(request.data.get('group'))
         return True
 
     def has_object_permission(self, request, view, obj):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        return request.user == obj.group.creator
+        return get_roles(request).is_creator(obj.group_id)
 
 
 class IsGroupAlbumCreatorOrReadOnly(permissions.BasePermission):
@@ -79,4 +118,4 @@ class IsGroupAlbumCreatorOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        return request.user == obj.album.group.creator
+        return get_roles(request).is_creator(obj.album.group_id)
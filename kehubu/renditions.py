@@ -0,0 +1,140 @@
+import logging
+from django.apps import apps
+from django.db import close_old_connections, transaction
+from imagekit import ImageSpec, register
+from imagekit.cachefiles import ImageCacheFile
+from imagekit.processors import ResizeToFill, ResizeToFit
+from rest_framework import serializers
+from .thumbnails import get_executor
+
+logger = logging.getLogger(__name__)
+
+# (width, height) per image field; a height of None keeps the aspect ratio
+RENDITIONS = {
+    'kehubu.Group.logo': [(96, 96), (192, 192)],
+    'kehubu.Group.cover': [(480, None), (960, None), (1440, None)],
+    'kehubu.Profile.head_image': [(64, 64), (132, 132), (256, 256)],
+    'forum.Category.icon': [(64, 64), (128, 128)],
+}
+
+# format name -> imagekit format; None keeps the source format
+FORMATS = {
+    'default': None,
+    'webp': 'WEBP',
+}
+
+
+def make_spec(width, height, format):
+    if height is None:
+        processors = [ResizeToFit(width=width, upscale=False)]
+    else:
+        processors = [ResizeToFill(width, height)]
+    # imagekit only runs the strategy of registered generators; Deferred keeps
+    # url free of storage IO and renders inline only when content is read
+    spec = type('RenditionSpec', (ImageSpec, ), dict(
+        processors=processors, format=format, options={'quality': 80},
+        cachefile_strategy='kehubu.thumbnails.Deferred'))
+    register.generator('kehubu:rendition:{}x{}:{}'.format(width, height or '', format or 'source'), spec)
+    return spec
+
+
+_specs = {
+    key: make_spec(*key)
+    for key in {(width, height, format)
+                for sizes in RENDITIONS.values() for width, height in sizes for format in FORMATS.values()}
+}
+
+
+def get_spec(width, height, format):
+    return _specs[(width, height, format)]
+
+
+def get_rendition_files(fieldfile):
+    """Yield ``(format name, width, ImageCacheFile)`` for every rendition of ``fieldfile``."""
+    key = '{}.{}'.format(fieldfile.instance._meta.label, fieldfile.field.name)
+    for width, height in RENDITIONS.get(key, []):
+        for name, format in FORMATS.items():
+            spec = get_spec(width, height, format)
+            yield name, width, ImageCacheFile(spec(source=fieldfile))
+
+
+def get_ready_field(field_name):
+    """Name of the BooleanField flagging that ``field_name``'s renditions exist."""
+    return '{}_renditions_ready'.format(field_name)
+
+
+def get_renditions(fieldfile, request=None):
+    """
+    srcset-style map of ``fieldfile``'s renditions, e.g.
+    ``{'default': {'96w': url, ...}, 'webp': {'96w': url, ...}}``, or None
+    until the pool has rendered them.
+    """
+    if not fieldfile or not getattr(fieldfile.instance, get_ready_field(fieldfile.field.name)):
+        return None
+    ret = {name: dict() for name in FORMATS}
+    for name, width, file in get_rendition_files(fieldfile):
+        url = file.url
+        if request is not None:
+            url = request.build_absolute_uri(url)
+        ret[name]['{}w'.format(width)] = url
+    return ret
+
+
+def generate_renditions(model_label, field_name, file_name):
+    """Render every rendition of a stored image. Runs in a pool process; storage only."""
+    model = apps.get_model(model_label)
+    fieldfile = getattr(model(**{field_name: file_name}), field_name)
+    for name, width, file in get_rendition_files(fieldfile):
+        file.generate()
+    return file_name
+
+
+def mark_renditions_ready(model_label, pk, field_name, file_name):
+    """
+    Flag the renditions ready unless the row moved on to another image. Saves
+    the row so its post_save receivers refresh what they cache.
+    """
+    model = apps.get_model(model_label)
+    ready_field = get_ready_field(field_name)
+    close_old_connections()
+    try:
+        with transaction.atomic():
+            instance = model.objects.select_for_update().filter(pk=pk, **{field_name: file_name}).first()
+            if instance is not None:
+                setattr(instance, ready_field, True)
+                instance.save(update_fields=[ready_field])
+    finally:
+        close_old_connections()
+
+
+def submit_renditions(model_label, pk, field_name, file_name):
+    def done(future):
+        try:
+            future.result()
+        except Exception:
+            logger.exception("rendition generation failed for %s", file_name)
+        else:
+            mark_renditions_ready(model_label, pk, field_name, file_name)
+
+    get_executor().submit(generate_renditions, model_label, field_name, file_name).add_done_callback(done)
+
+
+def reset_renditions(instance, field_name):
+    """Flag the renditions of a changed image stale. Call from pre_save."""
+    if instance.tracker.has_changed(field_name):
+        setattr(instance, get_ready_field(field_name), False)
+
+
+def schedule_renditions(instance, field_name):
+    """Render ``instance.<field_name>``'s renditions in the pool after commit unless they are ready."""
+    fieldfile = getattr(instance, field_name)
+    if not fieldfile or getattr(instance, get_ready_field(field_name)):
+        return
+    args = (instance._meta.label, instance.pk, field_name, fieldfile.name)
+    transaction.on_commit(lambda: submit_renditions(*args))
+
+
+class RenditionsField(serializers.ReadOnlyField):
+    """Read-only srcset-style map of the renditions of the image field named by ``source``."""
+    def to_representation(self, value):
+        return get_renditions(value, self.context.get('request'))
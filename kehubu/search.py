@@ -0,0 +1,148 @@
+import math
+import re
+from collections import Counter
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (
+    Case, When, Value, F, Sum, Count, FloatField, ExpressionWrapper,
+    OuterRef, Subquery,
+)
+from django.utils.module_loading import import_string
+
+TOKEN_RE = re.compile(r'[\u3400-\u9fff]+|[^\W_\u3400-\u9fff]+')
+CJK_RE = re.compile(r'[\u3400-\u9fff]')
+MAX_TERM_LENGTH = 32
+MAX_QUERY_TERMS = 8
+
+
+def tokenize(text, query=False):
+    """
+    Lower-cased words for latin text; unigrams and bigrams for CJK runs,
+    which have no word breaks. Queries use only the bigrams of CJK runs
+    longer than one character.
+    """
+    for match in TOKEN_RE.finditer(text.lower()):
+        word = match.group()
+        if not CJK_RE.match(word):
+            yield word[:MAX_TERM_LENGTH]
+            continue
+        if len(word) == 1 or not query:
+            for char in word:
+                yield char
+        for i in range(len(word) - 1):
+            yield word[i:i + 2]
+
+
+class DatabaseSearchBackend(object):
+    """
+    Inverted index in the ``kehubu.SearchPosting`` table. Works on every
+    database Django supports; ranking is tf-idf over the matched terms.
+    """
+    def get_model(self):
+        from .models import SearchPosting
+        return SearchPosting
+
+    def index(self, objs):
+        """
+        (Re)index model instances that define ``search_kind`` and
+        ``get_search_document()``, with one delete and one insert per kind.
+        """
+        model = self.get_model()
+        by_kind = dict()
+        for obj in objs:
+            by_kind.setdefault(obj.search_kind, []).append(obj)
+        for kind, kind_objs in by_kind.items():
+            postings = []
+            for obj in kind_objs:
+                group_id, timestamp, fields = obj.get_search_document()
+                weights = Counter()
+                for text, weight in fields:
+                    for term in tokenize(text or ''):
+                        weights[term] += weight
+                postings.extend(
+                    model(kind=kind, object_id=obj.pk, group_id=group_id,
+                          timestamp=timestamp, term=term, weight=weight)
+                    for term, weight in weights.items()
+                )
+            model.objects.filter(kind=kind, object_id__in=[obj.pk for obj in kind_objs]).delete()
+            model.objects.bulk_create(postings)
+
+    def remove(self, kind, object_id):
+        self.get_model().objects.filter(kind=kind, object_id=object_id).delete()
+
+    def clear(self, kind):
+        self.get_model().objects.filter(kind=kind).delete()
+
+    def matches(self, kind, query, group_ids=None):
+        """
+        Values queryset of ``{'object_id', 'score'}`` for the ``kind`` objects
+        matching every term of ``query``, or None when nothing can match.
+        """
+        terms = list(dict.fromkeys(tokenize(query, query=True)))[:MAX_QUERY_TERMS]
+        if not terms:
+            return None
+        posting_set = self.get_model().objects.filter(kind=kind, term__in=terms)
+        if group_ids is not None:
+            posting_set = posting_set.filter(group__in=group_ids)
+
+        frequencies = dict(posting_set.values_list('term').annotate(Count('id')).order_by())
+        if len(frequencies) < len(terms):
+            return None
+        # idf relative to the most common query term, which needs no document count
+        max_count = max(frequencies.values())
+        score = Sum(Case(
+            *[When(term=term, then=ExpressionWrapper(
+                F('weight') * Value(math.log(1 + max_count / count)), output_field=FloatField()))
+              for term, count in frequencies.items()],
+            output_field=FloatField()))
+        return (posting_set.values('object_id')
+                .annotate(matched=Count('id'), score=score)
+                .filter(matched=len(terms)))
+
+    def search(self, kind, query, group_ids=None, limit=None):
+        """Ids of ``kind`` objects matching every term of ``query``, best first."""
+        rows = self.matches(kind, query, group_ids)
+        if rows is None:
+            return []
+        rows = rows.order_by('-score', '-timestamp')
+        if limit is not None:
+            rows = rows[:limit]
+        return [row['object_id'] for row in rows]
+
+    def rank(self, queryset, kind, query, group_ids=None):
+        """
+        Filter ``queryset`` to every match of ``query``, annotated with its
+        ``search_score``, so the database does the ranking and paging.
+        """
+        rows = self.matches(kind, query, group_ids)
+        if rows is None:
+            return queryset.none()
+        score = Subquery(rows.filter(object_id=OuterRef('pk')).values('score'), output_field=FloatField())
+        return queryset.annotate(search_score=score).filter(search_score__isnull=False)
+
+
+_backend = None
+
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'KEHUBU_SEARCH_BACKEND', 'kehubu.search.DatabaseSearchBackend')
+        _backend = import_string(path)()
+    return _backend
+
+
+def index_queryset(queryset, chunk_size=500):
+    """(Re)index ``queryset`` in pk order, ``chunk_size`` rows at a time. Returns the row count."""
+    backend = get_search_backend()
+    count = 0
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not chunk:
+            return count
+        last_pk = chunk[-1].pk
+        with transaction.atomic():
+            backend.index(chunk)
+        count += len(chunk)
+
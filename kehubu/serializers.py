@@ -1,8 +1,9 @@
+import json
 import time
 from django.utils.crypto import get_random_string
 from .models import (
     Group, Profile, Member, GroupMemberRank, GroupInvitation, GroupAlbum,
-    GroupAlbumImage, GroupChat, UserChat,
+    GroupAlbumImage, GroupChat, UserChat, Conversation,
 )
 from django.contrib.auth.models import User
 from rest_framework import serializers
@@ -10,6 +11,10 @@ from django.utils.translation import gettext_lazy as _
 from actstream.models import Action
 from drf_extra_fields.fields import Base64ImageField
 from .utils import get_wechat_client
+from .cache import user_card_cache
+from .renditions import RenditionsField
+from .permissions import get_roles
+from django.core.serializers.json import DjangoJSONEncoder
 
 
 class ActionSerializer(serializers.ModelSerializer):
@@ -53,6 +58,8 @@ class ActionSerializer(serializers.ModelSerializer):
 
 
 class ProfileOnlySerializer(serializers.ModelSerializer):
+    head_image_renditions = RenditionsField(source='head_image')
+
     class Meta:
         model = Profile
         fields = "__all__"
@@ -74,15 +81,134 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ('id', 'username', 'full_name', 'first_name', 'last_name', 'email', 'is_active', 'date_joined', 'kehubu_profile')
 
 
+def get_user_cards(user_ids):
+    """UserSerializer representations keyed by user id, served from the user card cache."""
+    def fill(missing):
+        user_set = User.objects.select_related('kehubu_profile').filter(pk__in=missing)
+        return {user.pk: dict(UserSerializer(user).data) for user in user_set}
+    return user_card_cache.get_or_fill(set(user_ids), fill)
+
+
+def absolutize_card(card, request):
+    """Copy of ``card`` with its media URLs made absolute for ``request``."""
+    profile = card.get('kehubu_profile')
+    if request is None or not profile:
+        return card
+    profile = dict(profile)
+    if profile.get('head_image'):
+        profile['head_image'] = request.build_absolute_uri(profile['head_image'])
+    renditions = profile.get('head_image_renditions')
+    if renditions:
+        profile['head_image_renditions'] = {
+            name: {width: request.build_absolute_uri(url) for width, url in urls.items()}
+            for name, urls in renditions.items()
+        }
+    return dict(card, kehubu_profile=profile)
+
+
+def get_user_card(context, user_id):
+    """
+    The card of ``user_id`` from the cards a UserCardListSerializer prefetched
+    into ``context``, fetching it alone when rendering outside such a list.
+    """
+    if user_id is None:
+        return None
+    cards = context.setdefault('user_cards', dict())
+    if user_id not in cards:
+        cards.update(get_user_cards([user_id]))
+    card = cards.get(user_id)
+    if card is None:
+        return None
+    return absolutize_card(card, context.get('request'))
+
+
+class UserCardField(serializers.ReadOnlyField):
+    """
+    Read-only cached UserSerializer representation of the user foreign key
+    named by ``source``; only the ``*_id`` column is read from the instance.
+    """
+    def get_attribute(self, instance):
+        return getattr(instance, instance._meta.get_field(self.source).attname)
+
+    def to_representation(self, value):
+        return get_user_card(self.context, value)
+
+
+def collect_user_ids(serializer, instance, user_ids):
+    """
+    Add the ids of every user card ``serializer`` will render for ``instance``
+    to ``user_ids``: its UserCardFields, its ``user_card_sources`` and those of
+    nested serializers.
+    """
+    for source in getattr(serializer, 'user_card_sources', ()):
+        user_ids.add(getattr(instance, instance._meta.get_field(source).attname))
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if isinstance(field, UserCardField):
+            user_ids.add(field.get_attribute(instance))
+        elif isinstance(field, serializers.BaseSerializer) and has_user_cards(field):
+            value = field.get_attribute(instance)
+            if value is None:
+                continue
+            if isinstance(field, serializers.ListSerializer):
+                for item in (value.all() if hasattr(value, 'all') else value):
+                    collect_user_ids(field.child, item, user_ids)
+            else:
+                collect_user_ids(field, value, user_ids)
+
+
+def has_user_cards(serializer):
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    if getattr(serializer, 'user_card_sources', ()):
+        return True
+    return any(
+        isinstance(field, UserCardField) or
+        (isinstance(field, serializers.BaseSerializer) and has_user_cards(field))
+        for field in serializer.fields.values() if not field.write_only
+    )
+
+
+class UserCardListSerializer(serializers.ListSerializer):
+    """ListSerializer that loads every user card of the page with one cache multi-get."""
+    def to_representation(self, data):
+        items = data.all() if hasattr(data, 'all') else data
+        items = list(items)
+        user_ids = set()
+        for item in items:
+            collect_user_ids(self.child, item, user_ids)
+        user_ids.discard(None)
+        cards = self.context.setdefault('user_cards', dict())
+        missing = user_ids.difference(cards)
+        if missing:
+            cards.update(get_user_cards(missing))
+        return super().to_representation(items)
+
+
+def encode_event(message_type, key, data):
+    """
+    Encode ``data`` once and wrap it as a ``{"type": ..., key: data}`` client
+    event. Returns both texts so the event can be fanned out and the bare
+    data reused as a response body without encoding it again.
+    """
+    data_json = json.dumps(data, cls=DjangoJSONEncoder)
+    event_json = '{{"type": {}, {}: {}}}'.format(json.dumps(message_type), json.dumps(key), data_json)
+    return data_json, event_json
+
+
 class GroupSerializer(serializers.ModelSerializer):
-    creator = UserSerializer(read_only=True)
+    creator = UserCardField()
     album_count = serializers.ReadOnlyField()
     forum_stats = serializers.ReadOnlyField()
+    logo_renditions = RenditionsField(source='logo')
+    cover_renditions = RenditionsField(source='cover')
 
     class Meta:
         model = Group
         exclude = ["members"]
         read_only_fields = ['creator']
+        list_serializer_class = UserCardListSerializer
 
     def validate_name(self, value):
         user = self.context['request'].user
@@ -100,6 +226,7 @@ class GroupSerializer(serializers.ModelSerializer):
 
 class ProfileSerializer(serializers.ModelSerializer):
     user = UserOnlySerializer(read_only=True)
+    head_image_renditions = RenditionsField(source='head_image')
     class Meta:
         model = Profile
         fields = "__all__"
@@ -113,11 +240,12 @@ class GroupMemberRankSerializer(serializers.ModelSerializer):
 
 
 class MemberSerializer(serializers.ModelSerializer):
-    user = UserSerializer(read_only=True)
-    inviter = UserSerializer(read_only=True)
+    user = UserCardField()
+    inviter = UserCardField()
     class Meta:
         model = Member
         fields = "__all__"
+        list_serializer_class = UserCardListSerializer
 
     def to_representation(self, obj):
         data = super().to_representation(obj)
@@ -134,8 +262,7 @@ class JoinGroupSerializer(serializers.ModelSerializer):
         read_only_fields = ['created', 'modified']
 
     def validate_group(self, value):
-        user = self.context['request'].user
-        if user.user_kehubu_member_set.filter(group=value).exists():
+        if get_roles(self.context['request']).is_member(value.pk):
             raise serializers.ValidationError(
                 _('You cannot join the same group again.')
             )
@@ -168,22 +295,24 @@ class JoinGroupSerializer(serializers.ModelSerializer):
 
 
 class MemberUserSerializer(serializers.ModelSerializer):
-    user = UserSerializer(read_only=True)
+    user = UserCardField()
     group = GroupSerializer(read_only=True)
     class Meta:
         model = Member
         fields = ["user", "created", "id", "group"]
         read_only_fields = ['group']
         depth = 1
+        list_serializer_class = UserCardListSerializer
 
 
 class MemberInviterSerializer(serializers.ModelSerializer):
-    inviter = UserSerializer(read_only=True)
+    inviter = UserCardField()
     group = GroupSerializer(read_only=True)
     class Meta:
         model = Member
         fields = ["inviter", "created", "id", "group"]
         read_only_fields = ['group']
+        list_serializer_class = UserCardListSerializer
 
 
 
@@ -239,7 +368,9 @@ class GroupAlbumImageSerializer(serializers.ModelSerializer):
 
     def get_thumb(self, obj):
         request = self.context['request']
-        return request.build_absolute_uri(obj.thumb.url)
+        if obj.thumb_ready:
+            return request.build_absolute_uri(obj.thumb.url)
+        return request.build_absolute_uri(obj.image.url)
 
 
 class GroupAlbumSerializer(serializers.ModelSerializer):
@@ -254,27 +385,32 @@ class GroupAlbumSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         images = validated_data.pop("images", [])
         album = super().create(validated_data)
-        for image in images:
-            GroupAlbumImage.objects.create(album=album, image=image)
+        album.add_images(images)
         return album
 
     def update(self, instance, validated_data):
         images = validated_data.pop("images", [])
         album = super().update(instance, validated_data)
-        for image in images:
-            GroupAlbumImage.objects.create(album=album, image=image)
+        album.add_images(images)
         return instance
 
+
+class GroupAlbumUploadSerializer(serializers.Serializer):
+    images = serializers.ListField(child=serializers.ImageField(), allow_empty=False)
+
+
 class GroupChatSerializer(serializers.ModelSerializer):
     group = GroupPKField()
     user = serializers.HiddenField(default=serializers.CurrentUserDefault())
+    user_card_sources = ('user', )
     class Meta:
         model = GroupChat
         fields = "__all__"
+        list_serializer_class = UserCardListSerializer
 
     def to_representation(self, obj):
         data = super().to_representation(obj)
-        data['user'] = UserSerializer(obj.user).data
+        data['user'] = get_user_card(self.context, obj.user_id)
         return data
 
 
@@ -291,7 +427,7 @@ class WxConfigSerializer(serializers.Serializer):
         timestamp =  int(time.time())
         wxclient = get_wechat_client(request)
         try:
-            ticket = wxclient.jsapi.get_jsapi_ticket()
+            ticket = wxclient.get_jsapi_ticket()
         except Exception as exc:
             raise serializers.ValidationError(str(exc))
         else:
@@ -308,12 +444,25 @@ class SameGroupUserPKField(serializers.PrimaryKeyRelatedField):
 class UserChatSerializer(serializers.ModelSerializer):
     receiver = SameGroupUserPKField()
     sender = serializers.HiddenField(default=serializers.CurrentUserDefault())
+    user_card_sources = ('receiver', 'sender')
     class Meta:
         model = UserChat
         fields = "__all__"
+        list_serializer_class = UserCardListSerializer
 
     def to_representation(self, obj):
         data = super().to_representation(obj)
-        data['receiver'] = UserSerializer(obj.receiver).data
-        data['sender'] = UserSerializer(obj.sender).data
+        data['receiver'] = get_user_card(self.context, obj.receiver_id)
+        data['sender'] = get_user_card(self.context, obj.sender_id)
         return data
+
+
+class ConversationSerializer(serializers.ModelSerializer):
+    peer = UserCardField()
+
+    class Meta:
+        model = Conversation
+        fields = "__all__"
+        list_serializer_class = UserCardListSerializer
+        read_only_fields = ['owner', 'last_message', 'last_message_summary', 'last_activity',
+                            'unread_count']
@@ -4,43 +4,83 @@ from django.db.models import signals
 from allauth.socialaccount.signals import (
     social_account_added, social_account_updated
 )
-from .models import Member, Group, Profile, GroupChat, UserChat
+from allauth.socialaccount.models import SocialApp
+from .models import (
+    Member, Group, Profile, GroupChat, UserChat, Conversation, OutboxMessage, GroupAlbumImage,
+)
 from django.conf import settings
-from .serializers import MemberSerializer, GroupChatSerializer, UserChatSerializer
+from .serializers import (
+    MemberSerializer, GroupChatSerializer, UserChatSerializer, encode_event,
+)
 from actstream import action
 from actstream.actions import follow, unfollow
+from actstream.models import Action
+from .activity import fan_out, backfill_group_feed, remove_group_feed
+from .utils import invalidate_weixin_credentials
+from .thumbnails import schedule_thumbnail
+from .renditions import reset_renditions, schedule_renditions
+from .storage import blob_storage
+from .search import get_search_backend
+from .cache import user_group_ids_cache, group_user_ids_cache, user_card_cache
+
+
+def invalidate_membership_cache(member):
+    user_group_ids_cache.invalidate(member.user_id)
+    group_user_ids_cache.invalidate(member.group_id)
+
+
+def message_member_subscription(member, message_type):
+    profile = member.user.kehubu_profile
+    profile.message_channel(dict(type=message_type, group=member.group_id,
+                                 channel=Group.get_channel_name(member.group_id)))
 
 
 @receiver(signals.post_save, sender=Member)
 def member_post_save(sender, instance, created, **kwargs):
+    invalidate_membership_cache(instance)
     if created:
         group = instance.group
-        group.update_member_count()
+        group.update_member_count(1)
+        message_member_subscription(instance, 'kehubu.subscription.add')
         serializer = MemberSerializer(instance)
         group.message_channel(dict(type='kehubu.member.add', member=serializer.data))
+        backfill_group_feed(instance.user_id, instance.group_id)
         action.send(instance.user, verb='joined', target=group)
         follow(instance.user, group)
 
 
 @receiver(signals.post_delete, sender=Member)
 def member_post_delete(sender, instance, **kwargs):
+    invalidate_membership_cache(instance)
     group = instance.group
-    group.update_member_count()
+    group.update_member_count(-1)
+    message_member_subscription(instance, 'kehubu.subscription.discard')
+    remove_group_feed(instance.user_id, instance.group_id)
     serializer = MemberSerializer(instance)
     group.message_channel(dict(type='kehubu.member.delete', member=serializer.data))
     unfollow(instance.user, group)
 
 
+@receiver(signals.post_save, sender=Action)
+def action_post_save(sender, instance, created, **kwargs):
+    if created:
+        fan_out([instance])
+
+
 @receiver(signals.pre_save, sender=Group)
 def group_pre_save(sender, instance, **kwargs):
     if instance.tracker.has_changed('notice'):
         instance.notice_updated = timezone.now()
+    for field_name in ('logo', 'cover'):
+        reset_renditions(instance, field_name)
 
 
 @receiver(signals.post_save, sender=Group)
 def group_post_save(sender, instance, created, **kwargs):
     if created:
         instance.add_creator_member()
+    for field_name in ('logo', 'cover'):
+        schedule_renditions(instance, field_name)
 
 
 @receiver(signals.post_save, sender=settings.AUTH_USER_MODEL)
@@ -60,26 +100,80 @@ def on_social_account_updated(request, sociallogin, **kwargs):
     sociallogin.user.kehubu_profile.update_by_socialaccount(provider)
 
 
+def broadcast_group_chat(instance, created):
+    message_type = 'kehubu.groupchat.add' if created else 'kehubu.groupchat.update'
+    data = GroupChatSerializer(instance).data
+    instance.data_json, event_json = encode_event(message_type, 'groupchat', data)
+    channels = [Group.get_channel_name(instance.group_id)]
+    OutboxMessage.enqueue_text(channels, message_type, event_json)
+
+
+def broadcast_user_chat(instance, created):
+    if created:
+        Conversation.record_message(instance)
+    message_type = 'kehubu.userchat.add' if created else 'kehubu.userchat.update'
+    data = UserChatSerializer(instance).data
+    instance.data_json, event_json = encode_event(message_type, 'userchat', data)
+    channels = {
+        Profile.get_channel_name(data['sender']['kehubu_profile']['id']),
+        Profile.get_channel_name(data['receiver']['kehubu_profile']['id']),
+    }
+    OutboxMessage.enqueue_text(channels, message_type, event_json)
+
+
+@receiver(signals.post_save, sender=SocialApp)
+@receiver(signals.post_delete, sender=SocialApp)
+@receiver(signals.m2m_changed, sender=SocialApp.sites.through)
+def social_app_changed(sender, instance, **kwargs):
+    invalidate_weixin_credentials()
+
+
 @receiver(signals.post_save, sender=GroupChat)
 def group_chat_post_save(sender, instance, created, **kwargs):
-    group = instance.group
-    serializer = GroupChatSerializer(instance)
-    if created:
-        group.message_channel(dict(type='kehubu.groupchat.add', groupchat=serializer.data))
-    else:
-        group.message_channel(dict(type='kehubu.groupchat.update', groupchat=serializer.data))
+    broadcast_group_chat(instance, created)
+    get_search_backend().index([instance])
+
+
+@receiver(signals.post_delete, sender=GroupChat)
+def group_chat_post_delete(sender, instance, **kwargs):
+    get_search_backend().remove(instance.search_kind, instance.pk)
 
 
 @receiver(signals.post_save, sender=UserChat)
 def user_chat_post_save(sender, instance, created, **kwargs):
-    serializer = UserChatSerializer(instance)
-    if created:
-        instance.sender.kehubu_profile.message_channel(
-            dict(type='kehubu.userchat.add', userchat=serializer.data))
-        instance.receiver.kehubu_profile.message_channel(
-            dict(type='kehubu.userchat.add', userchat=serializer.data))
-    else:
-        instance.sender.kehubu_profile.message_channel(
-            dict(type='kehubu.userchat.update', userchat=serializer.data))
-        instance.receiver.kehubu_profile.message_channel(
-            dict(type='kehubu.userchat.update', userchat=serializer.data))
+    broadcast_user_chat(instance, created)
+
+
+@receiver(signals.post_save, sender=settings.AUTH_USER_MODEL)
+def user_card_post_save(sender, instance, **kwargs):
+    user_card_cache.invalidate(instance.pk)
+
+
+@receiver(signals.pre_save, sender=Profile)
+def profile_pre_save(sender, instance, **kwargs):
+    reset_renditions(instance, 'head_image')
+
+
+@receiver(signals.post_save, sender=Profile)
+def profile_post_save(sender, instance, **kwargs):
+    user_card_cache.invalidate(instance.user_id)
+    schedule_renditions(instance, 'head_image')
+
+
+@receiver(signals.pre_save, sender=GroupAlbumImage)
+def group_album_image_pre_save(sender, instance, **kwargs):
+    if instance.tracker.has_changed('image'):
+        instance.thumb_ready = False
+
+
+@receiver(signals.post_save, sender=GroupAlbumImage)
+def group_album_image_post_save(sender, instance, created, **kwargs):
+    if not created and instance.tracker.has_changed('image'):
+        blob_storage.release(instance.tracker.previous('image'))
+    if not instance.thumb_ready:
+        schedule_thumbnail(instance)
+
+
+@receiver(signals.post_delete, sender=GroupAlbumImage)
+def group_album_image_post_delete(sender, instance, **kwargs):
+    blob_storage.release(instance.image.name)
@@ -0,0 +1,122 @@
+import hashlib
+import os
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F, Value
+from django.utils.deconstruct import deconstructible
+from .counters import count_subquery
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage that names every upload after the sha256 of its content, so
+    identical uploads share one blob on disk. Each stored name is
+    reference-counted by a ``kehubu.Blob`` row: ``save`` acquires a reference
+    and ``release`` drops one, deleting the blob once nothing refers to it.
+    """
+    prefix = 'uploads/blobs'
+
+    def get_blob_name(self, name, content):
+        sha256 = hashlib.sha256()
+        for chunk in content.chunks():
+            sha256.update(chunk)
+        digest = sha256.hexdigest()
+        ext = os.path.splitext(name)[1].lower()
+        return '{}/{}/{}/{}{}'.format(self.prefix, digest[:2], digest[2:4], digest, ext)
+
+    def _save(self, name, content):
+        # write before acquiring, so a failed write leaves no reference behind
+        name = self.get_blob_name(name, content)
+        if not self.exists(name):
+            self.write(name, content)
+        self.acquire(name, content.size)
+        if not self.exists(name):
+            # collected between the write and the acquire
+            self.write(name, content)
+        return name
+
+    def write(self, name, content):
+        content.seek(0)
+        saved = super()._save(name, content)
+        if saved != name:
+            # an identical upload got there first; its copy is as good as ours
+            self.delete(saved)
+
+    def acquire(self, name, size=0):
+        from .models import Blob
+        while True:
+            if Blob.objects.filter(name=name).update(refcount=F('refcount') + 1):
+                return
+            try:
+                with transaction.atomic():
+                    Blob.objects.create(name=name, size=size, refcount=1)
+                return
+            except IntegrityError:
+                continue
+
+    def release(self, name):
+        """Drop one reference to ``name`` and collect it after commit if it was the last."""
+        from .models import Blob
+        if not name:
+            return
+        updated = Blob.objects.filter(name=name, refcount__gt=0).update(refcount=F('refcount') - 1)
+        if updated:
+            transaction.on_commit(lambda: self.collect(name))
+
+    def discard(self, name):
+        """Delete ``name`` if no Blob row refers to it, as after rolling back the save that acquired it."""
+        from .models import Blob
+        if name and not Blob.objects.filter(name=name).exists():
+            self.delete(name)
+
+    def collect(self, name):
+        """Delete ``name`` and its Blob row if nothing refers to it any more."""
+        from .models import Blob
+        with transaction.atomic():
+            blob = Blob.objects.select_for_update().filter(name=name, refcount=0).first()
+            if blob is not None:
+                blob.delete()
+                self.delete(name)
+
+    def reconcile(self, references, chunk_size=500):
+        """
+        Recount every Blob's ``refcount`` from ``references``, a list of
+        ``(queryset, field)`` pairs whose ``field`` holds blob names. Names
+        that are stored but have no Blob row get one, drifted counts are
+        fixed in pk-ordered chunks and blobs nothing refers to are collected.
+        Returns the numbers of rows created, fixed and collected.
+        """
+        from .models import Blob
+        created = 0
+        for queryset, field in references:
+            names = (queryset.exclude(**{field: ''}).exclude(**{field + '__in': Blob.objects.values('name')})
+                     .order_by().values_list(field, flat=True).distinct())
+            for name in names:
+                if self.exists(name):
+                    _, was_created = Blob.objects.get_or_create(name=name, defaults=dict(size=self.size(name)))
+                    created += was_created
+
+        actual = sum((count_subquery(queryset, field, outer_field='name') for queryset, field in references),
+                     Value(0))
+        fixed = 0
+        last_pk = 0
+        while True:
+            chunk = list(Blob.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', flat=True)[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1]
+            drifted = Blob.objects.filter(pk__in=chunk).annotate(actual_count=actual)
+            drifted = list(drifted.exclude(refcount=F('actual_count')).values_list('pk', flat=True))
+            if drifted:
+                fixed += Blob.objects.filter(pk__in=drifted).update(refcount=actual)
+
+        collected = 0
+        for name in Blob.objects.filter(refcount=0).values_list('name', flat=True):
+            self.collect(name)
+            collected += not Blob.objects.filter(name=name).exists()
+        return created, fixed, collected
+
+
+blob_storage = ContentAddressedStorage()
@@ -1,3 +1,1595 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager, ExitStack
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+import requests
+from PIL import Image
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer, InMemoryChannelLayer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User, AnonymousUser
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import signals
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient, APIRequestFactory
+from actstream.models import Action
+from allauth.socialaccount.models import SocialApp, SocialAccount
+from forum.models import Attachment
+from .models import (
+    Group, GroupMemberRank, GroupInvitation, GroupAlbum, GroupAlbumImage, GroupChat, UserChat, Conversation,
+    Member, OutboxMessage, FeedItem, Profile, Blob,
+    get_user_group_ids, get_group_user_ids, share_group,
+)
+from .counters import increment, reconcile
+from .pagination import KeysetPagination
+from .consumers import KehubuConsumer
+from . import batching, outbox
+from .activity import prefetch_action_objects
+from .utils import get_wechat_client
+from .renditions import get_renditions, get_rendition_files, mark_renditions_ready
+from .avatars import sync_head_image, schedule_head_image
+from .serializers import get_user_cards, absolutize_card
+from .storage import blob_storage
+from .search import get_search_backend, tokenize
 
-# Create your tests here.
+
+class TestSettingsMixin(object):
+    """
+    Runs a test class on a process-local cache, the in-memory channel layer
+    and a throwaway MEDIA_ROOT, so the suite needs no Redis and leaves no files.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.test_settings = override_settings(
+            MEDIA_ROOT=cls.media_root,
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+        )
+        cls.test_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.test_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+def make_image(name='image.png', size=(400, 300), color='red'):
+    buf = BytesIO()
+    Image.new('RGB', size, color).save(buf, 'PNG')
+    return ContentFile(buf.getvalue(), name=name)
+
+
+class ImmediateExecutor(Executor):
+    """Runs submitted work inline, in place of the thread and process pools."""
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+@contextmanager
+def returning_bulk_insert(*models):
+    """
+    Run the ``can_return_ids_from_bulk_insert`` branches on SQLite. With
+    one row per INSERT, ``bulk_create`` reads each id back the way
+    PostgreSQL's RETURNING would give them. Yields spies on the
+    ``bulk_create`` of each of ``models``.
+    """
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(connection.features, 'can_return_ids_from_bulk_insert', True))
+        stack.enter_context(mock.patch.object(connection.ops, 'bulk_batch_size', return_value=1))
+        yield [stack.enter_context(mock.patch.object(
+                   model.objects, 'bulk_create', wraps=model.objects.bulk_create))
+               for model in models]
+
+
+class KehubuTestCase(TestSettingsMixin, TestCase):
+    pass
+
+
+class KehubuTransactionTestCase(TestSettingsMixin, TransactionTestCase):
+    pass
+
+
+class QueryBudgetTestCase(KehubuTestCase):
+    """
+    Asserts that list endpoints run the same number of queries for a page of
+    10 rows as for a page of 100.
+    """
+    sizes = (10, 100)
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.user_count = 0
+
+    def create_user(self):
+        self.user_count += 1
+        return User.objects.create(username='user{}'.format(self.user_count))
+
+    def get_query_count(self, url, size):
+        # a fresh user instance so nothing memoized by a previous request leaks in
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))
+        cache.clear()
+        separator = '&' if '?' in url else '?'
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('{}{}limit={}'.format(url, separator, size))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), size)
+        return len(context.captured_queries)
+
+    def assertFlatQueryCount(self, url, populate):
+        """``populate(n)`` must leave at least ``n`` rows visible at ``url``."""
+        counts = []
+        for size in self.sizes:
+            populate(size)
+            counts.append(self.get_query_count(url, size))
+        self.assertEqual(counts[0], counts[-1], "{} queries grew with page size: {}".format(url, counts))
+
+
+class KehubuQueryBudgetTest(QueryBudgetTestCase):
+    def test_group_list(self):
+        def populate(size):
+            while Group.objects.filter_member_user(self.user).count() < size:
+                group = Group.objects.create(creator=self.create_user(), name='g{}'.format(self.user_count))
+                group.add_member(self.user)
+        self.assertFlatQueryCount('/api/kehubu/group/', populate)
+
+    def test_profile_list(self):
+        group = Group.objects.create(creator=self.user, name='g')
+
+        def populate(size):
+            while group.group_kehubu_member_set.count() < size:
+                group.add_member(self.create_user())
+        self.assertFlatQueryCount('/api/kehubu/profile/', populate)
+
+    def test_member_list(self):
+        group = Group.objects.create(creator=self.user, name='g')
+        rank = GroupMemberRank.objects.create(group=group, name='r')
+
+        def populate(size):
+            while group.group_kehubu_member_set.count() < size:
+                member, created = group.add_member(self.create_user(), inviter=self.user)
+                member.rank = rank
+                member.save()
+        self.assertFlatQueryCount('/api/kehubu/member/', populate)
+
+    def test_member_inviter_list(self):
+        def populate(size):
+            while self.user.user_kehubu_member_set.count() < size:
+                inviter = self.create_user()
+                group = Group.objects.create(creator=inviter, name='g{}'.format(self.user_count))
+                group.add_member(self.user, inviter=inviter)
+        self.assertFlatQueryCount('/api/kehubu/memberinviter/', populate)
+
+    def test_member_user_list(self):
+        group = Group.objects.create(creator=self.user, name='g')
+
+        def populate(size):
+            while self.user.inviter_kehubu_member_set.count() < size:
+                group.add_member(self.create_user(), inviter=self.user)
+        self.assertFlatQueryCount('/api/kehubu/memberuser/', populate)
+
+    def test_group_member_rank_list(self):
+        group = Group.objects.create(creator=self.user, name='g')
+
+        def populate(size):
+            while group.groupmemberrank_set.count() < size:
+                GroupMemberRank.objects.create(group=group, name='r{}'.format(group.groupmemberrank_set.count()))
+        self.assertFlatQueryCount('/api/kehubu/groupmemberrank/', populate)
+
+    def test_group_invitation_list(self):
+        group = Group.objects.create(creator=self.user, name='g')
+
+        def populate(size):
+            while GroupInvitation.objects.filter(inviter=self.user).count() < size:
+                GroupInvitation.objects.create(group=group, inviter=self.user)
+        self.assertFlatQueryCount('/api/kehubu/groupinvitation/', populate)
+
+    def test_group_album_list(self):
+        group = Group.objects.create(creator=self.user, name='g')
+
+        def populate(size):
+            while group.groupalbum_set.count() < size:
+                GroupAlbum.objects.create(group=group, title='a')
+        self.assertFlatQueryCount('/api/kehubu/groupalbum/', populate)
+
+    def test_conversation_list(self):
+        def populate(size):
+            while Conversation.objects.filter(owner=self.user).count() < size:
+                Conversation.objects.create(owner=self.user, peer=self.create_user(),
+                                            last_activity=timezone.now())
+        self.assertFlatQueryCount('/api/kehubu/conversation/', populate)
+
+    def test_activity_list(self):
+        group = Group.objects.create(creator=self.user, name='g')
+
+        def populate(size):
+            while self.user.kehubu_feeditem_set.count() < size:
+                group.add_member(self.create_user())
+        self.assertFlatQueryCount('/api/kehubu/activity/', populate)
+
+    def test_group_chat_list(self):
+        group = Group.objects.create(creator=self.user, name='g')
+
+        def populate(size):
+            while GroupChat.objects.filter(group=group).count() < size:
+                user = self.create_user()
+                group.add_member(user)
+                GroupChat.objects.create(group=group, user=user, message='hi')
+        self.assertFlatQueryCount('/api/kehubu/groupchat/', populate)
+
+    def test_user_chat_list(self):
+        group = Group.objects.create(creator=self.user, name='g')
+
+        def populate(size):
+            while UserChat.objects.filter(receiver=self.user).count() < size:
+                user = self.create_user()
+                group.add_member(user)
+                UserChat.objects.create(sender=user, receiver=self.user, message='hi')
+        self.assertFlatQueryCount('/api/kehubu/userchat/', populate)
+
+
+class MembershipCacheTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=User.objects.create(username='creator'), name='g')
+
+    def test_user_group_ids_follow_member_add_and_remove(self):
+        self.assertEqual(get_user_group_ids(self.user.pk), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_group_ids(self.user.pk), [])
+
+        member, created = self.group.add_member(self.user)
+        self.assertEqual(get_user_group_ids(self.user.pk), [self.group.pk])
+
+        member.delete()
+        self.assertEqual(get_user_group_ids(self.user.pk), [])
+
+    def test_group_user_ids_follow_member_add_and_remove(self):
+        creator_ids = [self.group.creator_id]
+        self.assertEqual(get_group_user_ids([self.group.pk]), creator_ids)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_group_user_ids([self.group.pk]), creator_ids)
+
+        member, created = self.group.add_member(self.user)
+        self.assertEqual(sorted(get_group_user_ids([self.group.pk])), sorted(creator_ids + [self.user.pk]))
+
+        member.delete()
+        self.assertEqual(get_group_user_ids([self.group.pk]), creator_ids)
+
+    def test_profile_group_ids(self):
+        self.group.add_member(self.user)
+        profile = User.objects.get(pk=self.user.pk).kehubu_profile
+        self.assertEqual(list(profile.group_set), [self.group])
+
+
+class CounterTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.group = Group.objects.create(creator=User.objects.create(username='creator'), name='g')
+
+    def get_member_count(self):
+        return Group.objects.get(pk=self.group.pk).member_count
+
+    def test_increment_never_goes_below_zero(self):
+        group_set = Group.objects.filter(pk=self.group.pk)
+        increment(group_set, 'member_count', 2)
+        self.assertEqual(self.get_member_count(), 3)
+        increment(group_set, 'member_count', -5)
+        self.assertEqual(self.get_member_count(), 0)
+
+    def test_member_count_follows_member_add_and_remove(self):
+        self.assertEqual(self.get_member_count(), 1)
+        member, created = self.group.add_member(User.objects.create(username='u'))
+        self.assertEqual(self.get_member_count(), 2)
+        member.delete()
+        self.assertEqual(self.get_member_count(), 1)
+
+    def test_failed_save_rolls_back_the_counter(self):
+        def fail(sender, instance, created, **kwargs):
+            raise RuntimeError
+        signals.post_save.connect(fail, sender=Member)
+        try:
+            with self.assertRaises(RuntimeError):
+                Member(group=self.group, user=User.objects.create(username='u')).save()
+        finally:
+            signals.post_save.disconnect(fail, sender=Member)
+        self.assertEqual(self.get_member_count(), 1)
+        self.assertEqual(self.group.group_kehubu_member_set.count(), 1)
+
+    def test_reconcile_fixes_only_drifted_rows(self):
+        other = Group.objects.create(creator=self.group.creator, name='other')
+        Group.objects.filter(pk=self.group.pk).update(member_count=7)
+        fixed = reconcile(Group, 'member_count', Member.objects.all(), 'group', chunk_size=1)
+        self.assertEqual(fixed, 1)
+        self.assertEqual(self.get_member_count(), 1)
+        self.assertEqual(Group.objects.get(pk=other.pk).member_count, 1)
+
+
+class KeysetPaginationTest(KehubuTestCase):
+    url = '/api/kehubu/groupchat/'
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.chats = [GroupChat.objects.create(group=self.group, user=self.user, message=str(i))
+                      for i in range(25)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_page(self, query):
+        response = self.client.get(self.url, query)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def walk(self):
+        ids, pages = [], []
+        query = dict(limit=10)
+        while query is not None:
+            page = self.get_page(query)
+            pages.append(page)
+            ids.extend(row['id'] for row in page['results'])
+            query = page['next_query']
+        return ids, pages
+
+    def test_token_round_trip(self):
+        paginator = KeysetPagination()
+        chat = self.chats[3]
+        self.assertEqual(paginator.decode_token(paginator.encode_token(chat)), (chat.created, chat.pk))
+
+    def test_pages_newest_first_without_gaps(self):
+        ids, pages = self.walk()
+        self.assertEqual(ids, [chat.pk for chat in reversed(self.chats)])
+        self.assertEqual([len(page['results']) for page in pages], [10, 10, 5])
+        self.assertIsNone(pages[0]['previous_query'])
+
+        previous = self.get_page(pages[1]['previous_query'])
+        self.assertEqual(previous['results'], pages[0]['results'])
+
+    def test_duplicate_timestamps(self):
+        GroupChat.objects.update(created=timezone.now())
+        ids, pages = self.walk()
+        self.assertEqual(ids, [chat.pk for chat in reversed(self.chats)])
+
+    def test_invalid_token(self):
+        for token in ('not a token', 'eHx5', 'MjAxOS0wMS0wMXx4'):
+            for param in ('before', 'after'):
+                response = self.client.get(self.url, {param: token})
+                self.assertEqual(response.status_code, 400, (param, token))
+
+
+class ConversationTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.peer = User.objects.create(username='peer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_conversation(self, owner, peer):
+        return Conversation.objects.get(owner=owner, peer=peer)
+
+    def test_both_sides_track_the_last_message_and_unread_count(self):
+        UserChat.objects.create(sender=self.user, receiver=self.peer, message='hi')
+        last = UserChat.objects.create(sender=self.user, receiver=self.peer, message='again')
+
+        mine = self.get_conversation(self.user, self.peer)
+        theirs = self.get_conversation(self.peer, self.user)
+        for conversation in (mine, theirs):
+            self.assertEqual(conversation.last_message_id, last.pk)
+            self.assertEqual(conversation.last_message_summary, 'again')
+            self.assertEqual(conversation.last_activity, last.created)
+        self.assertEqual(mine.unread_count, 0)
+        self.assertEqual(theirs.unread_count, 2)
+
+    def test_chat_with_self_keeps_one_read_row(self):
+        UserChat.objects.create(sender=self.user, receiver=self.user, message='note')
+        conversation = Conversation.objects.get(owner=self.user)
+        self.assertEqual(conversation.peer, self.user)
+        self.assertEqual(conversation.unread_count, 0)
+
+    def test_list_newest_first_and_mark_read(self):
+        other = User.objects.create(username='other')
+        UserChat.objects.create(sender=self.peer, receiver=self.user, message='first')
+        UserChat.objects.create(sender=other, receiver=self.user, message='second')
+
+        response = self.client.get('/api/kehubu/conversation/')
+        self.assertEqual([row['peer']['id'] for row in response.data['results']], [other.pk, self.peer.pk])
+        self.assertEqual([row['unread_count'] for row in response.data['results']], [1, 1])
+
+        conversation = self.get_conversation(self.user, other)
+        response = self.client.post('/api/kehubu/conversation/{}/read/'.format(conversation.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['unread_count'], 0)
+        self.assertEqual(self.get_conversation(self.user, other).unread_count, 0)
+        self.assertEqual(self.get_conversation(other, self.user).unread_count, 0)
+
+
+class ConsumerTestCase(KehubuTransactionTestCase):
+    """Drives KehubuConsumer through WebsocketCommunicator; tests are coroutines run by ``run_async``."""
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=self.user, name='g')
+
+    def run_async(self, coroutine_function):
+        async_to_sync(coroutine_function)()
+
+    async def connect(self, user=None):
+        communicator = WebsocketCommunicator(KehubuConsumer, '/ws/kehubu/')
+        communicator.scope['user'] = self.user if user is None else user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def dispatch(self, communicator):
+        """Deliver the outbox and return what the socket received once it went quiet."""
+        await database_sync_to_async(outbox.dispatch)()
+        received = []
+        while not await communicator.receive_nothing():
+            received.append(await communicator.receive_json_from())
+        return received
+
+    async def group_send(self, group, text):
+        await get_channel_layer().group_send(
+            Group.get_channel_name(group.pk), dict(type='kehubu.groupchat.add', text=text))
+
+
+class ConsumerConnectTest(ConsumerTestCase):
+    def test_anonymous_is_rejected(self):
+        async def test():
+            communicator = WebsocketCommunicator(KehubuConsumer, '/ws/kehubu/')
+            communicator.scope['user'] = AnonymousUser()
+            connected, subprotocol = await communicator.connect()
+            self.assertFalse(connected)
+        self.run_async(test)
+
+    def test_receives_group_and_profile_messages(self):
+        other = Group.objects.create(creator=User.objects.create(username='other'), name='other')
+        profile_channel = self.user.kehubu_profile.channel_name
+
+        async def test():
+            communicator = await self.connect()
+            await self.group_send(self.group, '{"n": 1}')
+            self.assertEqual(await communicator.receive_json_from(), dict(n=1))
+
+            await self.group_send(other, '{"n": 2}')
+            self.assertTrue(await communicator.receive_nothing())
+
+            await get_channel_layer().group_send(
+                profile_channel, dict(type='kehubu.userchat.add', text='{"n": 3}'))
+            self.assertEqual(await communicator.receive_json_from(), dict(n=3))
+            await communicator.disconnect()
+        self.run_async(test)
+
+
+class ConsumerSubscriptionTest(ConsumerTestCase):
+    def test_membership_changes_resubscribe_open_sockets(self):
+        other = Group.objects.create(creator=User.objects.create(username='other'), name='other')
+        add_member = database_sync_to_async(other.add_member)
+
+        async def test():
+            communicator = await self.connect()
+            member, created = await add_member(self.user)
+            await self.dispatch(communicator)
+            await self.group_send(other, '{"n": 1}')
+            self.assertEqual(await communicator.receive_json_from(), dict(n=1))
+
+            await database_sync_to_async(member.delete)()
+            await self.dispatch(communicator)
+            await self.group_send(other, '{"n": 2}')
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+        self.run_async(test)
+
+
+class RecordingChannelLayer(InMemoryChannelLayer):
+    """In-memory channel layer that records group sends and fails those to ``failing`` groups."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sent = []
+        self.failing = set()
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message['n']))
+        if group in self.failing:
+            raise ConnectionError(group)
+        await super().group_send(group, message)
+
+
+class OutboxDispatchTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.channel_layer = RecordingChannelLayer()
+
+    def enqueue(self, channel, n, **kwargs):
+        message = OutboxMessage.enqueue(channel, dict(type='kehubu.test', n=n))
+        if kwargs:
+            OutboxMessage.objects.filter(pk=message.pk).update(**kwargs)
+        return message
+
+    def dispatch(self, batch_size=100):
+        return outbox.dispatch(batch_size, channel_layer=self.channel_layer)
+
+    def sent_to(self, channel):
+        return [n for group, n in self.channel_layer.sent if group == channel]
+
+    def test_delivers_each_channel_in_order(self):
+        for channel, n in [('a', 1), ('b', 1), ('a', 2), ('b', 2), ('a', 3)]:
+            self.enqueue(channel, n)
+        result = self.dispatch()
+        self.assertEqual((result.sent, result.failed, result.dropped), (5, 0, 0))
+        self.assertEqual(self.sent_to('a'), [1, 2, 3])
+        self.assertEqual(self.sent_to('b'), [1, 2])
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_failure_backs_off_and_holds_back_its_channel(self):
+        first = self.enqueue('a', 1)
+        self.enqueue('a', 2)
+        self.enqueue('b', 1)
+        self.channel_layer.failing.add('a')
+
+        with self.assertLogs('kehubu.outbox', 'ERROR'):
+            result = self.dispatch()
+        self.assertEqual((result.sent, result.failed, result.dropped), (1, 1, 0))
+        self.assertEqual(self.sent_to('a'), [1])
+        first.refresh_from_db()
+        self.assertEqual(first.attempts, 1)
+        self.assertGreater(first.next_attempt, timezone.now())
+
+        # the layer recovered, but the head of 'a' is still backing off
+        self.channel_layer.failing.clear()
+        self.assertEqual(self.dispatch().sent, 0)
+        self.assertEqual(self.sent_to('a'), [1])
+
+        OutboxMessage.objects.filter(pk=first.pk).update(next_attempt=timezone.now())
+        self.assertEqual(self.dispatch().sent, 2)
+        self.assertEqual(self.sent_to('a'), [1, 1, 2])
+
+    def test_backing_off_channel_does_not_starve_the_batch(self):
+        retry = timezone.now() + timedelta(minutes=1)
+        for n in range(5):
+            self.enqueue('a', n, attempts=1, next_attempt=retry)
+        self.enqueue('b', 1)
+        result = self.dispatch(batch_size=3)
+        self.assertEqual(result.sent, 1)
+        self.assertEqual(self.channel_layer.sent, [('b', 1)])
+        self.assertEqual(OutboxMessage.objects.count(), 5)
+
+    def test_drops_after_max_attempts(self):
+        self.enqueue('a', 1, attempts=outbox.MAX_ATTEMPTS - 1)
+        self.enqueue('a', 2)
+        self.channel_layer.failing.add('a')
+        with self.assertLogs('kehubu.outbox', 'ERROR') as logs:
+            result = self.dispatch()
+        self.assertEqual((result.sent, result.failed, result.dropped), (0, 0, 1))
+        self.assertIn('dropping', logs.output[-1])
+        self.assertEqual(list(OutboxMessage.objects.values_list('attempts', flat=True)), [0])
+
+        self.channel_layer.failing.clear()
+        self.assertEqual(self.dispatch().sent, 1)
+        self.assertEqual(self.sent_to('a'), [1, 2])
+
+
+class PreEncodedCreateTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.peer = User.objects.create(username='peer')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.group.add_member(self.peer)
+        for user in (self.user, self.peer):
+            user.kehubu_profile.head_image.save('head.png', make_image())
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertCreateMatchesList(self, url, data):
+        created = self.client.post(url, data, format='json')
+        self.assertEqual(created.status_code, 201)
+        listed = self.client.get(url).data['results'][0]
+        self.assertEqual(created.data['id'], listed['id'])
+        self.assertEqual(json.loads(json.dumps(created.data)), json.loads(json.dumps(listed)))
+        return created.data
+
+    def test_group_chat(self):
+        data = self.assertCreateMatchesList('/api/kehubu/groupchat/', dict(group=self.group.pk, message='hi'))
+        self.assertTrue(data['user']['kehubu_profile']['head_image'].startswith('http://testserver/'))
+
+    def test_user_chat(self):
+        data = self.assertCreateMatchesList('/api/kehubu/userchat/', dict(receiver=self.peer.pk, message='hi'))
+        self.assertTrue(data['receiver']['kehubu_profile']['head_image'].startswith('http://testserver/'))
+
+
+class ChatAtomicityTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.peer = User.objects.create(username='peer')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.group.add_member(self.peer)
+        OutboxMessage.objects.all().delete()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post_failing(self, model, url, data):
+        def fail(sender, instance, created, **kwargs):
+            raise RuntimeError
+        signals.post_save.connect(fail, sender=model)
+        try:
+            with self.assertRaises(RuntimeError):
+                self.client.post(url, data, format='json')
+        finally:
+            signals.post_save.disconnect(fail, sender=model)
+
+    def test_failed_group_chat_leaves_no_broadcast(self):
+        self.post_failing(GroupChat, '/api/kehubu/groupchat/', dict(group=self.group.pk, message='hi'))
+        self.assertFalse(GroupChat.objects.exists())
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_failed_user_chat_leaves_no_broadcast_or_conversation(self):
+        self.post_failing(UserChat, '/api/kehubu/userchat/', dict(receiver=self.peer.pk, message='hi'))
+        self.assertFalse(UserChat.objects.exists())
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertFalse(Conversation.objects.exists())
+
+
+class ConsumerChatTest(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.peer = User.objects.create(username='peer')
+        self.group.add_member(self.peer)
+
+    def test_group_chat_is_acked_and_broadcast(self):
+        async def test():
+            communicator = await self.connect()
+            await communicator.send_json_to(dict(type='groupchat.add', group=self.group.pk,
+                                                 message='hi', nonce='n1'))
+            ack = await communicator.receive_json_from()
+            self.assertEqual((ack['type'], ack['request'], ack['nonce']), ('ack', 'groupchat.add', 'n1'))
+            received = await self.dispatch(communicator)
+            self.assertEqual([e['groupchat']['id'] for e in received if e['type'] == 'kehubu.groupchat.add'],
+                             [ack['id']])
+            await communicator.disconnect()
+        self.run_async(test)
+        self.assertEqual(GroupChat.objects.get().message, 'hi')
+
+    def test_user_chat_is_acked(self):
+        async def test():
+            communicator = await self.connect()
+            await communicator.send_json_to(dict(type='userchat.add', receiver=self.peer.pk, message='hi'))
+            ack = await communicator.receive_json_from()
+            self.assertEqual(ack['type'], 'ack')
+            await communicator.disconnect()
+        self.run_async(test)
+        chat = UserChat.objects.get()
+        self.assertEqual((chat.sender, chat.receiver), (self.user, self.peer))
+
+    def test_invalid_messages_are_answered_with_errors(self):
+        stranger = User.objects.create(username='stranger')
+        other = Group.objects.create(creator=stranger, name='other')
+        messages = [
+            dict(type='unknown'),
+            dict(type='groupchat.add', group=self.group.pk, message=' '),
+            dict(type='groupchat.add', group=other.pk, message='hi'),
+            dict(type='userchat.add', receiver=stranger.pk, message='hi'),
+        ]
+
+        async def test():
+            communicator = await self.connect()
+            for message in messages:
+                await communicator.send_json_to(dict(message, nonce=message['type']))
+                error = await communicator.receive_json_from()
+                self.assertEqual((error['type'], error['nonce']), ('error', message['type']))
+            await communicator.disconnect()
+        self.run_async(test)
+        self.assertFalse(GroupChat.objects.exists())
+        self.assertFalse(UserChat.objects.exists())
+
+    def test_failed_batch_is_retried_row_by_row(self):
+        persist = batching.persist
+
+        def persist_singles(objs):
+            if len(objs) > 1:
+                raise RuntimeError
+            persist(objs)
+
+        async def test():
+            communicator = await self.connect()
+            for n in range(2):
+                await communicator.send_json_to(dict(type='groupchat.add', group=self.group.pk,
+                                                     message=str(n), nonce=n))
+            acks = [await communicator.receive_json_from() for n in range(2)]
+            self.assertEqual(sorted((ack['type'], ack['nonce']) for ack in acks), [('ack', 0), ('ack', 1)])
+            await communicator.disconnect()
+
+        with mock.patch('kehubu.batching.persist', side_effect=persist_singles) as patched:
+            with self.assertLogs('kehubu.batching', 'ERROR'):
+                self.run_async(test)
+        self.assertEqual(patched.call_count, 3)
+        self.assertEqual(sorted(GroupChat.objects.values_list('message', flat=True)), ['0', '1'])
+
+    def test_failed_write_is_reported(self):
+        async def test():
+            communicator = await self.connect()
+            await communicator.send_json_to(dict(type='groupchat.add', group=self.group.pk,
+                                                 message='hi', nonce='n1'))
+            error = await communicator.receive_json_from()
+            self.assertEqual((error['type'], error['nonce']), ('error', 'n1'))
+            await communicator.disconnect()
+
+        with mock.patch('kehubu.batching.persist', side_effect=RuntimeError):
+            with self.assertLogs('kehubu.batching', 'ERROR'):
+                self.run_async(test)
+        self.assertFalse(GroupChat.objects.exists())
+
+
+class PersistTest(KehubuTestCase):
+    """The bulk insert branch of ``batching.persist`` must match what post_save does."""
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.peer = User.objects.create(username='peer')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.group.add_member(self.peer)
+        OutboxMessage.objects.all().delete()
+
+    def persist(self, bulk):
+        objs = [
+            GroupChat(group=self.group, user=self.user, message='hello world'),
+            UserChat(sender=self.user, receiver=self.peer, message='hi'),
+            UserChat(sender=self.peer, receiver=self.user, message='hi back'),
+        ]
+        if not bulk:
+            batching.persist(objs)
+            return objs
+        with returning_bulk_insert(GroupChat, UserChat) as bulk_creates:
+            batching.persist(objs)
+        for bulk_create in bulk_creates:
+            bulk_create.assert_called_once()
+        return objs
+
+    def get_events(self):
+        events = dict()
+        for message in OutboxMessage.objects.order_by('pk'):
+            event = json.loads(message.message['text'])
+            data = event.get('groupchat') or event.get('userchat')
+            events.setdefault(message.channel, []).append((event['type'], data['id']))
+        return events
+
+    def test_bulk_insert_matches_post_save(self):
+        for bulk in (False, True):
+            with self.subTest(bulk=bulk):
+                group_chat, first, second = self.persist(bulk)
+                for chat in (group_chat, first, second):
+                    self.assertIsNotNone(chat.pk)
+                    self.assertEqual(json.loads(chat.data_json)['id'], chat.pk)
+
+                group_channel = Group.get_channel_name(self.group.pk)
+                profile_channels = [Profile.get_channel_name(user.kehubu_profile.pk) for user in (self.user, self.peer)]
+                events = self.get_events()
+                self.assertEqual(events[group_channel], [('kehubu.groupchat.add', group_chat.pk)])
+                for channel in profile_channels:
+                    self.assertEqual(events[channel], [('kehubu.userchat.add', first.pk),
+                                                       ('kehubu.userchat.add', second.pk)])
+
+                self.assertEqual(get_search_backend().search('groupchat', 'hello'), [group_chat.pk])
+
+                conversations = {(c.owner_id, c.peer_id): (c.last_message_id, c.unread_count)
+                                 for c in Conversation.objects.all()}
+                self.assertEqual(conversations, {
+                    (self.user.pk, self.peer.pk): (second.pk, 1),
+                    (self.peer.pk, self.user.pk): (second.pk, 1),
+                })
+
+                for model in (GroupChat, UserChat, Conversation, OutboxMessage):
+                    model.objects.all().delete()
+
+
+class ActivityTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.members = [User.objects.create(username='u{}'.format(i)) for i in range(3)]
+        for user in self.members:
+            self.group.add_member(user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_prefetch_action_objects_resolves_every_generic_relation(self):
+        actions = list(Action.objects.all())
+        prefetch_action_objects(actions)
+        with self.assertNumQueries(0):
+            names = [(str(action.actor), str(action.target)) for action in actions]
+            descriptions = [str(action) for action in actions]
+        # joining a group also follows it, which actstream records as a second action
+        self.assertEqual(len(names), 8)
+        self.assertTrue(all(target == 'g' for actor, target in names))
+        self.assertEqual(sum('joined' in description for description in descriptions), 4)
+
+    def test_activity_list_pages_feed_actions_newest_first(self):
+        response = self.client.get('/api/kehubu/activity/', dict(limit=2))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 8)
+        self.assertEqual(response.data['next_query'], dict(limit='2', offset='2'))
+        rows = [(row['actor']['name'], row['verb']) for row in response.data['results']]
+        self.assertEqual(rows, [('u2', 'started following'), ('u2', 'joined')])
+        self.assertEqual(response.data['results'][0]['target'], dict(name='g', type='Group'))
+
+        response = self.client.get('/api/kehubu/activity/', response.data['next_query'])
+        self.assertEqual([row['actor']['name'] for row in response.data['results']], ['u1', 'u1'])
+
+    def test_activity_list_pages_by_keyset(self):
+        response = self.client.get('/api/kehubu/activity/', dict(limit=3))
+        expected = [row['id'] for row in response.data['results']]
+        response = self.client.get('/api/kehubu/activity/', dict(limit=3, offset=3))
+        expected += [row['id'] for row in response.data['results']]
+
+        # the page, then its actors and targets: no COUNT(*)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/kehubu/activity/', dict(limit=3, before=''))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('count', response.data)
+        self.assertIsNone(response.data['previous_query'])
+        first = [row['id'] for row in response.data['results']]
+        self.assertEqual(first, expected[:3])
+
+        response = self.client.get('/api/kehubu/activity/', response.data['next_query'])
+        self.assertEqual([row['id'] for row in response.data['results']], expected[3:])
+
+        response = self.client.get('/api/kehubu/activity/', response.data['previous_query'])
+        self.assertEqual([row['id'] for row in response.data['results']], first)
+
+        response = self.client.get('/api/kehubu/activity/', dict(before='garbage'))
+        self.assertEqual(response.status_code, 400)
+
+
+class FeedTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=User.objects.create(username='creator'), name='g')
+        self.other = Group.objects.create(creator=User.objects.create(username='other'), name='other')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_feed(self, user):
+        return list(FeedItem.objects.filter(user=user).order_by('timestamp', 'id')
+                    .values_list('action__verb', 'action__target_object_id'))
+
+    def test_actions_fan_out_to_current_members(self):
+        member = User.objects.create(username='u')
+        self.group.add_member(member)
+        creator_feed = self.get_feed(self.group.creator)
+        self.assertIn(('joined', str(self.group.pk)), creator_feed)
+        self.assertNotIn(str(self.other.pk), [target for verb, target in creator_feed])
+
+    def test_joining_backfills_the_group_history(self):
+        for i in range(3):
+            self.group.add_member(User.objects.create(username='u{}'.format(i)))
+        history = Action.objects.filter(target_object_id=str(self.group.pk)).count()
+        self.group.add_member(self.user)
+        # the history plus this member's own join and follow
+        self.assertEqual(len(self.get_feed(self.user)), history + 2)
+        self.assertEqual({target for verb, target in self.get_feed(self.user)}, {str(self.group.pk)})
+
+    @override_settings(KEHUBU_FEED_BACKFILL_SIZE=2)
+    def test_backfill_is_capped(self):
+        for i in range(3):
+            self.group.add_member(User.objects.create(username='u{}'.format(i)))
+        self.group.add_member(self.user)
+        self.assertEqual(len(self.get_feed(self.user)), 2 + 2)
+
+    def test_leaving_removes_the_group_feed(self):
+        member, created = self.group.add_member(self.user)
+        self.other.add_member(self.user)
+        member.delete()
+        self.assertEqual({target for verb, target in self.get_feed(self.user)}, {str(self.other.pk)})
+
+    def test_ordering_by_action_fields(self):
+        self.group.add_member(self.user)
+        response = self.client.get('/api/kehubu/activity/', dict(ordering='timestamp'))
+        timestamps = [row['timestamp'] for row in response.data['results']]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        response = self.client.get('/api/kehubu/activity/', dict(ordering='-id'))
+        ids = [row['id'] for row in response.data['results']]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+        response = self.client.get('/api/kehubu/activity/', dict(ordering='verb'))
+        verbs = [row['verb'] for row in response.data['results']]
+        self.assertEqual(verbs, sorted(verbs))
+
+
+class TokenEndpoint(object):
+    """Stands in for the WeChat API, counting the credentials it hands out."""
+    def __init__(self, expires_in=7200, delay=0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.tokens = 0
+        self.tickets = 0
+        self.lock = threading.Lock()
+
+    def response(self, data):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = data
+        response.content = json.dumps(data).encode()
+        return response
+
+    def get(self, url, params=None, **kwargs):
+        time.sleep(self.delay)
+        with self.lock:
+            self.tokens += 1
+            token = '{}-token{}'.format(params['secret'], self.tokens)
+        return self.response({'access_token': token, 'expires_in': self.expires_in})
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.tickets += 1
+        return self.response({'errcode': 0, 'ticket': 'ticket{}'.format(self.tickets),
+                              'expires_in': self.expires_in})
+
+
+class WeChatClientTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = SocialApp.objects.create(provider='weixin', name='wx', client_id='appid', secret='s1')
+        self.app.sites.add(Site.objects.get_current())
+
+    def stub_endpoint(self, **kwargs):
+        endpoint = TokenEndpoint(**kwargs)
+        for name in ('get', 'request'):
+            patcher = mock.patch('requests.Session.{}'.format(name), side_effect=getattr(endpoint, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return endpoint
+
+    def test_access_token_is_cached_until_refresh_ahead(self):
+        endpoint = self.stub_endpoint()
+        client = get_wechat_client()
+        self.assertEqual(client.access_token, 's1-token1')
+        self.assertEqual(client.access_token, 's1-token1')
+        self.assertEqual(endpoint.tokens, 1)
+
+        endpoint.expires_in = client.refresh_ahead - 1
+        cache.clear()
+        self.assertEqual(client.access_token, 's1-token2')
+        self.assertEqual(client.access_token, 's1-token3')
+        self.assertEqual(endpoint.tokens, 3)
+
+    def test_concurrent_refresh_fetches_once(self):
+        endpoint = self.stub_endpoint(delay=0.2)
+        client = get_wechat_client()
+        tokens = []
+
+        def fetch():
+            tokens.append(client.access_token)
+
+        threads = [threading.Thread(target=fetch) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(endpoint.tokens, 1)
+        self.assertEqual(tokens, ['s1-token1'] * 5)
+
+    def test_jsapi_ticket_is_cached(self):
+        endpoint = self.stub_endpoint()
+        client = get_wechat_client()
+        self.assertEqual(client.get_jsapi_ticket(), 'ticket1')
+        self.assertEqual(client.get_jsapi_ticket(), 'ticket1')
+        self.assertEqual(endpoint.tickets, 1)
+
+    def test_client_follows_credential_changes(self):
+        endpoint = self.stub_endpoint()
+        client = get_wechat_client()
+        with self.assertNumQueries(0):
+            self.assertIs(get_wechat_client(), client)
+        self.assertEqual(client.access_token, 's1-token1')
+
+        self.app.secret = 's2'
+        self.app.save()
+        new_client = get_wechat_client()
+        self.assertIsNot(new_client, client)
+        self.assertEqual(new_client.secret, 's2')
+        self.assertEqual(new_client.access_token, 's2-token2')
+        self.assertEqual(endpoint.tokens, 2)
+
+    def test_missing_app(self):
+        self.app.sites.clear()
+        with self.assertRaises(SocialApp.DoesNotExist):
+            get_wechat_client()
+
+
+class ThumbnailTest(KehubuTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create(username='me')
+        group = Group.objects.create(creator=user, name='g')
+        self.album = GroupAlbum.objects.create(group=group, title='a')
+        patcher = mock.patch('kehubu.thumbnails.get_executor', return_value=ImmediateExecutor())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_url_does_not_touch_storage(self):
+        with mock.patch('kehubu.thumbnails.transaction.on_commit'):
+            image = GroupAlbumImage.objects.create(album=self.album, image=make_image(color='green'))
+        with mock.patch.object(image.thumb.storage, 'exists') as exists:
+            url = image.thumb.url
+        exists.assert_not_called()
+        self.assertTrue(url.endswith('.jpg'))
+        self.assertFalse(image.thumb.storage.exists(image.thumb.name))
+        self.assertFalse(GroupAlbumImage.objects.get(pk=image.pk).thumb_ready)
+
+    def test_generated_after_commit(self):
+        image = GroupAlbumImage.objects.create(album=self.album, image=make_image())
+        self.assertTrue(GroupAlbumImage.objects.get(pk=image.pk).thumb_ready)
+        self.assertTrue(image.thumb.storage.exists(image.thumb.name))
+        self.assertEqual(Image.open(image.thumb.storage.open(image.thumb.name)).size, (300, 300))
+
+    def test_new_image_resets_ready(self):
+        image = GroupAlbumImage.objects.create(album=self.album, image=make_image())
+        with mock.patch('kehubu.thumbnails.transaction.on_commit'):
+            image.image = make_image(name='blue.png', color='blue')
+            image.save()
+        self.assertFalse(GroupAlbumImage.objects.get(pk=image.pk).thumb_ready)
+
+    def test_failed_generation_stays_pending(self):
+        with mock.patch('kehubu.thumbnails.generate_thumbnail', side_effect=IOError('disk full')), \
+                self.assertLogs('kehubu.thumbnails', 'ERROR'):
+            image = GroupAlbumImage.objects.create(album=self.album, image=make_image())
+        self.assertFalse(GroupAlbumImage.objects.get(pk=image.pk).thumb_ready)
+
+    def test_warm_thumbnails(self):
+        with mock.patch('kehubu.thumbnails.transaction.on_commit'):
+            image = GroupAlbumImage.objects.create(album=self.album, image=make_image())
+        out = StringIO()
+        with mock.patch('kehubu.management.commands.warm_thumbnails.ProcessPoolExecutor', ImmediateExecutor):
+            call_command('warm_thumbnails', stdout=out)
+        self.assertIn('1 thumbnails warmed, 0 failed', out.getvalue())
+        self.assertTrue(GroupAlbumImage.objects.get(pk=image.pk).thumb_ready)
+        self.assertTrue(image.thumb.storage.exists(image.thumb.name))
+
+
+class AlbumAddImagesTest(KehubuTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create(username='me')
+        self.album = GroupAlbum.objects.create(group=Group.objects.create(creator=user, name='g'), title='a')
+        patcher = mock.patch('kehubu.thumbnails.get_executor', return_value=ImmediateExecutor())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bulk_insert(self):
+        with returning_bulk_insert(GroupAlbumImage) as (bulk_create,):
+            images = self.album.add_images([make_image('a.png', color='red'), make_image('b.png', color='blue')])
+        bulk_create.assert_called_once()
+        self.assertEqual(sorted(self.album.groupalbumimage_set.values_list('pk', flat=True)),
+                         sorted(image.pk for image in images))
+        for image in images:
+            self.assertTrue(GroupAlbumImage.objects.get(pk=image.pk).thumb_ready)
+            self.assertEqual(Blob.objects.get(name=image.image.name).refcount, 1)
+
+    def test_failure_releases_blobs(self):
+        with mock.patch('kehubu.thumbnails.transaction.on_commit'):
+            shared = GroupAlbumImage.objects.create(album=self.album, image=make_image(color='red'))
+        for bulk in (False, True):
+            with self.subTest(bulk=bulk), ExitStack() as stack:
+                if bulk:
+                    stack.enter_context(returning_bulk_insert(GroupAlbumImage))
+                stack.enter_context(mock.patch('kehubu.thumbnails.transaction.on_commit',
+                                               side_effect=[None, IOError('queue full')]))
+                files = [make_image('a.png', color='red'), make_image('b.png', color='blue')]
+                with self.assertRaises(IOError):
+                    self.album.add_images(files)
+                self.assertEqual(list(self.album.groupalbumimage_set.all()), [shared])
+                self.assertEqual(list(Blob.objects.values_list('name', 'refcount')), [(shared.image.name, 1)])
+                self.assertTrue(blob_storage.exists(shared.image.name))
+                self.assertFalse(blob_storage.exists(blob_storage.get_blob_name('b.png', files[1])))
+
+
+class AlbumUploadTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.album = GroupAlbum.objects.create(group=self.group, title='a')
+        self.client = APIClient()
+        self.url = '/api/kehubu/groupalbum/{}/upload/'.format(self.album.pk)
+
+    def upload(self, *images):
+        return self.client.post(self.url, {'images': list(images)}, format='multipart')
+
+    def test_upload(self):
+        self.client.force_authenticate(self.user)
+        response = self.upload(make_image('a.png', color='red'), make_image('b.png', color='blue'))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.album.groupalbumimage_set.count(), 2)
+        self.assertEqual(len(response.data['groupalbumimage_set']), 2)
+
+    def test_rejects_non_images(self):
+        self.client.force_authenticate(self.user)
+        response = self.upload(ContentFile(b'not an image', name='a.png'))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.album.groupalbumimage_set.exists())
+
+    def test_member_cannot_upload(self):
+        member = User.objects.create(username='member')
+        self.group.add_member(member)
+        self.client.force_authenticate(member)
+        self.assertEqual(self.upload(make_image()).status_code, 403)
+
+
+class RenditionTest(KehubuTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        patcher = mock.patch('kehubu.renditions.get_executor', return_value=ImmediateExecutor())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save_head_image(self, color):
+        self.user.kehubu_profile.head_image.save('head.png', make_image(color=color))
+        return Profile.objects.get(user=self.user)
+
+    def test_urls_do_not_touch_storage(self):
+        profile = self.save_head_image('green')
+        self.assertTrue(profile.head_image_renditions_ready)
+        with mock.patch('django.core.files.storage.FileSystemStorage.exists') as exists, \
+                mock.patch('imagekit.cachefiles.ImageCacheFile.generate') as generate:
+            renditions = get_renditions(profile.head_image)
+        exists.assert_not_called()
+        generate.assert_not_called()
+        self.assertEqual(sorted(renditions['default']), ['132w', '256w', '64w'])
+        self.assertEqual(sorted(renditions['webp']), ['132w', '256w', '64w'])
+
+    def test_generated_after_commit(self):
+        profile = self.save_head_image('red')
+        files = list(get_rendition_files(profile.head_image))
+        self.assertEqual(len(files), 6)
+        for name, width, file in files:
+            self.assertTrue(file.storage.exists(file.name))
+            self.assertEqual(Image.open(file.storage.open(file.name)).size, (width, width))
+
+    def test_none_until_rendered(self):
+        with mock.patch('kehubu.renditions.transaction.on_commit'):
+            profile = self.save_head_image('yellow')
+        self.assertFalse(profile.head_image_renditions_ready)
+        self.assertIsNone(get_renditions(profile.head_image))
+        self.assertIsNone(get_renditions(User.objects.create(username='u').kehubu_profile.head_image))
+
+    def test_failed_render_stays_not_ready(self):
+        with mock.patch('kehubu.renditions.generate_renditions', side_effect=IOError('disk full')), \
+                self.assertLogs('kehubu.renditions', 'ERROR'):
+            profile = self.save_head_image('purple')
+        self.assertFalse(profile.head_image_renditions_ready)
+        self.assertIsNone(get_renditions(profile.head_image))
+
+        # the next save of the row retries
+        profile.save()
+        self.assertTrue(Profile.objects.get(pk=profile.pk).head_image_renditions_ready)
+
+    def test_new_image_resets_ready(self):
+        self.save_head_image('red')
+        with mock.patch('kehubu.renditions.transaction.on_commit'):
+            profile = self.save_head_image('blue')
+        self.assertFalse(profile.head_image_renditions_ready)
+
+    def test_stale_render_does_not_mark_new_image(self):
+        with mock.patch('kehubu.renditions.transaction.on_commit'):
+            old_name = self.save_head_image('red').head_image.name
+            profile = self.save_head_image('blue')
+        mark_renditions_ready(profile._meta.label, profile.pk, 'head_image', old_name)
+        self.assertFalse(Profile.objects.get(pk=profile.pk).head_image_renditions_ready)
+
+    def test_user_card_follows_ready(self):
+        with mock.patch('kehubu.renditions.transaction.on_commit'):
+            profile = self.save_head_image('red')
+        self.assertIsNone(get_user_cards([self.user.pk])[self.user.pk]['kehubu_profile']['head_image_renditions'])
+
+        profile.save()
+        card = get_user_cards([self.user.pk])[self.user.pk]
+        request = APIRequestFactory().get('/')
+        renditions = absolutize_card(card, request)['kehubu_profile']['head_image_renditions']
+        self.assertTrue(renditions['webp']['64w'].startswith('http://testserver/'))
+
+    def test_warm_renditions(self):
+        with mock.patch('kehubu.renditions.transaction.on_commit'):
+            group = Group.objects.create(creator=self.user, name='g', logo=make_image(color='blue'))
+        self.assertIsNone(get_renditions(group.logo))
+        out = StringIO()
+        with mock.patch('kehubu.management.commands.warm_renditions.ProcessPoolExecutor', ImmediateExecutor):
+            call_command('warm_renditions', field=['kehubu.Group.logo'], stdout=out)
+            call_command('warm_renditions', field=['kehubu.Group.logo'], stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), ['1 images warmed, 0 failed', '0 images warmed, 0 failed'])
+        group = Group.objects.get(pk=group.pk)
+        self.assertTrue(group.logo_renditions_ready)
+        for name, width, file in get_rendition_files(group.logo):
+            self.assertTrue(file.storage.exists(file.name))
+
+
+class HeadImageTest(KehubuTransactionTestCase):
+    url = 'http://wx.qlogo.cn/mmopen/abc/132'
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.session = mock.Mock()
+        for target, value in (('kehubu.avatars.get_session', self.session),
+                              ('kehubu.avatars.get_executor', ImmediateExecutor()),
+                              ('kehubu.renditions.get_executor', ImmediateExecutor())):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def respond(self, status_code=200, etag='', color='red'):
+        content = make_image(color=color).read() if status_code == 200 else b''
+        self.session.get.return_value = mock.Mock(
+            status_code=status_code, content=content, headers={'ETag': etag} if etag else {})
+
+    def get_profile(self):
+        return Profile.objects.get(user=self.user)
+
+    def test_login_schedules_sync(self):
+        SocialAccount.objects.create(user=self.user, provider='weixin', uid='openid',
+                                     extra_data={'nickname': 'nick', 'sex': 2, 'headimgurl': self.url})
+        self.respond(etag='"v1"')
+        self.user.kehubu_profile.update_by_socialaccount('weixin')
+        profile = self.get_profile()
+        self.assertEqual(profile.nickname, 'nick')
+        self.assertEqual(profile.head_image_source, self.url)
+        self.assertEqual(profile.head_image_etag, '"v1"')
+        self.assertEqual(Image.open(profile.head_image).size, (256, 256))
+
+    def test_unchanged_image_is_revalidated(self):
+        self.respond(etag='"v1"')
+        self.assertTrue(sync_head_image(self.user.kehubu_profile.pk, self.url))
+        name = self.get_profile().head_image.name
+
+        self.respond(status_code=304)
+        self.assertFalse(sync_head_image(self.user.kehubu_profile.pk, self.url))
+        self.assertEqual(self.session.get.call_args[1]['headers'], {'If-None-Match': '"v1"'})
+        self.assertEqual(self.get_profile().head_image.name, name)
+
+    def test_same_url_without_etag_is_not_fetched(self):
+        self.respond()
+        self.assertTrue(sync_head_image(self.user.kehubu_profile.pk, self.url))
+        self.assertFalse(sync_head_image(self.user.kehubu_profile.pk, self.url))
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_new_url_with_same_etag_keeps_image(self):
+        self.respond(etag='"v1"')
+        sync_head_image(self.user.kehubu_profile.pk, self.url)
+        name = self.get_profile().head_image.name
+
+        new_url = self.url.replace('abc', 'def')
+        self.assertFalse(sync_head_image(self.user.kehubu_profile.pk, new_url))
+        profile = self.get_profile()
+        self.assertEqual(profile.head_image_source, new_url)
+        self.assertEqual(profile.head_image.name, name)
+
+    def test_new_image_is_saved(self):
+        self.respond(etag='"v1"')
+        sync_head_image(self.user.kehubu_profile.pk, self.url)
+        self.respond(etag='"v2"', color='blue')
+        self.assertTrue(sync_head_image(self.user.kehubu_profile.pk, self.url.replace('abc', 'def')))
+        self.assertEqual(self.get_profile().head_image_etag, '"v2"')
+
+    def test_fetch_errors_are_logged(self):
+        self.session.get.side_effect = requests.ConnectionError('timed out')
+        with self.assertLogs('kehubu.avatars', 'ERROR'):
+            schedule_head_image(self.user.kehubu_profile, self.url)
+        self.assertFalse(self.get_profile().head_image)
+
+
+class BlobStorageTest(KehubuTransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        shutil.rmtree(os.path.join(self.media_root, blob_storage.prefix), ignore_errors=True)
+
+    def save(self, data=b'hello', name='file.txt'):
+        return blob_storage.save(name, ContentFile(data))
+
+    def get_refcount(self, name):
+        return Blob.objects.get(name=name).refcount
+
+    def list_blobs(self, name):
+        return blob_storage.listdir(os.path.dirname(name))[1]
+
+    def test_identical_content_is_stored_once(self):
+        name = self.save(name='a.txt')
+        self.assertEqual(self.save(name='b.txt'), name)
+        self.assertTrue(name.startswith('uploads/blobs/'))
+        self.assertTrue(name.endswith('.txt'))
+        self.assertEqual(self.get_refcount(name), 2)
+        self.assertEqual(self.list_blobs(name), [os.path.basename(name)])
+        self.assertNotEqual(self.save(b'other'), name)
+
+    def test_release_collects_last_reference(self):
+        name = self.save()
+        self.save()
+        blob_storage.release(name)
+        self.assertEqual(self.get_refcount(name), 1)
+        self.assertTrue(blob_storage.exists(name))
+
+        blob_storage.release(name)
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+        self.assertFalse(blob_storage.exists(name))
+        blob_storage.release(name)
+
+    def test_collect_keeps_referenced_blobs(self):
+        name = self.save()
+        blob_storage.collect(name)
+        self.assertTrue(blob_storage.exists(name))
+        self.assertEqual(self.get_refcount(name), 1)
+
+    def test_failed_write_leaves_no_reference(self):
+        with mock.patch('django.core.files.storage.FileSystemStorage._save', side_effect=IOError('disk full')):
+            with self.assertRaises(IOError):
+                self.save()
+        self.assertFalse(Blob.objects.exists())
+
+    def test_concurrent_identical_write(self):
+        name = self.save()
+        exists = blob_storage.exists
+        checked = []
+
+        def not_yet_written(path):
+            # the first check runs before an identical upload lands
+            if path == name and not checked:
+                checked.append(path)
+                return False
+            return exists(path)
+
+        with mock.patch.object(blob_storage, 'exists', side_effect=not_yet_written):
+            self.assertEqual(self.save(), name)
+        self.assertEqual(self.list_blobs(name), [os.path.basename(name)])
+        self.assertEqual(self.get_refcount(name), 2)
+
+    def test_collected_before_acquire_is_rewritten(self):
+        name = self.save()
+        Blob.objects.filter(name=name).update(refcount=0)
+        acquire = blob_storage.acquire
+
+        def collect_then_acquire(name, size=0):
+            blob_storage.collect(name)
+            self.assertFalse(blob_storage.exists(name))
+            acquire(name, size)
+
+        with mock.patch.object(blob_storage, 'acquire', side_effect=collect_then_acquire):
+            self.assertEqual(self.save(), name)
+        self.assertTrue(blob_storage.exists(name))
+        self.assertEqual(self.get_refcount(name), 1)
+
+    def test_album_image_releases_blob(self):
+        user = User.objects.create(username='me')
+        album = GroupAlbum.objects.create(group=Group.objects.create(creator=user, name='g'), title='a')
+        with mock.patch('kehubu.thumbnails.transaction.on_commit'):
+            first = GroupAlbumImage.objects.create(album=album, image=make_image())
+            second = GroupAlbumImage.objects.create(album=album, image=make_image())
+        name = first.image.name
+        self.assertEqual(second.image.name, name)
+        self.assertEqual(self.get_refcount(name), 2)
+
+        first.delete()
+        self.assertEqual(self.get_refcount(name), 1)
+        second.delete()
+        self.assertFalse(blob_storage.exists(name))
+
+    def test_reconcile_blobs(self):
+        user = User.objects.create(username='me')
+        group = Group.objects.create(creator=user, name='g')
+        album = GroupAlbum.objects.create(group=group, title='a')
+        with mock.patch('kehubu.thumbnails.transaction.on_commit'):
+            image = GroupAlbumImage.objects.create(album=album, image=make_image())
+        attachment = Attachment.objects.create(group=group, creator=user, file=ContentFile(b'hello', name='a.txt'))
+        orphan = self.save(b'orphan')
+        Blob.objects.filter(name=image.image.name).update(refcount=5)
+        Blob.objects.filter(name=attachment.file.name).delete()
+
+        out = StringIO()
+        call_command('reconcile_blobs', stdout=out)
+        self.assertIn('1 created, 3 fixed, 1 collected', out.getvalue())
+        self.assertEqual(self.get_refcount(image.image.name), 1)
+        self.assertEqual(self.get_refcount(attachment.file.name), 1)
+        self.assertEqual(Blob.objects.get(name=attachment.file.name).size, 5)
+        self.assertFalse(Blob.objects.filter(name=orphan).exists())
+        self.assertFalse(blob_storage.exists(orphan))
+
+        out = StringIO()
+        call_command('reconcile_blobs', stdout=out)
+        self.assertIn('0 created, 0 fixed, 0 collected', out.getvalue())
+
+
+class SearchTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.group = Group.objects.create(creator=self.user, name='g')
+        self.backend = get_search_backend()
+
+    def chat(self, message, group=None):
+        return GroupChat.objects.create(group=group or self.group, user=self.user, message=message)
+
+    def test_tokenize(self):
+        self.assertEqual(list(tokenize('Hello, World_2!')), ['hello', 'world', '2'])
+        self.assertEqual(list(tokenize('小组聊天')), ['小', '组', '聊', '天', '小组', '组聊', '聊天'])
+        self.assertEqual(list(tokenize('小组聊天', query=True)), ['小组', '组聊', '聊天'])
+        self.assertEqual(list(tokenize('组', query=True)), ['组'])
+
+    def test_matches_every_term(self):
+        both = self.chat('django search backend')
+        self.chat('django only')
+        self.assertEqual(self.backend.search('groupchat', 'Django backend'), [both.pk])
+        self.assertEqual(self.backend.search('groupchat', 'django missing'), [])
+        self.assertEqual(self.backend.search('groupchat', '  '), [])
+
+    def test_ranking_and_cjk(self):
+        once = self.chat('小组 news')
+        twice = self.chat('小组 小组 news')
+        self.assertEqual(self.backend.search('groupchat', '小组'), [twice.pk, once.pk])
+
+    def test_group_scope(self):
+        other = Group.objects.create(creator=self.user, name='o')
+        mine = self.chat('hello')
+        self.chat('hello', group=other)
+        self.assertEqual(self.backend.search('groupchat', 'hello', group_ids=[self.group.pk]), [mine.pk])
+        self.assertEqual(len(self.backend.search('groupchat', 'hello')), 2)
+
+    def test_edit_and_delete(self):
+        chat = self.chat('hello')
+        chat.message = 'goodbye'
+        chat.save()
+        self.assertEqual(self.backend.search('groupchat', 'hello'), [])
+        self.assertEqual(self.backend.search('groupchat', 'goodbye'), [chat.pk])
+        chat.delete()
+        self.assertEqual(self.backend.search('groupchat', 'goodbye'), [])
+
+    def test_rank(self):
+        once = self.chat('hello world')
+        twice = self.chat('hello hello')
+        self.chat('world')
+        ranked = self.backend.rank(GroupChat.objects.all(), 'groupchat', 'hello').order_by('-search_score')
+        self.assertEqual(list(ranked), [twice, once])
+        self.assertEqual(ranked.count(), 2)
+        self.assertFalse(self.backend.rank(GroupChat.objects.all(), 'groupchat', 'nothing').exists())
+
+
+class LimitOffsetPaginationTest(KehubuTestCase):
+    url = '/api/kehubu/groupalbum/'
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        group = Group.objects.create(creator=self.user, name='g')
+        for i in range(5):
+            GroupAlbum.objects.create(group=group, title='a{}'.format(i))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        counted = any('COUNT(' in query['sql'] for query in context.captured_queries)
+        return response.data, counted
+
+    def test_exact(self):
+        for params in ({}, {'count': 'bogus'}):
+            data, counted = self.get(limit=2, offset=2, **params)
+            self.assertTrue(counted)
+            self.assertEqual(data['count'], 5)
+            self.assertEqual(data['next_query'], dict(params, limit='2', offset='4'))
+            self.assertEqual(data['previous_query'], dict(params, limit='2'))
+
+    def test_none(self):
+        data, counted = self.get(limit=2, offset=2, count='none')
+        self.assertFalse(counted)
+        self.assertIsNone(data['count'])
+        self.assertEqual(len(data['results']), 2)
+        self.assertEqual(data['next_query']['offset'], '4')
+
+        data, counted = self.get(limit=2, offset=4, count='none')
+        self.assertEqual(len(data['results']), 1)
+        self.assertIsNone(data['next'])
+        self.assertIsNone(data['next_query'])
+
+    def test_estimate_is_cached(self):
+        data, counted = self.get(limit=2, count='estimate')
+        self.assertTrue(counted)
+        self.assertEqual(data['count'], 5)
+        data, counted = self.get(limit=2, offset=2, count='estimate')
+        self.assertFalse(counted)
+        self.assertEqual(data['count'], 5)
+
+
+class CoMembershipTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='me')
+        self.peer = User.objects.create(username='peer')
+        self.stranger = User.objects.create(username='stranger')
+        group = Group.objects.create(creator=self.user, name='g')
+        group.add_member(self.peer)
+        Group.objects.create(creator=self.stranger, name='s')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_share_group(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(share_group(self.user.pk, self.peer.pk))
+        self.assertTrue(share_group(self.peer.pk, self.user.pk))
+        self.assertFalse(share_group(self.user.pk, self.stranger.pk))
+        self.assertEqual(set(self.user.kehubu_profile.group_users), {self.user, self.peer})
+
+    def test_profile_list(self):
+        response = self.client.get('/api/kehubu/profile/')
+        self.assertEqual({profile['user']['id'] for profile in response.data['results']},
+                         {self.user.pk, self.peer.pk})
+
+    def test_user_chat_receiver(self):
+        response = self.client.post('/api/kehubu/userchat/', dict(receiver=self.stranger.pk, message='hi'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('receiver', response.data)
+        response = self.client.post('/api/kehubu/userchat/', dict(receiver=self.peer.pk, message='hi'))
+        self.assertEqual(response.status_code, 201)
+
+
+class GroupAlbumImagePermissionTest(KehubuTestCase):
+    def setUp(self):
+        super().setUp()
+        self.creator = User.objects.create(username='creator')
+        self.member = User.objects.create(username='member')
+        group = Group.objects.create(creator=self.creator, name='g')
+        group.add_member(self.member)
+        album = GroupAlbum.objects.create(group=group, title='a')
+        self.image = GroupAlbumImage.objects.create(album=album, image=make_image())
+        self.url = '/api/kehubu/groupalbumimage/{}/'.format(self.image.pk)
+        self.client = APIClient()
+
+    def test_member_can_only_read(self):
+        self.client.force_authenticate(self.member)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.client.delete(self.url).status_code, 403)
+        self.assertTrue(GroupAlbumImage.objects.filter(pk=self.image.pk).exists())
+
+    def test_creator_check_does_not_load_the_album(self):
+        self.client.force_authenticate(self.creator)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.delete(self.url).status_code, 204)
+        album_queries = [query['sql'] for query in context.captured_queries
+                         if 'FROM "kehubu_groupalbum" WHERE' in query['sql']]
+        self.assertEqual(album_queries, [])
+        self.assertFalse(GroupAlbumImage.objects.filter(pk=self.image.pk).exists())
@@ -0,0 +1,73 @@
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class Deferred(object):
+    """
+    imagekit cache file strategy that never generates on ``url`` access;
+    thumbnails are produced by the worker pool and only generated inline
+    when their content is actually read.
+    """
+    def on_content_required(self, file):
+        file.generate()
+
+    def should_verify_existence(self, file):
+        return False
+
+
+def generate_thumbnail(image_name):
+    """
+    Render the album thumbnail for ``image_name``. Runs in a pool process and
+    touches storage only, never the database.
+    """
+    from .models import GroupAlbumImage
+    GroupAlbumImage(image=image_name).thumb.generate()
+    return image_name
+
+
+def mark_thumbnail_ready(pk):
+    from .models import GroupAlbumImage
+    close_old_connections()
+    try:
+        GroupAlbumImage.objects.filter(pk=pk).update(thumb_ready=True)
+    finally:
+        close_old_connections()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = getattr(settings, 'KEHUBU_THUMBNAIL_WORKERS', 2)
+                _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def submit_thumbnail(image):
+    """Render ``image``'s thumbnail in the pool and flag it ready when done."""
+    pk, name = image.pk, image.image.name
+
+    def done(future):
+        try:
+            future.result()
+        except Exception:
+            logger.exception("thumbnail generation failed for %s", name)
+        else:
+            mark_thumbnail_ready(pk)
+
+    get_executor().submit(generate_thumbnail, name).add_done_callback(done)
+
+
+def schedule_thumbnail(image):
+    """Queue ``image``'s thumbnail once the upload transaction has committed."""
+    transaction.on_commit(lambda: submit_thumbnail(image))
@@ -14,6 +14,7 @@ router.register(r'groupalbum', views.GroupAlbumViewSet, basename='groupalbum')
 router.register(r'groupalbumimage', views.GroupAlbumImageViewSet, basename='groupalbumimage')
 router.register(r'groupchat', views.GroupChatViewSet, basename='groupchat')
 router.register(r'userchat', views.UserChatViewSet, basename='userchat')
+router.register(r'conversation', views.ConversationViewSet, basename='conversation')
 urlpatterns = router.urls
 urlpatterns += [
     path('joingroup/', views.JoinGroupView.as_view(), name='JoinGroup'),
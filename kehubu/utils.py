@@ -1,6 +1,14 @@
+import hashlib
+import time
+import threading
 from wechatpy import WeChatClient
+from wechatpy.exceptions import WeChatClientException
+from wechatpy.session import SessionStorage
+from django.core.cache import cache
 from django.contrib.sites.shortcuts import get_current_site
 from django.contrib.sites.models import Site
+from allauth.socialaccount.models import SocialApp
+from .cache import weixin_app_cache
 
 
 def get_weixin_app(request=None):
@@ -12,6 +20,135 @@ def get_weixin_app(request=None):
     return site.socialapp_set.get(provider='weixin')
 
 
+class DjangoCacheStorage(SessionStorage):
+    """wechatpy session storage backed by the shared Django cache."""
+    prefix = 'kehubu.wechat'
+
+    def make_key(self, key):
+        return '{}.{}'.format(self.prefix, key)
+
+    def get(self, key, default=None):
+        return cache.get(self.make_key(key), default)
+
+    def set(self, key, value, ttl=None):
+        cache.set(self.make_key(key), value, ttl)
+
+    def delete(self, key):
+        cache.delete(self.make_key(key))
+
+
+class KehubuWeChatClient(WeChatClient):
+    """
+    WeChatClient whose access token and jsapi ticket live in the shared cache,
+    are refreshed ``refresh_ahead`` seconds before they expire, and are
+    fetched by a single worker at a time.
+    """
+    refresh_ahead = 300
+    lock_timeout = 10
+    wait_timeout = 5
+    wait_interval = 0.1
+
+    def __init__(self, appid, secret, **kwargs):
+        kwargs.setdefault('session', DjangoCacheStorage())
+        super().__init__(appid, secret, **kwargs)
+        # credentials issued under a rotated secret are never read back
+        self.credential_prefix = '{}_{}'.format(appid, hashlib.sha1(secret.encode()).hexdigest()[:12])
+
+    @property
+    def access_token_key(self):
+        return '{}_access_token'.format(self.credential_prefix)
+
+    @property
+    def jsapi_ticket_key(self):
+        return '{}_jsapi_ticket'.format(self.credential_prefix)
+
+    def get_credential(self, key, fetch):
+        """
+        Return the credential stored under ``key``, calling ``fetch()`` for a
+        new ``(value, expires_in)`` pair when it is about to expire. Workers
+        that lose the refresh lock keep using the current value while it is
+        still valid, or wait for the winner to store a new one.
+        """
+        expires_at_key = key + '_expires_at'
+        value = self.session.get(key)
+        expires_at = self.session.get(expires_at_key, 0)
+        if value and expires_at - time.time() > self.refresh_ahead:
+            return value
+
+        lock_key = 'kehubu.wechat.lock.{}'.format(key)
+        if cache.add(lock_key, 1, self.lock_timeout):
+            try:
+                value, expires_in = fetch()
+                self.session.set(key, value, expires_in)
+                self.session.set(expires_at_key, time.time() + expires_in, expires_in)
+                return value
+            finally:
+                cache.delete(lock_key)
+
+        if value and expires_at > time.time():
+            return value
+        deadline = time.time() + self.wait_timeout
+        while time.time() < deadline:
+            time.sleep(self.wait_interval)
+            value = self.session.get(key)
+            if value and self.session.get(expires_at_key, 0) > time.time():
+                return value
+        raise WeChatClientException(None, 'Timed out waiting for {}'.format(key), client=self)
+
+    @property
+    def access_token(self):
+        def fetch():
+            result = self.fetch_access_token()
+            return result['access_token'], int(result.get('expires_in', 7200))
+        return self.get_credential(self.access_token_key, fetch)
+
+    def get_jsapi_ticket(self):
+        def fetch():
+            result = self.jsapi.get_ticket('jsapi')
+            return result['ticket'], int(result['expires_in'])
+        return self.get_credential(self.jsapi_ticket_key, fetch)
+
+
+def get_weixin_credentials(site):
+    """``(client_id, secret)`` of ``site``'s weixin app, from the shared cache."""
+    def fill(site_ids):
+        apps = SocialApp.objects.filter(provider='weixin', sites__in=site_ids)
+        return {site_id: (client_id, secret)
+                for site_id, client_id, secret in apps.values_list('sites', 'client_id', 'secret')}
+
+    credentials = weixin_app_cache.get_or_fill([site.pk], fill).get(site.pk)
+    if credentials is None:
+        raise SocialApp.DoesNotExist('No weixin app for site {}'.format(site.pk))
+    return credentials
+
+
+_client_pool = dict()
+_client_pool_lock = threading.Lock()
+
+
 def get_wechat_client(request=None):
-    app = get_weixin_app(request)
-    return WeChatClient(app.client_id, app.secret)
\ No newline at end of file
+    """
+    Process-wide KehubuWeChatClient for the current site's weixin app, keyed
+    by its credentials so every process switches clients once they change.
+    """
+    if request is None:
+        site = Site.objects.get_current()
+    else:
+        site = get_current_site(request)
+
+    client_id, secret = credentials = get_weixin_credentials(site)
+    client = _client_pool.get(credentials)
+    if client is None:
+        with _client_pool_lock:
+            client = _client_pool.get(credentials)
+            if client is None:
+                for key in [key for key in _client_pool if key[0] == client_id]:
+                    del _client_pool[key]
+                client = _client_pool[credentials] = KehubuWeChatClient(client_id, secret)
+    return client
+
+
+def invalidate_weixin_credentials():
+    """Drop the cached weixin credentials of every site, in every process."""
+    for site_id in Site.objects.values_list('pk', flat=True):
+        weixin_app_cache.invalidate(site_id)
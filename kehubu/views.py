@@ -1,3 +1,4 @@
+import json
 from django.http.response import HttpResponseRedirect
 from django.contrib.sites.shortcuts import get_current_site
 from django.urls import reverse
@@ -6,26 +7,49 @@ from .serializers import (
     MemberInviterSerializer, MemberUserSerializer, GroupMemberRankSerializer,
     GroupInvitationSerializer, ActionSerializer, GroupAlbumSerializer,
     GroupAlbumImageSerializer, GroupChatSerializer, WxConfigSerializer,
-    UserChatSerializer,
+    UserChatSerializer, ConversationSerializer, GroupAlbumUploadSerializer, absolutize_card,
 )
 from .models import (
     Group, Profile, Member, GroupMemberRank, GroupInvitation, GroupAlbum,
-    GroupAlbumImage, GroupChat, UserChat,
+    GroupAlbumImage, GroupChat, UserChat, Conversation, FeedItem, co_member_user_ids,
 )
 from rest_framework import (
         viewsets, generics, permissions, filters, exceptions, status, views,
 )
 from .permissions import (
     IsOwnerOrReadOnly, IsGroupCreatorOrReadOnly, IsGroupCreator,
-    IsGroupAlbumCreatorOrReadOnly,
+    IsGroupAlbumCreatorOrReadOnly, get_roles,
 )
 from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import OrderingFilter, SearchFilter
-from actstream.models import Action
-from django.contrib.contenttypes.models import ContentType
-from django.db.models import Q
+from django.db.models import Q, Prefetch
+from .pagination import KeysetPagination, ActionPagination, LimitOffsetPagination
+from .filters import FeedItemFilter, FeedItemOrderingFilter, IndexedSearchFilter
+
+
+class PreEncodedCreateMixin(object):
+    """
+    Answer create calls from the ``data_json`` the post_save signal already
+    encoded for the broadcast, instead of serializing the row again. The
+    broadcast has no request, so the user cards named by the serializer's
+    ``user_card_sources`` get absolute media URLs here, as in list responses.
+    """
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+        data_json = getattr(serializer.instance, 'data_json', None)
+        if data_json is None:
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        data = json.loads(data_json)
+        for source in serializer.user_card_sources:
+            if data.get(source):
+                data[source] = absolutize_card(data[source], request)
+        return Response(data, status=status.HTTP_201_CREATED)
 
 
 class GroupViewSet(viewsets.ModelViewSet):
@@ -44,7 +68,7 @@ class GroupViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         if self.action == "join":
             return self.queryset
-        return self.queryset.filter_member_user(self.request.user)
+        return self.queryset.filter_member_user(self.request.user).with_stats()
 
     @action(detail=True, permission_classes=[permissions.AllowAny])
     def join(self, request, pk=None):
@@ -54,7 +78,7 @@ class GroupViewSet(viewsets.ModelViewSet):
             return HttpResponseRedirect(redirect_url)
 
         group = self.get_object()
-        if group.has_member(request.user):
+        if get_roles(request).is_member(group.pk):
             return HttpResponseRedirect("/")
 
         inviter = request.query_params.get('inviter')
@@ -77,7 +101,7 @@ class JoinGroupView(generics.CreateAPIView):
 
 class ProfileViewSet(viewsets.ModelViewSet):
     serializer_class = ProfileSerializer
-    queryset = Profile.objects.all()
+    queryset = Profile.objects.select_related('user')
     permission_classes = [IsOwnerOrReadOnly]
     owner_field = "user"
     filterset_fields = ('user', 'nickname', )
@@ -92,13 +116,12 @@ class ProfileViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
     def get_queryset(self):
-        group_user_ids = self.request.user.kehubu_profile.group_user_ids
-        return Profile.objects.filter(user__in=group_user_ids)
+        return self.queryset.filter(user__in=co_member_user_ids(self.request.user.pk))
 
 
 class MemberViewSet(viewsets.ModelViewSet):
     serializer_class = MemberSerializer
-    queryset = Member.objects.all()
+    queryset = Member.objects.select_related('rank').prefetch_related('tags')
     permission_classes = [IsGroupCreatorOrReadOnly, permissions.IsAuthenticated]
     filterset_fields = ('user', 'inviter', 'group')
     filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
@@ -108,7 +131,7 @@ class MemberViewSet(viewsets.ModelViewSet):
         user = self.request.user
         user_member_set = user.user_kehubu_member_set.all()
         group_set = user_member_set.values_list("group", flat=True)
-        return Member.objects.filter(group__in=group_set)
+        return self.queryset.filter(group__in=group_set)
 
     def perform_destroy(self, instance):
         if instance.user == self.request.user:
@@ -118,24 +141,22 @@ class MemberViewSet(viewsets.ModelViewSet):
 
 class MemberInviterViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = MemberInviterSerializer
-    queryset = Member.objects.all()
+    queryset = Member.objects.prefetch_related(Prefetch('group', queryset=Group.objects.with_stats()))
     permission_classes = [permissions.IsAuthenticated]
     filterset_fields = ('user', 'inviter', 'group')
 
     def get_queryset(self):
-        user = self.request.user
-        return user.user_kehubu_member_set.all()
+        return self.queryset.filter(user=self.request.user)
 
 
 class MemberUserViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = MemberUserSerializer
-    queryset = Member.objects.all()
+    queryset = Member.objects.prefetch_related(Prefetch('group', queryset=Group.objects.with_stats()))
     permission_classes = [permissions.IsAuthenticated]
     filterset_fields = ('user', 'user', 'group')
 
     def get_queryset(self):
-        user = self.request.user
-        return user.inviter_kehubu_member_set.all()
+        return self.queryset.filter(inviter=self.request.user)
 
 
 class GroupMemberRankViewSet(viewsets.ModelViewSet):
@@ -147,7 +168,7 @@ class GroupMemberRankViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         user = self.request.user
         group_set = user.creator_kehubu_group_set.all()
-        return GroupMemberRank.objects.filter(group__in=group_set)
+        return self.queryset.filter(group__in=group_set)
 
 
 class GroupInvitationViewSet(viewsets.ModelViewSet):
@@ -168,33 +189,22 @@ class GroupInvitationViewSet(viewsets.ModelViewSet):
 
 class ActivityListView(generics.ListAPIView):
     serializer_class = ActionSerializer
-    queryset = Action.objects.all()
+    queryset = FeedItem.objects.all()
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
-    filterset_fields = ('actor_object_id', 'actor_content_type', 'action_object_object_id',
-        'action_object_content_type', 'target_object_id', 'target_content_type')
+    pagination_class = ActionPagination
+    filter_backends = (DjangoFilterBackend, FeedItemOrderingFilter, SearchFilter)
+    filterset_class = FeedItemFilter
+    ordering_fields = ('id', 'verb', 'public', 'timestamp', 'actor_content_type', 'actor_object_id',
+                       'action_object_content_type', 'action_object_object_id',
+                       'target_content_type', 'target_object_id')
 
     def get_queryset(self):
-        #FIXME: only return the group related actions for now
-        group_set = self.request.user.kehubu_profile.group_set
-        group_ids = list(group_set.values_list("pk", flat=True))
-        ctype = ContentType.objects.get_for_model(Group)
-        return self.queryset.filter(
-            Q(
-                actor_content_type=ctype,
-                actor_object_id__in=group_ids,
-            ) | Q(
-                target_content_type=ctype,
-                target_object_id__in=group_ids,
-            ) | Q(
-                action_object_content_type=ctype,
-                action_object_object_id__in=group_ids,
-            ))
+        return self.request.user.kehubu_feeditem_set.order_by('-timestamp', '-id')
 
 
 class GroupAlbumViewSet(viewsets.ModelViewSet):
     serializer_class = GroupAlbumSerializer
-    queryset = GroupAlbum.objects.all()
+    queryset = GroupAlbum.objects.prefetch_related('groupalbumimage_set')
     permission_classes = [IsGroupCreatorOrReadOnly, permissions.IsAuthenticated]
     filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
     filterset_fields = ('group', )
@@ -204,12 +214,30 @@ class GroupAlbumViewSet(viewsets.ModelViewSet):
         user = self.request.user
         user_member_set = user.user_kehubu_member_set.all()
         group_set = user_member_set.values_list("group", flat=True)
-        return GroupAlbum.objects.filter(group__in=group_set)
+        return self.queryset.filter(group__in=group_set)
+
+    def initial(self, request, *args, **kwargs):
+        if self.action == 'upload':
+            # spool every file to disk so memory holds one chunk, not the batch
+            request._request.upload_handlers = [TemporaryFileUploadHandler(request._request)]
+        super().initial(request, *args, **kwargs)
+
+    @action(detail=True, methods=['post'], permission_classes=[IsGroupCreator],
+            parser_classes=[MultiPartParser])
+    def upload(self, request, pk=None):
+        album = self.get_object()
+        upload_serializer = GroupAlbumUploadSerializer(data=request.data)
+        upload_serializer.is_valid(raise_exception=True)
+        album.add_images(upload_serializer.validated_data['images'])
+        # reload so the response lists the new images, not the stale prefetch
+        serializer = self.get_serializer(self.get_object())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
 class GroupAlbumImageViewSet(viewsets.ModelViewSet):
     serializer_class = GroupAlbumImageSerializer
-    queryset = GroupAlbumImage.objects.all()
+    # IsGroupAlbumCreatorOrReadOnly reads obj.album.group_id
+    queryset = GroupAlbumImage.objects.select_related('album')
     permission_classes = [IsGroupAlbumCreatorOrReadOnly, permissions.IsAuthenticated]
     filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
     filterset_fields = ('album', 'album__group' )
@@ -218,21 +246,31 @@ class GroupAlbumImageViewSet(viewsets.ModelViewSet):
         user = self.request.user
         user_member_set = user.user_kehubu_member_set.all()
         group_set = user_member_set.values_list("group", flat=True)
-        return GroupAlbumImage.objects.filter(album__group__in=group_set)
+        return self.queryset.filter(album__group__in=group_set)
 
 
-class GroupChatViewSet(viewsets.ModelViewSet):
+class GroupChatViewSet(PreEncodedCreateMixin, viewsets.ModelViewSet):
     serializer_class = GroupChatSerializer
     queryset = GroupChat.objects.all()
     permission_classes = [IsOwnerOrReadOnly, permissions.IsAuthenticated]
     owner_field = "user"
-    filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
+    pagination_class = KeysetPagination
+    search_pagination_class = LimitOffsetPagination
+    filter_backends = (DjangoFilterBackend, IndexedSearchFilter)
     filterset_fields = ('group', 'user')
-    ordering_fields = ('id', 'created', 'modified')
+    search_kind = 'groupchat'
 
     def get_queryset(self):
         group_set = self.request.user.kehubu_profile.group_set
-        return GroupChat.objects.filter(group__in=group_set)
+        return self.queryset.filter(group__in=group_set)
+
+    @property
+    def paginator(self):
+        # keyset pages are ordered by time, so ranked search results page by offset
+        query = self.request.query_params.get(IndexedSearchFilter.search_param, '').strip()
+        if query and not hasattr(self, '_paginator'):
+            self._paginator = self.search_pagination_class()
+        return super().paginator
 
 
 class WxConfigAPIView(views.APIView):
@@ -249,23 +287,40 @@ class WxConfigAPIView(views.APIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
-class UserChatViewSet(viewsets.ModelViewSet):
+class UserChatViewSet(PreEncodedCreateMixin, viewsets.ModelViewSet):
     serializer_class = UserChatSerializer
     queryset = UserChat.objects.all()
     permission_classes = [IsOwnerOrReadOnly, permissions.IsAuthenticated]
     owner_field = "sender"
-    filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
+    pagination_class = KeysetPagination
+    filter_backends = (DjangoFilterBackend, SearchFilter)
     filterset_fields = ('receiver', 'sender')
-    ordering_fields = ('id', 'created', 'modified')
 
     def get_queryset(self):
         user = self.request.user
-        qs = UserChat.objects.filter(Q(sender=user) | Q(receiver=user))
         chat_user = self.request.query_params.get('chat_user', None)
         if chat_user:
             try:
                 chat_user = int(chat_user)
             except ValueError:
                 raise exceptions.APIException("Invalid chat_user param")
-            qs = qs.filter(Q(sender=chat_user) | Q(receiver=chat_user))
-        return qs
+            return self.queryset.filter(
+                Q(sender=user, receiver=chat_user) | Q(sender=chat_user, receiver=user))
+        return self.queryset.filter(Q(sender=user) | Q(receiver=user))
+
+
+class ConversationViewSet(viewsets.ReadOnlyModelViewSet):
+    serializer_class = ConversationSerializer
+    queryset = Conversation.objects.all()
+    permission_classes = [permissions.IsAuthenticated]
+    filterset_fields = ('peer', )
+
+    def get_queryset(self):
+        return self.queryset.filter(owner=self.request.user).order_by('-last_activity')
+
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        conversation = self.get_object()
+        conversation.mark_read()
+        serializer = self.get_serializer(conversation)
+        return Response(serializer.data)
@@ -140,6 +140,15 @@ CHANNEL_LAYERS = {
     },
 }
 
+# shared by every web, ASGI and worker process, so the membership, user card
+# and WeChat credential caches invalidated by one process are fresh in all
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": "redis://127.0.0.1:6379/1",
+    },
+}
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
@@ -173,6 +182,9 @@ SOCIALACCOUNT_PROVIDERS = {
     }
 }
 
+# processes rendering album thumbnails in each web worker
+KEHUBU_THUMBNAIL_WORKERS = 2
+
 ACCOUNT_ADAPTER = 'kehubu.adapters.KehubuAccountAdapter'
 SOCIALACCOUNT_ADAPTER = 'kehubu.adapters.KehubuSocialAccountAdapter'
 